@@ -40,20 +40,17 @@ def generate_aa_example():
         )
         
         # Find SNPs for amino acids
-        snp_dict, record_snps, num_snps = sfunks.find_snps(
+        variants = sfunks.find_snps(
             reference, alignment, False, sequence_type, "snps"
         )
         
-        # Find ambiguities
-        record_ambs = sfunks.find_ambiguities(alignment, snp_dict, sequence_type)
-        
         # Get nature_aa palette colors
         colours = sfunks.get_colours("nature_aa")
         
         # Generate AA example
         output_file = "docs/examples/nature_aa_example.png"
         sfunks.make_graph(
-            num_seqs, num_snps, record_ambs, record_snps, output_file,
+            num_seqs, variants.num_snps, None, variants, output_file,
             label_map, colours, length, 14, 4, "scale", False, False,
             "snps", False, None, None, False, True, False, None,
             False, None, None, "nature_aa", sequence_type
@@ -35,8 +35,7 @@ def generate_sars_cov2_examples():
         
         label_map = sfunks.label_map(record_ids, None, "name,label", os.getcwd())
         reference, alignment = sfunks.get_ref_and_alignment(alignment_file, ref_input, label_map)
-        snp_dict, record_snps, num_snps = sfunks.find_snps(reference, alignment, False, sequence_type, "snps")
-        record_ambs = sfunks.find_ambiguities(alignment, snp_dict, sequence_type)
+        variants = sfunks.find_snps(reference, alignment, False, sequence_type, "snps")
         
         # Parse GenBank file
         gene_features = sfunks.parse_genbank("docs/test_reference.gb", os.getcwd(), sequence_type)
@@ -45,7 +44,7 @@ def generate_sars_cov2_examples():
         colours = sfunks.get_colours("morandi")
         output_file = "docs/examples/sars_cov2_morandi.png"
         sfunks.make_graph(
-            num_seqs, num_snps, record_ambs, record_snps, output_file,
+            num_seqs, variants.num_snps, None, variants, output_file,
             label_map, colours, length, 16, 6, "scale", False, False,
             "snps", False, None, None, False, True, False, None,
             False, None, gene_features, "morandi", sequence_type
@@ -56,7 +55,7 @@ def generate_sars_cov2_examples():
         colours = sfunks.get_colours("monet")
         output_file = "docs/examples/sars_cov2_monet.png"
         sfunks.make_graph(
-            num_seqs, num_snps, record_ambs, record_snps, output_file,
+            num_seqs, variants.num_snps, None, variants, output_file,
             label_map, colours, length, 16, 6, "scale", False, False,
             "snps", False, None, None, False, True, False, None,
             False, None, gene_features, "monet", sequence_type
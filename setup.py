@@ -39,7 +39,8 @@ setup(name='snipit-mc',
       scripts=["snipit/scripts/snp_functions.py"],
       install_requires=[
             "biopython>=1.70",
-            "matplotlib>=3.2.1"
+            "matplotlib>=3.2.1",
+            "numpy>=1.17"
         ],
       description='Enhanced snipit with artistic color palettes and improved SNP visualization',
       long_description=long_description,
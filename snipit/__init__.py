@@ -11,8 +11,10 @@ try:
         quick_plot,
         publication_plot,
         protein_plot,
-        genbank_plot
+        genbank_plot,
+        clear_variant_cache
     )
+    from .service import snipit_plot_async, SnipitService
     
     __all__ = [
         'snipit_plot',
@@ -22,7 +24,10 @@ try:
         'quick_plot',
         'publication_plot',
         'protein_plot',
-        'genbank_plot'
+        'genbank_plot',
+        'clear_variant_cache',
+        'snipit_plot_async',
+        'SnipitService'
     ]
 except ImportError:
     # During build, dependencies might not be available
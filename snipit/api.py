@@ -30,9 +30,15 @@ from pathlib import Path
 
 # Import existing snipit functionality
 from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.variant_cache import VariantCache
 from snipit import command
 
 
+# Parsed alignments and called variants, shared by all API calls in this process so that
+# re-plotting the same alignment (e.g. with a different palette) only re-renders
+variant_cache = VariantCache(max_bytes=256 * 1024 * 1024)
+
+
 @dataclass
 class SnipitConfig:
     """Configuration class for snipit plotting parameters.
@@ -46,23 +52,39 @@ class SnipitConfig:
         labels (str): Path to CSV file with sequence labels
         label_headers (str): Column headers for label CSV. Default: 'name,label'
         genbank (str): Path to GenBank file for gene annotations
+        region (str): Region of a VCF input to read, e.g. 'MN908947.3:21563-25384'
         
         # Mode options
         recombi_mode (bool): Enable recombination mode. Default: False
         recombi_references (str): Comma-separated sequence IDs for recombination
+        compare_references (str): Comma-separated sequence IDs to plot the alignment against in one run,
+            one output per reference
         cds_mode (bool): Assume sequence is coding sequence. Default: False
+        colour_by_gene (bool): Colour SNP cells by gene (requires genbank). Default: False
         
         # Output options
         output_dir (str): Output directory. Default: current directory
         output_file (str): Output file name stem. Default: 'snp_plot'
         write_snps (bool): Write SNPs to CSV file. Default: False
-        format (str): Output format (png, jpg, pdf, svg, tiff). Default: 'png'
+        write_vcf (bool): Write variants to a multi-sample VCF file. Default: False
+        format (str): Output format (png, jpg, pdf, svg, tiff, html), or several comma separated
+            formats such as 'png,svg,pdf' saved from one render. Default: 'png'
+        page_rows (int): Split the plot into pages of at most this many sequences, 0 for one page.
+            Default: automatic
+        processes (int): Number of processes to draw pages in parallel with. Default: 1
         
         # Figure options
         height (float): Figure height. Default: auto
         width (float): Figure width. Default: auto
         size_option (str): Sizing options: 'expand' or 'scale'
         solid_background (bool): Use solid background. Default: False
+        dpi (int): Resolution of the saved figure. Default: 300, or 72 with preview
+        native_svg (bool): Write svg output directly rather than through matplotlib, for much
+            smaller files. Sized by the number of sites and sequences. Default: False
+        preview (bool): Fast, low resolution preview without rounded cells, text shadows
+            or label boxes. Default: False
+        all_labels (bool): Draw every letter and label, rather than leaving them off
+            cells too small to read. Default: False
         colour_palette (str): Color palette name. Default: 'classic'
         flip_vertical (bool): Flip plot orientation. Default: False
         sort_by_mutation_number (bool): Sort by SNP count. Default: False
@@ -73,7 +95,15 @@ class SnipitConfig:
         show_indels (bool): Include indels in plot. Default: False
         include_positions (str): Positions to include (e.g., '100-150')
         exclude_positions (str): Positions to exclude (e.g., '223 224')
+        mask_bed (str): BED file of regions to mask
+        mask_vcf (str): VCF file of sites to mask, e.g. the SARS-CoV-2 problematic sites
         ambig_mode (str): Handle ambiguous bases: 'all', 'snps', 'exclude'. Default: 'exclude'
+        min_site_count (int): Only show sites where at least this many sequences vary. Default: 0
+        min_site_frequency (float): Only show sites where at least this fraction of sequences vary. Default: 0
+        
+        # Misc options
+        profile (bool): Print per-stage wall time, CPU time and peak memory. Default: False
+        profile_trace (str): Path to write a Chrome trace JSON of the profiled stages
     """
     
     # Input options
@@ -82,23 +112,33 @@ class SnipitConfig:
     labels: Optional[str] = None
     label_headers: str = 'name,label'
     genbank: Optional[str] = None
+    region: Optional[str] = None
     
     # Mode options
     recombi_mode: bool = False
     recombi_references: Optional[str] = None
+    compare_references: Optional[str] = None
     cds_mode: bool = False
+    colour_by_gene: bool = False
     
     # Output options
     output_dir: Optional[str] = None
     output_file: str = 'snp_plot'
     write_snps: bool = False
+    write_vcf: bool = False
     format: str = 'png'
+    page_rows: Optional[int] = None
+    processes: int = 1
     
     # Figure options
     height: float = 0
     width: float = 0
     size_option: Optional[str] = None
     solid_background: bool = False
+    dpi: Optional[int] = None
+    native_svg: bool = False
+    preview: bool = False
+    all_labels: bool = False
     colour_palette: str = 'classic'
     flip_vertical: bool = False
     sort_by_mutation_number: bool = False
@@ -109,7 +149,15 @@ class SnipitConfig:
     show_indels: bool = False
     include_positions: Optional[str] = None
     exclude_positions: Optional[str] = None
+    mask_bed: Optional[str] = None
+    mask_vcf: Optional[str] = None
     ambig_mode: str = 'exclude'
+    min_site_count: int = 0
+    min_site_frequency: float = 0
+    
+    # Misc options
+    profile: bool = False
+    profile_trace: Optional[str] = None
     
     def to_args(self, alignment_file: str) -> List[str]:
         """Convert configuration to command-line arguments format."""
@@ -125,14 +173,20 @@ class SnipitConfig:
             args.extend(['--l-header', self.label_headers])
         if self.genbank:
             args.extend(['-g', self.genbank])
+        if self.region:
+            args.extend(['--region', self.region])
         
         # Mode options
         if self.recombi_mode:
             args.append('--recombi-mode')
         if self.recombi_references:
             args.extend(['--recombi-references', self.recombi_references])
+        if self.compare_references:
+            args.extend(['--compare-references', self.compare_references])
         if self.cds_mode:
             args.append('--cds-mode')
+        if self.colour_by_gene:
+            args.append('--colour-by-gene')
         
         # Output options
         if self.output_dir:
@@ -140,7 +194,13 @@ class SnipitConfig:
         args.extend(['-o', self.output_file])
         if self.write_snps:
             args.append('-s')
+        if self.write_vcf:
+            args.append('--write-vcf')
         args.extend(['-f', self.format])
+        if self.page_rows is not None:
+            args.extend(['--page-rows', str(self.page_rows)])
+        if self.processes > 1:
+            args.extend(['--processes', str(self.processes)])
         
         # Figure options
         if self.height > 0:
@@ -151,6 +211,14 @@ class SnipitConfig:
             args.extend(['--size-option', self.size_option])
         if self.solid_background:
             args.append('--solid-background')
+        if self.dpi:
+            args.extend(['--dpi', str(self.dpi)])
+        if self.native_svg:
+            args.append('--native-svg')
+        if self.preview:
+            args.append('--preview')
+        if self.all_labels:
+            args.append('--all-labels')
         args.extend(['-c', self.colour_palette])
         if self.flip_vertical:
             args.append('--flip-vertical')
@@ -168,8 +236,22 @@ class SnipitConfig:
             args.extend(['--include-positions', self.include_positions])
         if self.exclude_positions:
             args.extend(['--exclude-positions', self.exclude_positions])
+        if self.mask_bed:
+            args.extend(['--mask-bed', self.mask_bed])
+        if self.mask_vcf:
+            args.extend(['--mask-vcf', self.mask_vcf])
         if self.ambig_mode != 'exclude':
             args.extend(['--ambig-mode', self.ambig_mode])
+        if self.min_site_count > 1:
+            args.extend(['--min-site-count', str(self.min_site_count)])
+        if self.min_site_frequency > 0:
+            args.extend(['--min-site-frequency', str(self.min_site_frequency)])
+        
+        # Misc options
+        if self.profile:
+            args.append('--profile')
+        if self.profile_trace:
+            args.extend(['--profile-trace', self.profile_trace])
         
         return args
 
@@ -177,6 +259,7 @@ class SnipitConfig:
 def snipit_plot(
     alignment_file: Union[str, Path],
     config: Optional[SnipitConfig] = None,
+    use_cache: bool = True,
     **kwargs
 ) -> Dict[str, Any]:
     """
@@ -187,6 +270,8 @@ def snipit_plot(
     Args:
         alignment_file (str or Path): Path to the input alignment FASTA file
         config (SnipitConfig, optional): Configuration object with plot parameters
+        use_cache (bool): Reuse variants already called for this alignment file and
+            SNP options, see `clear_variant_cache`. Default: True
         **kwargs: Additional parameters that override config settings
         
     Returns:
@@ -238,25 +323,8 @@ def snipit_plot(
     
     try:
         # Run snipit command
-        result = command.main(args)
-        
-        # Determine output files
-        output_files = []
-        if config.output_dir:
-            output_dir = Path(config.output_dir)
-        else:
-            output_dir = alignment_path.parent
-            
-        # Main plot file
-        plot_file = output_dir / f"{config.output_file}.{config.format}"
-        if plot_file.exists():
-            output_files.append(str(plot_file))
-            
-        # SNP CSV file if requested
-        if config.write_snps:
-            snp_file = output_dir / f"{config.output_file}_snps.csv"
-            if snp_file.exists():
-                output_files.append(str(snp_file))
+        # the exact files written, so stale pages from earlier runs aren't reported
+        output_files = command.run(args, variant_cache=variant_cache if use_cache else None)
         
         return {
             'success': True,
@@ -275,6 +343,22 @@ def snipit_plot(
         }
 
 
+def clear_variant_cache(max_bytes: Optional[int] = None) -> None:
+    """
+    Empty the in-process cache of parsed variants used by `snipit_plot`.
+    
+    Args:
+        max_bytes (int, optional): New size limit for the cache in bytes
+        
+    Example:
+        >>> from snipit import clear_variant_cache
+        >>> clear_variant_cache(max_bytes=1024**3)  # start afresh with a 1 GB budget
+    """
+    variant_cache.clear()
+    if max_bytes is not None:
+        variant_cache.resize(max_bytes)
+
+
 def get_color_palettes() -> Dict[str, Dict[str, str]]:
     """
     Get information about available color palettes.
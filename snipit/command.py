@@ -15,40 +15,56 @@ from Bio import SeqIO
 from snipit import __version__
 from . import _program
 from snipit.scripts import snp_functions as sfunks
+from snipit.scripts import profiling
+from snipit.scripts import variant_cache as vcache
+from snipit.scripts import annotation
+from snipit.scripts import translation
+from snipit.scripts import vcf
+from snipit.scripts.positions import PositionFilter
 
 thisdir = os.path.abspath(os.path.dirname(__file__))
 cwd = os.getcwd()
 
 
-def main(sysargs = sys.argv[1:]):
+def run(sysargs = sys.argv[1:], variant_cache = None):
+    """Run snipit on the command-line arguments and return the paths of the files it wrote."""
 
     parser = argparse.ArgumentParser(prog = _program, 
     description='snipit', 
     usage='''snipit <alignment> [options]''')
 
     i_group = parser.add_argument_group('Input options')
-    i_group.add_argument('alignment',help="Input alignment fasta file")
+    i_group.add_argument('alignment',help="Input alignment fasta file, or a multi-sample VCF (.vcf, .vcf.gz) of genotypes against one reference")
     i_group.add_argument("-t","--sequence-type", choices=['nt','aa'], action="store",help="Input sequence type: aa or nt", default="nt", dest="sequence_type")
-    i_group.add_argument("-r","--reference", action="store",help="Indicates which sequence in the alignment is\nthe reference (by sequence ID).\nDefault: first sequence in alignment", dest="reference")
+    i_group.add_argument("-r","--reference", action="store",help="Indicates which sequence in the alignment is\nthe reference (by sequence ID). Use 'consensus' to compare against the majority consensus of the alignment.\nDefault: first sequence in alignment", dest="reference")
     i_group.add_argument("-l","--labels", action="store",help="Optional csv file of labels to show in output snipit plot. Default: sequence names", dest="labels")
     i_group.add_argument("--l-header", action="store",help="Comma separated string of column headers in label csv. First field indicates sequence name column, second the label column. Default: 'name,label'", dest="label_headers",default="name,label")
+    i_group.add_argument("--region", action="store",help="Only read VCF records in this region, as 'chrom', 'chrom:start' or 'chrom:start-end' (one-indexed). Uses a tabix index next to a bgzipped VCF if there is one.", dest="region")
     i_group.add_argument("-g","--genbank", action="store",help="Optional GenBank file for reference sequence to display gene annotations", dest="genbank")
 
     m_group = parser.add_argument_group('Mode options')
     m_group.add_argument("--recombi-mode",action='store_true',dest="recombi_mode",help="Allow colouring of query seqeunces by mutations present in two 'recombi-references' from the input alignment fasta file")
     m_group.add_argument("--recombi-references",action='store',type=str,dest="recombi_references",help="Specify two comma separated sequence IDs in the input alignment to use as 'recombi-references'. Ex. Sequence_ID_A,Sequence_ID_B")
-    m_group.add_argument("--cds-mode",action="store_true",help="Assumes sequence supplied is a coding sequence")
+    m_group.add_argument("--compare-references",action="store",dest="compare_references",help="Comma separated sequence IDs in the input alignment (or 'consensus') to compare every other sequence against, in one run. Writes one plot per reference, named <output-file>_<reference>. Ex. Sequence_ID_A,Sequence_ID_B")
+    m_group.add_argument("--cds-mode",action="store_true",help="Assumes sequence supplied is a coding sequence. Translates codons to call amino acid changes and marks synonymous (faded) and non-synonymous (outlined) SNPs.")
+    m_group.add_argument("--colour-by-gene",action="store_true",dest="colour_by_gene",help="Colour SNP cells by the gene they fall in (requires --genbank), matching the gene track colours.")
 
     o_group = parser.add_argument_group('Output options')
     o_group.add_argument('-d',"--output-dir",action="store",help="Output directory. Default: current working directory", dest="output_dir")
     o_group.add_argument('-o',"--output-file",action="store",help="Output file name stem. Default: snp_plot", default="snp_plot",dest="outfile")
     o_group.add_argument('-s',"--write-snps",action="store_true",help="Write out the SNPs in a csv file.",dest="write_snps")
-    o_group.add_argument("-f","--format",action="store",help="Format options (png, jpg, pdf, svg, tiff) Default: png",default="png")
+    o_group.add_argument("--write-vcf",action="store_true",help="Write out the variants as a multi-sample VCF, with a genotype column per sequence. Positions are in the ungapped reference sequence, not alignment columns.",dest="write_vcf")
+    o_group.add_argument("--page-rows",action="store",type=int,help=f"Split the plot into pages of at most this many sequences, sharing the site layout and reference tracks. Pages go into one pdf, or numbered files for other formats (e.g. snp_plot_page1.png). Default: pages of {sfunks.AUTO_PAGE_ROWS} once there are more sequences than that. Use 0 for a single page.",dest="page_rows",default=None)
+    o_group.add_argument("--processes",action="store",type=int,help="Number of processes to draw pages in parallel with. Pages of a pdf are always saved one after another. Default: 1",dest="processes",default=1)
+    o_group.add_argument("-f","--format",action="store",help="Format options (png, jpg, pdf, svg, tiff, html). Give several comma separated formats, e.g. png,svg,pdf, to save the one plot in each. html writes an interactive page of every sequence that opens offline in a browser. Default: png",default="png")
 
     f_group = parser.add_argument_group('Figure options')
     f_group.add_argument("--height",action="store",type=float,help="Overwrite the default figure height",default=0)
     f_group.add_argument("--width",action="store",type=float,help="Overwrite the default figure width",default=0)
     f_group.add_argument("--size-option",action="store",help="Specify options for sizing. Options: expand, scale",dest="size_option",default="scale")
+    f_group.add_argument("--dpi",action="store",type=int,help=f"Resolution of the saved figure in dots per inch. Default: {sfunks.DEFAULT_DPI}, or {sfunks.PREVIEW_DPI} with --preview",dest="dpi",default=None)
+    f_group.add_argument("--native-svg",action="store_true",help="Write svg output with snipit's own svg writer rather than matplotlib: much smaller files, written much faster, with cells as rounded rectangles styled by shared css classes. The figure is sized by the number of sites and sequences, so --width, --height, --size-option and --dpi do not apply.",dest="native_svg")
+    f_group.add_argument("--preview",action="store_true",help="Fast, low resolution preview: plain rectangles, no text shadows or label boxes.",dest="preview")
     f_group.add_argument("--solid-background",action="store_true",help="Force the plot to have a solid background, rather than a transparent one.",dest="solid_background")
     f_group.add_argument("-c","--colour-palette",dest="colour_palette",action="store",
                          help="Specify colour palette. Options: [classic, classic_extended, nature, nature_extended, morandi, morandi_extended, vangogh, vangogh_extended, monet, monet_extended, matisse, matisse_extended, primary, purine-pyrimidine, greyscale, wes, verity, ugene, nature_aa, morandi_aa, vangogh_aa, monet_aa, matisse_aa]. Use _aa versions for protein alignments.",default="classic",
@@ -64,17 +80,24 @@ def main(sysargs = sys.argv[1:]):
                         help="If sorted by mutation number is selected, show the sequences with the fewest SNPs closest to the reference. Default: False",
                         dest="high_to_low")
     f_group.add_argument("--remove-site-text",action='store_true',help="Do not annotate text on the individual columns in the figure.",dest="remove_site_text")
+    f_group.add_argument("--all-labels",action='store_false',help="Draw every cell letter, position and sequence label, even where cells are too small to read them. By default letters are left off small cells and crowded labels are thinned out.",dest="cull_labels")
 
     s_group = parser.add_argument_group('SNP options')
     s_group.add_argument("--show-indels",action='store_true',help="Include insertion and deletion mutations in snipit plot.",dest="show_indels")
-    s_group.add_argument('--include-positions', dest='included_positions', type=sfunks.bp_range, nargs='+', default=None, help="One or more range (closed, inclusive; one-indexed) or specific position only included in the output. Ex. '100-150' or Ex. '100 101' Considered before '--exclude-positions'.")
-    s_group.add_argument('--exclude-positions', dest='excluded_positions', type=sfunks.bp_range, nargs='+', default=None, help="One or more range (closed, inclusive; one-indexed) or specific position to exclude in the output. Ex. '100-150' or Ex. '100 101' Considered after '--include-positions'.")
+    s_group.add_argument('--include-positions', dest='included_positions', type=sfunks.bp_range, nargs='+', default=None, help="One or more range (closed, inclusive; one-indexed) or specific position only included in the output. Ex. '100-150' or Ex. '100 101' Considered before '--exclude-positions'. Positions outside these are never compared.")
+    s_group.add_argument('--exclude-positions', dest='excluded_positions', type=sfunks.bp_range, nargs='+', default=None, help="One or more range (closed, inclusive; one-indexed) or specific position to exclude in the output. Ex. '100-150' or Ex. '100 101' Considered after '--include-positions'. Excluded positions are never compared, e.g. to mask primer sites.")
+    s_group.add_argument("--mask-bed", dest="mask_bed", nargs='+', default=None, help="One or more BED files of regions to mask, in reference coordinates, mapped onto the alignment through the reference and otherwise treated like --exclude-positions. May be gzip/bgzip compressed.")
+    s_group.add_argument("--mask-vcf", dest="mask_vcf", nargs='+', default=None, help="One or more VCF files of sites to mask, in reference coordinates, e.g. the SARS-CoV-2 problematic sites VCF. Records filtered as 'caution' are not masked. May be gzip/bgzip compressed.")
+    s_group.add_argument("--min-site-count", dest="min_site_count", type=int, default=0, help="Only show sites where at least this many sequences carry a variant. Default: show every site")
+    s_group.add_argument("--min-site-frequency", dest="min_site_frequency", type=sfunks.frequency, default=0, help="Only show sites where at least this fraction (0-1) of sequences carry a variant. Default: show every site")
     s_group.add_argument("--ambig-mode", dest="ambig_mode",choices=['all', 'snps', 'exclude'], default='snpsambi',
                          help=textwrap.dedent('''Controls how ambiguous bases are handled -
                         [all] include all ambig such as N,Y,B in all positions;
                         [snps] only include ambig if a snp is present at the same position;
                         [exclude] remove all ambig, same as depreciated --exclude-ambig-pos'''))
     misc_group = parser.add_argument_group('Misc options')
+    misc_group.add_argument("--profile",action="store_true",help="Print wall time, CPU time and peak memory for each stage of the run.",dest="profile")
+    misc_group.add_argument("--profile-trace",action="store",help="Write a Chrome trace JSON file of the profiled stages (implies --profile).",dest="profile_trace")
     misc_group.add_argument("-v","--version", action='version', version=f"snipit {__version__}")
 
     if len(sysargs)<1:
@@ -83,18 +106,66 @@ def main(sysargs = sys.argv[1:]):
     else:
         args = parser.parse_args(sysargs)
 
-    num_seqs,ref_input,record_ids,length = sfunks.qc_alignment(args.alignment,args.reference,args.cds_mode,args.sequence_type,cwd)
-        
-    
-    if args.reference:
-        ref_file,ref_input = sfunks.reference_qc(args.reference, record_ids,cwd)
+    profiler = profiling.StageProfiler() if (args.profile or args.profile_trace) else None
+
+    vcf_input = vcf.is_vcf(args.alignment)
+    if args.region and not vcf_input:
+        sys.stderr.write(sfunks.red(f"Error: `--region` can only be used with VCF input\n"))
+        sys.exit(-1)
+
+    # include/exclude positions and masks are applied while calling snps, so masked regions are never compared
+    masked = sfunks.load_masks(args.mask_bed, args.mask_vcf, cwd)
+    positions = PositionFilter(args.included_positions, args.excluded_positions, masked)
+
+    # parsed variants only depend on the alignment and the snp calling options,
+    # so callers that plot the same alignment repeatedly can skip straight to rendering
+    cache_key = None
+    variants = None
+    if variant_cache is not None and not args.compare_references:
+        cache_key = vcache.variant_cache_key(args.alignment, cwd,
+                                             input_files=(args.reference, args.genbank),
+                                             reference=args.reference,
+                                             genbank=args.genbank,
+                                             sequence_type=args.sequence_type,
+                                             cds_mode=args.cds_mode,
+                                             show_indels=args.show_indels,
+                                             ambig_mode=args.ambig_mode,
+                                             positions=positions.key(),
+                                             region=args.region)
+        variants = variant_cache.get(cache_key)
+
+    if variants is None and vcf_input:
+        # genotypes are already called against the VCF's reference, so there's no alignment to parse
+        with profiling.stage(profiler, "parse_vcf"):
+            variants = sfunks.read_vcf(args.alignment,args.region,args.reference,args.genbank,args.cds_mode,args.sequence_type,
+                                       args.compare_references,args.show_indels,args.ambig_mode,positions,cwd)
+        if variant_cache is not None:
+            variant_cache.put(cache_key, variants)
+
+    if variants is None:
+        with profiling.stage(profiler, "qc_alignment"):
+            num_seqs,ref_input,record_ids,length = sfunks.qc_alignment(args.alignment,args.reference,args.cds_mode,args.sequence_type,cwd)
+
+        if args.reference:
+            with profiling.stage(profiler, "reference_qc"):
+                ref_file,ref_input = sfunks.reference_qc(args.reference, record_ids,cwd)
     else:
+        num_seqs = variants["num_seqs"]
+        ref_input = variants["ref_input"]
+        record_ids = variants["record_ids"]
+        length = variants["length"]
+
+    reference_ids = None
+    if args.compare_references:
+        reference_ids = sfunks.compare_references_qc(args.compare_references, args.reference, record_ids)
+    elif not args.reference and not vcf_input:
         sfunks.check_ref(args.recombi_mode)
 
     if args.recombi_mode:
         
         if args.recombi_references:
-            sfunks.recombi_qc(args.recombi_references, args.reference, record_ids,cwd)
+            for reference_id in (reference_ids or [args.reference]):
+                sfunks.recombi_qc(args.recombi_references, reference_id, record_ids,cwd)
         else:
             sfunks.recombi_ref_missing()
 
@@ -105,55 +176,215 @@ def main(sysargs = sys.argv[1:]):
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
 
-    output = os.path.join(output_dir,f"{args.outfile}.{args.format}")
-    
     label_map = sfunks.label_map(record_ids,args.labels,args.label_headers,cwd)
 
-    reference,alignment = sfunks.get_ref_and_alignment(args.alignment,ref_input,label_map)
+    if reference_ids:
+        comparisons = compare_references(args, reference_ids, label_map, positions, profiler)
+    elif variants is None:
+        with profiling.stage(profiler, "parse_alignment"):
+            reference,alignment = sfunks.get_ref_and_alignment(args.alignment,ref_input,label_map,args.sequence_type)
 
-    snp_dict,record_snps,num_snps = sfunks.find_snps(reference,alignment,args.show_indels,args.sequence_type,args.ambig_mode)
+        with profiling.stage(profiler, "find_snps"):
+            called = sfunks.find_snps(reference,alignment,args.show_indels,args.sequence_type,args.ambig_mode,positions)
 
-    record_ambs = sfunks.find_ambiguities(alignment, snp_dict, args.sequence_type)
+        record_aa_snps = None
+        record_synonymous = None
+        if args.cds_mode and args.sequence_type == "nt":
+            with profiling.stage(profiler, "translate_cds"):
+                record_aa_snps,record_synonymous = translation.find_aa_changes(reference, alignment, called)
+
+        if variant_cache is not None:
+            variant_cache.put(cache_key, {"num_seqs": num_seqs,
+                                          "ref_input": ref_input,
+                                          "reference": reference,
+                                          "record_ids": record_ids,
+                                          "length": length,
+                                          "variants": called,
+                                          "record_aa_snps": record_aa_snps,
+                                          "record_synonymous": record_synonymous})
+        comparisons = [comparison(None, reference, label_map, called, record_aa_snps, record_synonymous)]
+    else:
+        sfunks.set_reference_label(label_map, ref_input)
+        comparisons = [comparison(None, variants["reference"], label_map, variants["variants"],
+                                  variants["record_aa_snps"], variants["record_synonymous"])]
 
     colours = sfunks.get_colours(args.colour_palette)
 
-    sfunks.check_format(args.format)
+    formats = sfunks.check_format(args.format)
     sfunks.check_size_option(args.size_option)
+    if args.page_rows is not None and args.page_rows < 0:
+        sys.stderr.write(sfunks.red(f"Error: `--page-rows` must be 0 or more\n"))
+        sys.exit(-1)
+    if args.dpi is not None and args.dpi < 1:
+        sys.stderr.write(sfunks.red(f"Error: `--dpi` must be 1 or more\n"))
+        sys.exit(-1)
+    dpi = args.dpi or (sfunks.PREVIEW_DPI if args.preview else sfunks.DEFAULT_DPI)
+    if args.processes < 1:
+        sys.stderr.write(sfunks.red(f"Error: `--processes` must be 1 or more\n"))
+        sys.exit(-1)
 
-    sfunks.write_out_snps(args.write_snps,record_snps,output_dir)
-    
     # Parse GenBank file if provided
     gene_features = None
+    gene_index = None
     if args.genbank:
-        gene_features = sfunks.parse_genbank(args.genbank, cwd, args.sequence_type)
-
-    sfunks.make_graph(num_seqs,
-                        num_snps,
-                        record_ambs,
-                        record_snps,
-                        output,
-                        label_map,
-                        colours,
-                        length,
-                        args.width,
-                        args.height,
-                        args.size_option,
-                        args.solid_background,
-                        args.remove_site_text,
-                        args.ambig_mode,
-                        args.flip_vertical,
-                        args.included_positions,
-                        args.excluded_positions,
-                      args.sort_by_mutation_number,
-                      args.high_to_low,
-                      args.sort_by_id,
-                      args.sort_by_mutations,
-                      args.recombi_mode,
-                      args.recombi_references,
-                      gene_features,
-                      args.colour_palette,
-                      args.sequence_type)
-    print(sfunks.green(f"Snipping Complete: {output}"))
+        with profiling.stage(profiler, "parse_genbank"):
+            gene_features = sfunks.parse_genbank(args.genbank, cwd, args.sequence_type)
+
+        # genome coordinates only line up with the annotations for nucleotide alignments,
+        # and the annotations are only written out to snps.csv
+        if gene_features and args.sequence_type == "nt" and args.write_snps:
+            gene_index = annotation.FeatureIndex(gene_features)
+    elif args.colour_by_gene:
+        sys.stderr.write(sfunks.red(f"Error: --colour-by-gene requires a --genbank file\n"))
+        sys.exit(-1)
+
+    stems = sfunks.file_stems([result["reference_id"] for result in comparisons if result["reference_id"] is not None])
+    written_files = []
+    for result in comparisons:
+        if result["reference_id"] is None:
+            output = [os.path.join(output_dir,f"{args.outfile}.{fmt}") for fmt in formats]
+            snp_file = "snps.csv"
+            frequency_file = "site_frequencies.csv"
+            vcf_file = "snps.vcf"
+        else:
+            stem = stems[result["reference_id"]]
+            output = [os.path.join(output_dir,f"{args.outfile}_{stem}.{fmt}") for fmt in formats]
+            snp_file = f"snps_{stem}.csv"
+            frequency_file = f"site_frequencies_{stem}.csv"
+            vcf_file = f"snps_{stem}.vcf"
+
+        # one sparse record-by-site matrix is read by everything from here on
+        variants = result["variants"]
+
+        filter_sites = args.min_site_count > 1 or args.min_site_frequency > 0
+        if args.write_snps or filter_sites:
+            with profiling.stage(profiler, "site_frequencies"):
+                if args.write_snps:
+                    site_counts,variant_counts = sfunks.site_frequencies(variants)
+                    sfunks.write_site_frequencies(site_counts,variant_counts,len(variants),output_dir,frequency_file)
+                    written_files.append(os.path.join(output_dir,frequency_file))
+                if filter_sites:
+                    # rare sites are dropped before plotting, leaving the cached variants untouched
+                    variants = sfunks.filter_sites(variants,args.min_site_count,args.min_site_frequency)
+
+        if args.write_snps:
+            variant_annotations = None
+            if gene_index is not None:
+                with profiling.stage(profiler, "annotate_variants"):
+                    variant_annotations = annotation.annotate_variants(variants.distinct_variants(), gene_index, result["reference"])
+
+            with profiling.stage(profiler, "write_snps"):
+                sfunks.write_out_snps(args.write_snps,variants,output_dir,variant_annotations,result["record_aa_snps"],snp_file)
+            written_files.append(os.path.join(output_dir,snp_file))
+
+        if args.write_vcf:
+            with profiling.stage(profiler, "write_vcf"):
+                sfunks.write_out_vcf(variants,output_dir,vcf_file,vcf_chrom(args,result,ref_input),result["reference"],length,args.sequence_type)
+            written_files.append(os.path.join(output_dir,vcf_file))
+
+        with profiling.stage(profiler, "make_graph"):
+            outputs = sfunks.make_graph(num_seqs,
+                                variants.num_snps,
+                                None,
+                                variants,
+                                output,
+                                result["label_map"],
+                                colours,
+                                length,
+                                args.width,
+                                args.height,
+                                args.size_option,
+                                args.solid_background,
+                                args.remove_site_text,
+                                args.ambig_mode,
+                                args.flip_vertical,
+                                args.included_positions,
+                                args.excluded_positions,
+                              args.sort_by_mutation_number,
+                              args.high_to_low,
+                              args.sort_by_id,
+                              args.sort_by_mutations,
+                              args.recombi_mode,
+                              args.recombi_references,
+                              gene_features,
+                              args.colour_palette,
+                              args.sequence_type,
+                              profiler,
+                              args.colour_by_gene,
+                              result["record_synonymous"],
+                              args.page_rows,
+                              args.processes,
+                              dpi,
+                              args.preview,
+                              args.cull_labels,
+                              args.native_svg)
+        for written in outputs:
+            print(sfunks.green(f"Snipping Complete: {written}"))
+        written_files.extend(outputs)
+
+    if profiler is not None:
+        print(profiler.summary())
+        if args.profile_trace:
+            trace_file = os.path.join(cwd, args.profile_trace)
+            profiler.write_trace(trace_file)
+            print(sfunks.green(f"Profile trace written: {trace_file}"))
+
+    return written_files
+
+
+def main(sysargs = sys.argv[1:], variant_cache = None):
+    # console scripts exit with main's return value, so the written files are left to run()
+    run(sysargs, variant_cache)
+
+
+def comparison(reference_id, reference, label_map, variants,
+               record_aa_snps=None, record_synonymous=None):
+    """Everything needed to plot and write out the alignment against one reference."""
+    return {"reference_id": reference_id,
+            "reference": reference,
+            "label_map": label_map,
+            "variants": variants,
+            "record_aa_snps": record_aa_snps,
+            "record_synonymous": record_synonymous}
+
+
+def vcf_chrom(args, result, ref_input):
+    """CHROM for written VCFs: the reference's sequence id, or the genbank file name if that's the reference."""
+    if result["reference_id"] is not None:
+        return result["reference_id"]
+    if args.reference and args.reference.split(".")[-1] in ["gb","genbank"]:
+        return os.path.splitext(os.path.basename(args.reference))[0]
+    return ref_input
+
+
+def compare_references(args, reference_ids, label_map, positions=None, profiler=None):
+    """
+    Parse and dedup the alignment once, then call variants against every reference
+    in a single pass rather than rerunning snipit for each of them.
+    Returns one comparison per reference, in the order given.
+    """
+    with profiling.stage(profiler, "parse_alignment"):
+        references,alignment = sfunks.get_references_and_alignment(args.alignment, reference_ids, args.sequence_type)
+
+    with profiling.stage(profiler, "find_snps"):
+        reference_variants = sfunks.find_snps_multi(references,alignment,args.show_indels,args.sequence_type,args.ambig_mode,positions)
+
+    comparisons = []
+    for reference_id in reference_ids:
+        called = reference_variants[reference_id]
+        query_alignment = sfunks.alignment_without(alignment, reference_id)
+
+        record_aa_snps = None
+        record_synonymous = None
+        if args.cds_mode and args.sequence_type == "nt":
+            with profiling.stage(profiler, "translate_cds"):
+                record_aa_snps,record_synonymous = translation.find_aa_changes(references[reference_id], query_alignment, called)
+
+        reference_labels = dict(label_map)
+        sfunks.set_reference_label(reference_labels, reference_id)
+        comparisons.append(comparison(reference_id, references[reference_id], reference_labels,
+                                      called, record_aa_snps, record_synonymous))
+    return comparisons
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+from bisect import bisect_right
+
+# imports from other modules
+from Bio.Data import CodonTable
+
+STANDARD_CODONS = CodonTable.unambiguous_dna_by_id[1].forward_table
+STOP_CODONS = set(CodonTable.unambiguous_dna_by_id[1].stop_codons)
+COMPLEMENT = str.maketrans("ACGTRYKMBDHVN", "TGCAYRMKVHDBN")
+
+
+def translate_codon(codon):
+    """Translate one upper case DNA codon with the standard code. Stops are '*', anything ambiguous is 'X'."""
+    if codon in STOP_CODONS:
+        return "*"
+    return STANDARD_CODONS.get(codon.replace("U", "T"), "X")
+
+
+class FeatureIndex:
+    """
+    Nested containment list over gene features for position lookups.
+
+    Features are split into lists in which none contains another, so along each list
+    both starts and ends increase and a binary search finds the first feature that can
+    cover a position. A feature's sublist holds the features it contains and is only
+    searched when that feature is a hit. A lookup with k hits therefore costs at most
+    O((k + 1) log n), however long or deeply nested the features are (a polyprotein or a
+    source-length gene doesn't make later lookups walk over everything before them).
+    """
+
+    def __init__(self, features):
+        self.features = sorted(features, key=lambda feature: (feature["start"], feature["end"]))
+        # containers go before the features they contain
+        order = sorted(range(len(self.features)),
+                       key=lambda i: (self.features[i]["start"], -self.features[i]["end"]))
+        top = []
+        sublists = {}
+        open_features = []
+        for i in order:
+            end = self.features[i]["end"]
+            while open_features and self.features[open_features[-1]]["end"] < end:
+                open_features.pop()
+            if open_features:
+                sublists.setdefault(open_features[-1], []).append(i)
+            else:
+                top.append(i)
+            open_features.append(i)
+        self._top = self._pack(top, sublists)
+
+    def _pack(self, members, sublists):
+        """(starts, ends, feature indices, sublists) for one containment list."""
+        return ([self.features[i]["start"] for i in members],
+                [self.features[i]["end"] for i in members],
+                members,
+                [self._pack(sublists[i], sublists) if i in sublists else None for i in members])
+
+    def overlapping(self, position):
+        """All features covering a 0-based position, in start order."""
+        hits = []
+        pending = [self._top]
+        while pending:
+            starts, ends, members, sublists = pending.pop()
+            # the first feature ending after the position, those before it end too early
+            j = bisect_right(ends, position)
+            while j < len(members) and starts[j] <= position:
+                feature = self.features[members[j]]
+                if in_parts(feature, position):
+                    hits.append(members[j])
+                # features nested in a spliced one can sit in its introns, so look regardless
+                if sublists[j] is not None:
+                    pending.append(sublists[j])
+                j += 1
+        return [self.features[i] for i in sorted(hits)]
+
+    def gene_at(self, position):
+        """Name of the first feature covering a 0-based position, or None if it's intergenic."""
+        hits = self.overlapping(position)
+        return hits[0]["name"] if hits else None
+
+    def __len__(self):
+        return len(self.features)
+
+
+def in_parts(feature, position):
+    parts = feature.get("parts")
+    if not parts or len(parts) == 1:
+        return True
+    return any(start <= position < end for start, end in parts)
+
+
+def transcript_offset(feature, position):
+    """0-based offset of a genome position within a feature's spliced transcript, or None."""
+    parts = feature.get("parts") or [[feature["start"], feature["end"]]]
+    offset = 0
+    for start, end in parts:
+        if start <= position < end:
+            if feature["strand"] == -1:
+                return offset + (end - 1 - position)
+            return offset + (position - start)
+        offset += end - start
+    return None
+
+
+def genome_position(feature, offset):
+    """Inverse of transcript_offset."""
+    parts = feature.get("parts") or [[feature["start"], feature["end"]]]
+    for start, end in parts:
+        if offset < end - start:
+            if feature["strand"] == -1:
+                return end - 1 - offset
+            return start + offset
+        offset -= end - start
+    return None
+
+
+def codon_change(feature, position, alt_base, reference_seq):
+    """
+    Effect of substituting alt_base at a 0-based genome position inside a CDS.
+
+    Returns (codon_number, codon_position, ref_aa, alt_aa), with 1-based codon
+    number and position, or None if the codon runs off the end of the feature.
+    """
+    offset = transcript_offset(feature, position)
+    if offset is None:
+        return None
+    codon_start = offset - offset % 3
+    codon_positions = [genome_position(feature, codon_start + i) for i in range(3)]
+    if None in codon_positions or max(codon_positions) >= len(reference_seq):
+        return None
+
+    ref_codon = "".join(reference_seq[i] for i in codon_positions)
+    alt_codon = "".join(alt_base if i == position else reference_seq[i] for i in codon_positions)
+    if feature["strand"] == -1:
+        ref_codon = ref_codon.translate(COMPLEMENT)
+        alt_codon = alt_codon.translate(COMPLEMENT)
+
+    return offset // 3 + 1, offset % 3 + 1, translate_codon(ref_codon), translate_codon(alt_codon)
+
+
+def annotate_variant(variant, index, reference_seq):
+    """
+    Annotate one snipit variant string (e.g. '23403:AG') with the gene it falls in.
+
+    Returns a dict with gene, codon, codon_position, consequence (e.g. 'D614G')
+    and synonymous, or None for intergenic variants. Only substitutions inside CDS
+    features get codon and amino acid details; indels and other feature types
+    just get the gene name.
+    """
+    pos, var = variant.split(":")
+    position = int(pos) - 1
+    hits = index.overlapping(position)
+    if not hits:
+        return None
+
+    annotation = {"gene": hits[0]["name"],
+                  "codon": None,
+                  "codon_position": None,
+                  "consequence": None,
+                  "synonymous": None}
+
+    if var.startswith("ins") or var.startswith("del") or len(var) != 2:
+        return annotation
+
+    for feature in hits:
+        if feature["type"] != "CDS":
+            continue
+        change = codon_change(feature, position, var[1], reference_seq)
+        if change is None:
+            continue
+        codon, codon_position, ref_aa, alt_aa = change
+        annotation.update({"gene": feature["name"],
+                           "codon": codon,
+                           "codon_position": codon_position,
+                           "consequence": f"{ref_aa}{codon}{alt_aa}",
+                           "synonymous": ref_aa == alt_aa})
+        break
+
+    return annotation
+
+
+def annotate_variants(variants, index, reference_seq):
+    """
+    Annotate every distinct variant called across all records.
+
+    Takes the distinct variant strings (see VariantMatrix.distinct_variants), as
+    variants are shared between records and each one only needs looking up once.
+    Returns a dict of variant string to annotation (None when intergenic).
+    """
+    reference_seq = str(reference_seq).upper()
+    annotations = {}
+    for variant in variants:
+        if variant not in annotations:
+            annotations[variant] = annotate_variant(variant, index, reference_seq)
+    return annotations
+
+
+def format_annotation(annotation):
+    """Short text form of an annotation for csv output, e.g. 'S:D614G' or 'ORF1ab'."""
+    if annotation is None:
+        return ""
+    if annotation["consequence"]:
+        return f"{annotation['gene']}:{annotation['consequence']}"
+    return annotation["gene"]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import os
+import re
+import json
+import hashlib
+import threading
+
+FEATURE_TYPES = ["gene", "CDS", "rRNA", "tRNA", "ncRNA", "regulatory"]
+NAME_QUALIFIERS = ["gene", "locus_tag", "product"]
+
+# bump when the layout of the cached feature table changes so stale sidecars are ignored
+FEATURE_TABLE_VERSION = 1
+
+# genbank flat file layout: feature keys start at column 6, locations and qualifiers at column 22
+FEATURE_KEY_INDENT = 5
+QUALIFIER_INDENT = 21
+
+LOCATION_PART = re.compile(r"(?<![\w.:])(\d+)(?:\.\.(\d+)|\^(\d+))?(?![\w.:])")
+
+# tables already loaded in this process, keyed by path, mtime and size
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def parse_location(location):
+    """
+    Convert a genbank location string into 0-based, half-open (start, end) parts in
+    transcription order, plus the strand.
+    Parts on other records (e.g. 'J00194.1:100..202') are ignored.
+    """
+    location = location.replace("<", "").replace(">", "")
+    strand = -1 if "complement(" in location else 1
+
+    parts = []
+    for start, end, between in LOCATION_PART.findall(location):
+        start = int(start)
+        # single bases and sites between two bases (e.g. 123^124) both cover just the first base
+        end = int(end) if end else start
+        parts.append((start - 1, end))
+
+    # complement(join(a,b)) reads b then a on the minus strand
+    if location.startswith("complement(join(") or location.startswith("complement(order("):
+        parts.reverse()
+    return parts, strand
+
+
+def _feature_name(feature_type, qualifiers):
+    if "gene" in qualifiers:
+        return qualifiers["gene"]
+    elif "locus_tag" in qualifiers:
+        return qualifiers["locus_tag"]
+    elif "product" in qualifiers:
+        # Truncate long product names
+        return qualifiers["product"][:20]
+    return feature_type
+
+
+def _finish_feature(current, features):
+    if current is None or current["type"] not in FEATURE_TYPES:
+        return
+    parts, strand = parse_location(current["location"])
+    if not parts:
+        return
+    features.append({"start": min(part[0] for part in parts),
+                     "end": max(part[1] for part in parts),
+                     "strand": strand,
+                     "type": current["type"],
+                     "name": _feature_name(current["type"], current["qualifiers"]),
+                     "parts": [list(part) for part in parts]})
+
+
+def parse_feature_table(genbank_file, with_sequence=False):
+    """
+    Read gene/CDS coordinates straight from the FEATURES section of a genbank file,
+    without building SeqRecords or parsing the full annotation.
+
+    Only features of the first record are returned (as snipit only draws the reference),
+    but every LOCUS line is counted so callers can reject multi-record files.
+    The sequence is only read from the ORIGIN block when with_sequence is set.
+
+    Returns a dict with keys: records, length, features and sequence.
+    """
+    records = 0
+    length = None
+    features = []
+    sequence = []
+
+    current = None
+    qualifier = None
+    in_features = False
+    in_origin = False
+
+    with open(genbank_file, "r") as f:
+        for line in f:
+            if line.startswith("LOCUS"):
+                records += 1
+                if records == 1:
+                    fields = line.split()
+                    if len(fields) > 2 and fields[2].isdigit():
+                        length = int(fields[2])
+                continue
+            if records != 1:
+                # only the first record is ever used, the rest just need counting
+                continue
+
+            if in_origin:
+                if line.startswith("//"):
+                    in_origin = False
+                elif with_sequence:
+                    sequence.append("".join(line.split()[1:]))
+                continue
+
+            if line.startswith("FEATURES"):
+                in_features = True
+                continue
+            if not in_features:
+                continue
+
+            if not line.startswith(" "):
+                # end of the feature table, e.g. ORIGIN, CONTIG or //
+                _finish_feature(current, features)
+                current = None
+                in_features = False
+                in_origin = line.startswith("ORIGIN")
+                continue
+
+            key = line[FEATURE_KEY_INDENT:QUALIFIER_INDENT].strip()
+            value = line[QUALIFIER_INDENT:].rstrip("\n").strip()
+            if key:
+                _finish_feature(current, features)
+                current = {"type": key, "location": value, "qualifiers": {}}
+                qualifier = None
+            elif current is None:
+                continue
+            elif value.startswith("/"):
+                name, _, qualifier_value = value[1:].partition("=")
+                if name in NAME_QUALIFIERS and name not in current["qualifiers"]:
+                    qualifier = name
+                    current["qualifiers"][name] = qualifier_value.strip('"')
+                else:
+                    qualifier = None
+            elif qualifier is not None:
+                # continuation of a multi-line qualifier
+                current["qualifiers"][qualifier] = (current["qualifiers"][qualifier] + " " + value.strip('"')).strip()
+            elif not current["qualifiers"]:
+                # continuation of a long location
+                current["location"] += value
+
+    _finish_feature(current, features)
+
+    return {"records": records,
+            "length": length,
+            "features": features,
+            "sequence": "".join(sequence).upper() if with_sequence else None}
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def sidecar_path(genbank_file):
+    directory, basename = os.path.split(os.path.abspath(genbank_file))
+    return os.path.join(directory, f".{basename}.snipit-features.json")
+
+
+def _read_sidecar(path, sha1):
+    try:
+        with open(path, "r") as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if table.get("version") != FEATURE_TABLE_VERSION or table.get("sha1") != sha1:
+        return None
+    return table
+
+
+def _write_sidecar(path, table):
+    cached = {key: value for key, value in table.items() if key != "sequence"}
+    try:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fw:
+            json.dump(cached, fw, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError:
+        # read-only data directories just don't get a cache
+        pass
+
+
+def load_feature_table(genbank_file, with_sequence=False):
+    """
+    Load the compact feature table for a genbank file, shared by everything that needs
+    the reference annotations in a run.
+
+    Tables are memoised in-process by path, mtime and size, and persisted to a hidden
+    sidecar file next to the genbank file keyed by its SHA-1, so repeat runs skip parsing.
+    The reference sequence is never stored in the sidecar, and is read from the file
+    only when with_sequence is set.
+    """
+    genbank_file = os.path.abspath(genbank_file)
+    stat = os.stat(genbank_file)
+    memo_key = (genbank_file, stat.st_mtime_ns, stat.st_size)
+
+    with _loaded_lock:
+        table = _loaded.get(memo_key)
+    if table is not None and (table["sequence"] is not None or not with_sequence):
+        return table
+
+    if with_sequence:
+        # the sequence has to come from the file itself, so parse everything at once
+        table = parse_feature_table(genbank_file, with_sequence=True)
+        table["sha1"] = file_sha1(genbank_file)
+        table["version"] = FEATURE_TABLE_VERSION
+        if _read_sidecar(sidecar_path(genbank_file), table["sha1"]) is None:
+            _write_sidecar(sidecar_path(genbank_file), table)
+    else:
+        sha1 = file_sha1(genbank_file)
+        table = _read_sidecar(sidecar_path(genbank_file), sha1)
+        if table is None:
+            table = parse_feature_table(genbank_file)
+            table["sha1"] = sha1
+            table["version"] = FEATURE_TABLE_VERSION
+            _write_sidecar(sidecar_path(genbank_file), table)
+        table["sequence"] = None
+
+    with _loaded_lock:
+        _loaded[memo_key] = table
+    return table
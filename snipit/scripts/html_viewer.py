@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import io
+import json
+import gzip
+import base64
+import html
+
+# imports from other modules
+import numpy as np
+
+# imports from this module
+from snipit.scripts.variant_matrix import display_alleles
+
+# javascript typed array for each numpy dtype stored in the payload
+TYPED_ARRAYS = {"int32": "Int32Array", "uint32": "Uint32Array", "uint16": "Uint16Array", "uint8": "Uint8Array"}
+
+
+def pack_payload(meta, arrays):
+    """
+    Pack the viewer's data into one gzip'd, base64 encoded block: the metadata as json,
+    followed by each array as little-endian bytes aligned to 8 bytes, so the viewer can
+    wrap them in typed arrays without copying. Returns the block and where each part sits.
+    """
+    body = io.BytesIO()
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    body.write(meta_bytes)
+    layout = {"meta": len(meta_bytes), "arrays": {}}
+    for name, array in arrays.items():
+        body.write(b"\0" * (-body.tell() % 8))
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+        layout["arrays"][name] = [TYPED_ARRAYS[array.dtype.name], body.tell(), len(array)]
+        body.write(array.tobytes())
+    return base64.b64encode(gzip.compress(body.getvalue(), mtime=0)).decode("ascii"), layout
+
+
+def write_html(variants, output_file, labels, reference_label, palette, entry_colours, site_refs,
+               ref_vars, length, genes=None, title="snipit"):
+    """
+    Write a VariantMatrix as a self-contained, interactive html page.
+
+    labels are the display names of the matrix's records, in order, and entry_colours an
+    index into palette (hex colours) for every stored entry. genes are (name, start, end,
+    colour) tuples for the genome track. The matrix is embedded as compressed typed arrays
+    and drawn on a canvas a window at a time, so the page opens offline and stays
+    responsive however many records there are.
+    """
+    meta = {"records": labels,
+            "reference": reference_label,
+            "variants": variants.variants,
+            "alleles": [display_alleles(variant)[1] for variant in variants.variants],
+            "site_refs": site_refs,
+            "ref_vars": ref_vars,
+            "palette": palette,
+            "genes": genes or [],
+            "length": length}
+    arrays = {"sites": variants.sites.astype(np.int32),
+              "indptr": variants.indptr.astype(np.uint32),
+              "columns": variants.columns.astype(np.uint32),
+              "codes": variants.codes.astype(np.uint32),
+              "flags": variants.flags.astype(np.uint8),
+              "colours": np.asarray(entry_colours, dtype=np.uint16)}
+    payload, layout = pack_payload(meta, arrays)
+
+    page = (VIEWER_TEMPLATE.replace("__TITLE__", html.escape(title))
+                           .replace("__LAYOUT__", json.dumps(layout))
+                           .replace("__PAYLOAD__", payload))
+    with open(output_file, "w", encoding="utf-8") as fw:
+        fw.write(page)
+
+
+VIEWER_TEMPLATE = r"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<style>
+html, body { margin: 0; height: 100%; overflow: hidden; font-family: "DejaVu Sans", Helvetica, Arial, sans-serif; color: #1F2937; background: #fff; }
+#bar { height: 32px; display: flex; align-items: center; gap: 16px; padding: 0 12px; border-bottom: 1px solid #E5E7EB; font-size: 13px; }
+#bar b { font-size: 14px; }
+#bar .hint { color: #6B7280; margin-left: auto; }
+#view { position: absolute; top: 33px; left: 0; right: 0; bottom: 0; }
+canvas { display: block; width: 100%; height: 100%; cursor: grab; }
+canvas.drag { cursor: grabbing; }
+#tip { position: fixed; pointer-events: none; background: #1F2937; color: #fff; font-size: 12px; padding: 6px 8px; border-radius: 4px; display: none; white-space: pre; line-height: 1.4; }
+#msg { padding: 24px; color: #DC2626; }
+</style>
+</head>
+<body>
+<div id="bar"><b>__TITLE__</b><span id="summary"></span><button id="reset">Reset view</button><span class="hint">drag to pan, wheel to zoom, shift+wheel for sites only, alt+wheel for sequences only</span></div>
+<div id="view"><canvas id="plot"></canvas></div>
+<div id="tip"></div>
+<script id="layout" type="application/json">__LAYOUT__</script>
+<script id="payload" type="application/octet-stream">__PAYLOAD__</script>
+<script>
+"use strict";
+(async function () {
+  // unpack the embedded matrix
+  const layout = JSON.parse(document.getElementById("layout").textContent);
+  let buffer;
+  try {
+    const text = atob(document.getElementById("payload").textContent.trim());
+    const bytes = new Uint8Array(text.length);
+    for (let i = 0; i < text.length; i++) bytes[i] = text.charCodeAt(i);
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+    buffer = await new Response(stream).arrayBuffer();
+  } catch (err) {
+    document.getElementById("view").innerHTML = '<div id="msg">This browser cannot unpack the plot data: ' + err + '</div>';
+    return;
+  }
+  const meta = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 0, layout.meta)));
+  const TYPES = { Int32Array, Uint32Array, Uint16Array, Uint8Array };
+  const data = {};
+  for (const [name, [type, offset, size]] of Object.entries(layout.arrays)) {
+    data[name] = new TYPES[type](buffer, offset, size);
+  }
+  const { records, variants, alleles, site_refs, ref_vars, genes, length, reference } = meta;
+  const { sites, indptr, columns, codes, flags, colours } = data;
+  const numRows = records.length, numCols = site_refs.length;
+  const AMBIGUITY = 1, INSERTION = 2, DELETION = 4;
+
+  // cell colours as packed pixels, at 80% opacity over white like the static plot
+  function rgb(hex) {
+    return [1, 3, 5].map(i => parseInt(hex.slice(i, i + 2), 16));
+  }
+  function pixel(c) {
+    return ((255 << 24) | (c[2] << 16) | (c[1] << 8) | c[0]) >>> 0;
+  }
+  const cellPixels = meta.palette.map(hex => pixel(rgb(hex).map(v => Math.round(v * 0.8 + 255 * 0.2))));
+  const WHITE = pixel([255, 255, 255]), SHADE = pixel([244, 244, 244]);
+
+  document.getElementById("summary").textContent =
+    numRows + " sequences, " + numCols + " sites, " + columns.length + " variants";
+
+  const canvas = document.getElementById("plot");
+  const ctx = canvas.getContext("2d");
+  const tip = document.getElementById("tip");
+  const FONT = "11px \"DejaVu Sans\", Helvetica, Arial, sans-serif";
+  const HEADER = 76, FOOTER = genes.length ? 62 : 40;
+
+  // the name gutter fits the longest labels, measuring only the few that could be longest
+  ctx.font = FONT;
+  const longest = records.reduce((most, label) => Math.max(most, label.length), reference.length);
+  let widest = ctx.measureText(reference).width;
+  for (let r = 0, measured = 0; r < numRows && measured < 200; r++) {
+    if (records[r].length >= longest - 2) {
+      widest = Math.max(widest, ctx.measureText(records[r]).width);
+      measured++;
+    }
+  }
+  const gutter = Math.min(280, Math.max(80, Math.ceil(widest) + 20));
+
+  let W = 0, H = 0, dpr = 1;
+  const view = { x: 0, y: 0, cw: 1, rh: 1 };
+
+  function plotBox() {
+    return { left: gutter, top: HEADER, width: Math.max(W - gutter - 16, 10), height: Math.max(H - HEADER - FOOTER, 10) };
+  }
+  function fit() {
+    const b = plotBox();
+    return { cw: Math.min(80, b.width / Math.max(numCols, 1)), rh: Math.min(20, b.height / Math.max(numRows, 1)) };
+  }
+  function clamp() {
+    const b = plotBox(), f = fit();
+    view.cw = Math.min(Math.max(view.cw, f.cw), 80);
+    view.rh = Math.min(Math.max(view.rh, f.rh), 60);
+    view.x = Math.min(Math.max(view.x, 0), Math.max(0, numCols - b.width / view.cw));
+    view.y = Math.min(Math.max(view.y, 0), Math.max(0, numRows - b.height / view.rh));
+  }
+  function resetView() {
+    const f = fit();
+    view.x = 0; view.y = 0; view.cw = f.cw; view.rh = f.rh;
+    clamp();
+  }
+  function visible(b) {
+    return {
+      firstRow: Math.max(0, Math.floor(view.y)), lastRow: Math.min(numRows, Math.ceil(view.y + b.height / view.rh)),
+      firstCol: Math.max(0, Math.floor(view.x)), lastCol: Math.min(numCols, Math.ceil(view.x + b.width / view.cw))
+    };
+  }
+
+  // cells are written straight into an image of the plot area, so the cost of a frame
+  // depends on what is on screen rather than on the size of the panel
+  function drawCells(b, v) {
+    const pw = Math.round(b.width * dpr), ph = Math.round(b.height * dpr);
+    const image = ctx.createImageData(pw, ph);
+    const out = new Uint32Array(image.data.buffer);
+    out.fill(WHITE);
+    const cw = view.cw * dpr, rh = view.rh * dpr;
+    const rowTop = r => Math.max(0, Math.round((r - view.y) * rh));
+    const rowBottom = r => Math.min(ph, Math.round((r + 1 - view.y) * rh));
+    if (rh >= 2) {
+      for (let r = v.firstRow; r < v.lastRow; r += 1) {
+        if (r % 2) continue;
+        out.fill(SHADE, rowTop(r) * pw, rowBottom(r) * pw);
+      }
+    }
+    const gapX = cw >= 4 ? cw * 0.075 : 0, gapY = rh >= 4 ? rh * 0.05 : 0;
+    for (let r = v.firstRow; r < v.lastRow; r++) {
+      const y0 = Math.max(0, Math.round((r - view.y) * rh + gapY));
+      const y1 = Math.min(ph, Math.max(y0 + 1, Math.round((r + 1 - view.y) * rh - gapY)));
+      for (let e = indptr[r]; e < indptr[r + 1]; e++) {
+        const c = columns[e];
+        if (c < v.firstCol || c >= v.lastCol) continue;
+        const x0 = Math.max(0, Math.round((c - view.x) * cw + gapX));
+        const x1 = Math.min(pw, Math.max(x0 + 1, Math.round((c + 1 - view.x) * cw - gapX)));
+        const colour = cellPixels[colours[e]];
+        for (let y = y0; y < y1; y++) out.fill(colour, y * pw + x0, y * pw + x1);
+      }
+    }
+    ctx.putImageData(image, Math.round(b.left * dpr), Math.round(b.top * dpr));
+  }
+
+  function draw() {
+    const b = plotBox(), v = visible(b);
+    ctx.setTransform(1, 0, 0, 1, 0, 0);
+    ctx.fillStyle = "#fff";
+    ctx.fillRect(0, 0, canvas.width, canvas.height);
+    drawCells(b, v);
+    ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(0, b.top, W, b.height);
+    ctx.clip();
+
+    // letters only where the cells can hold them
+    if (view.cw >= 12 && view.rh >= 12) {
+      ctx.font = "bold " + Math.min(14, Math.floor(Math.min(view.cw, view.rh) * 0.7)) + "px \"DejaVu Sans\", Helvetica, Arial, sans-serif";
+      ctx.fillStyle = "#fff";
+      ctx.textAlign = "center";
+      ctx.textBaseline = "middle";
+      for (let r = v.firstRow; r < v.lastRow; r++) {
+        const y = b.top + (r + 0.5 - view.y) * view.rh;
+        for (let e = indptr[r]; e < indptr[r + 1]; e++) {
+          const c = columns[e];
+          if (c < v.firstCol || c >= v.lastCol) continue;
+          ctx.fillText(alleles[codes[e]], b.left + (c + 0.5 - view.x) * view.cw, y);
+        }
+      }
+    }
+
+    // sequence names, thinned out where the rows are too close for every one
+    ctx.font = FONT;
+    ctx.fillStyle = "#1F2937";
+    ctx.textAlign = "right";
+    ctx.textBaseline = "middle";
+    const nameStep = Math.max(1, Math.ceil(13 / view.rh));
+    for (let r = Math.ceil(v.firstRow / nameStep) * nameStep; r < v.lastRow; r += nameStep) {
+      ctx.fillText(records[r], gutter - 10, b.top + (r + 0.5 - view.y) * view.rh);
+    }
+    ctx.restore();
+
+    // reference row and position labels
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(b.left, 0, b.width, b.top);
+    ctx.clip();
+    ctx.fillStyle = "#E5E7EB";
+    ctx.fillRect(b.left, b.top - 22, b.width, 18);
+    ctx.fillStyle = "#1F2937";
+    ctx.textAlign = "center";
+    if (view.cw >= 10) {
+      for (let c = v.firstCol; c < v.lastCol; c++) {
+        ctx.fillText(site_refs[c], b.left + (c + 0.5 - view.x) * view.cw, b.top - 13);
+      }
+    }
+    ctx.fillStyle = "#374151";
+    ctx.textAlign = "left";
+    const siteStep = Math.max(1, Math.ceil(14 / view.cw));
+    for (let c = Math.ceil(v.firstCol / siteStep) * siteStep; c < v.lastCol; c += siteStep) {
+      ctx.save();
+      ctx.translate(b.left + (c + 0.5 - view.x) * view.cw, b.top - 28);
+      ctx.rotate(-Math.PI / 4);
+      ctx.fillText(String(sites[c]), 0, 0);
+      ctx.restore();
+    }
+    ctx.restore();
+    ctx.font = "italic bold 12px \"DejaVu Sans\", Helvetica, Arial, sans-serif";
+    ctx.textAlign = "right";
+    ctx.fillStyle = "#1F2937";
+    ctx.fillText(reference, gutter - 10, b.top - 13);
+
+    // genome track: every site, the stretch of genome on screen, and genes
+    const gy = b.top + b.height + 10;
+    const gx = pos => b.left + (pos / Math.max(length, 1)) * b.width;
+    ctx.fillStyle = "#E5E7EB";
+    ctx.fillRect(b.left, gy, b.width, 14);
+    ctx.fillStyle = "rgba(220, 38, 38, 0.7)";
+    for (const pos of ref_vars) ctx.fillRect(gx(pos) - 0.5, gy, 1, 14);
+    if (v.lastCol > v.firstCol) {
+      const start = gx(sites[v.firstCol]), end = gx(sites[v.lastCol - 1]);
+      ctx.strokeStyle = "#1F2937";
+      ctx.strokeRect(start - 1, gy - 1, Math.max(end - start, 0) + 2, 16);
+    }
+    ctx.font = FONT;
+    ctx.textAlign = "center";
+    for (const [name, start, end, colour] of genes) {
+      const x0 = gx(start), x1 = gx(end);
+      ctx.fillStyle = colour;
+      ctx.fillRect(x0, gy + 20, Math.max(x1 - x0, 1), 14);
+      if (ctx.measureText(name).width + 6 < x1 - x0) {
+        ctx.fillStyle = "#fff";
+        ctx.fillText(name, (x0 + x1) / 2, gy + 27);
+      }
+    }
+  }
+
+  let pending = false;
+  function schedule() {
+    if (!pending) {
+      pending = true;
+      requestAnimationFrame(() => { pending = false; draw(); });
+    }
+  }
+  function resize() {
+    const rect = canvas.getBoundingClientRect();
+    dpr = window.devicePixelRatio || 1;
+    W = rect.width; H = rect.height;
+    canvas.width = Math.round(W * dpr);
+    canvas.height = Math.round(H * dpr);
+    clamp();
+    schedule();
+  }
+
+  // what is under the pointer: a cell, a sequence name or a site
+  function describe(mx, my) {
+    const b = plotBox();
+    const r = Math.floor(view.y + (my - b.top) / view.rh);
+    const c = Math.floor(view.x + (mx - b.left) / view.cw);
+    const inRows = my >= b.top && my < b.top + b.height && r < numRows;
+    const inCols = mx >= b.left && mx < b.left + b.width && c < numCols;
+    if (inRows && inCols) {
+      const lines = [records[r], "position " + sites[c]];
+      let found = -1;
+      for (let e = indptr[r]; e < indptr[r + 1]; e++) {
+        if (columns[e] === c) { found = e; break; }
+      }
+      if (found < 0) {
+        lines.push("reference " + site_refs[c]);
+      } else {
+        const flag = flags[found];
+        const kind = flag & AMBIGUITY ? "ambiguity" : flag & INSERTION ? "insertion" : flag & DELETION ? "deletion" : "snp";
+        lines.push(variants[codes[found]] + " (" + kind + ")");
+      }
+      return lines;
+    }
+    if (inRows && mx < b.left) return [records[r]];
+    if (inCols && my < b.top) return ["position " + sites[c], "reference " + site_refs[c]];
+    return null;
+  }
+
+  let drag = null;
+  canvas.addEventListener("mousedown", ev => {
+    drag = { x: ev.clientX, y: ev.clientY };
+    canvas.classList.add("drag");
+    tip.style.display = "none";
+  });
+  window.addEventListener("mouseup", () => {
+    drag = null;
+    canvas.classList.remove("drag");
+  });
+  canvas.addEventListener("mousemove", ev => {
+    if (drag) {
+      view.x -= (ev.clientX - drag.x) / view.cw;
+      view.y -= (ev.clientY - drag.y) / view.rh;
+      drag = { x: ev.clientX, y: ev.clientY };
+      clamp();
+      schedule();
+      return;
+    }
+    const lines = describe(ev.offsetX, ev.offsetY);
+    if (lines) {
+      tip.textContent = lines.join("\n");
+      tip.style.left = (ev.clientX + 14) + "px";
+      tip.style.top = (ev.clientY + 14) + "px";
+      tip.style.display = "block";
+    } else {
+      tip.style.display = "none";
+    }
+  });
+  canvas.addEventListener("mouseleave", () => { tip.style.display = "none"; });
+  canvas.addEventListener("wheel", ev => {
+    ev.preventDefault();
+    const b = plotBox();
+    const zoom = Math.exp(-(ev.deltaY || ev.deltaX) * 0.0015);
+    const mx = ev.offsetX - b.left, my = ev.offsetY - b.top;
+    if (!ev.altKey) {
+      const col = view.x + mx / view.cw;
+      view.cw *= zoom;
+      clamp();
+      view.x = col - mx / view.cw;
+    }
+    if (!ev.shiftKey) {
+      const row = view.y + my / view.rh;
+      view.rh *= zoom;
+      clamp();
+      view.y = row - my / view.rh;
+    }
+    clamp();
+    schedule();
+  }, { passive: false });
+  document.getElementById("reset").addEventListener("click", () => { resetView(); schedule(); });
+  window.addEventListener("resize", resize);
+
+  resize();
+  resetView();
+  schedule();
+})();
+</script>
+</body>
+</html>
+"""
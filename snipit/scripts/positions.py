@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import gzip
+from bisect import bisect_right
+
+# imports from other modules
+import numpy as np
+
+GAP = ord("-")
+
+
+def merge_intervals(intervals):
+    """
+    Sort closed, 1-based (start, end) intervals and merge any that overlap or touch.
+    Returns a list of disjoint (start, end) tuples in position order.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def open_text(path):
+    """Open a plain or gzip/bgzip compressed text file for reading."""
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rt") if compressed else open(path, "r")
+
+
+def read_bed_intervals(path):
+    """
+    Closed, 1-based intervals from the first three columns of a BED file
+    (0-based, half-open). Header, track and browser lines are skipped and the
+    chromosome is ignored, as snipit compares against a single reference.
+    """
+    intervals = []
+    with open_text(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split("\t") if "\t" in line else line.split()
+            try:
+                start, end = int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                raise ValueError(f"line {line_number} is not a BED interval")
+            if end > start:
+                intervals.append((start + 1, end))
+    return intervals
+
+
+def read_vcf_intervals(path):
+    """
+    Closed, 1-based intervals covering the REF allele of every record in a VCF, as
+    positions on the ungapped reference (see PositionFilter.masked_columns).
+    Records filtered as 'caution' (as in the problematic sites VCF for SARS-CoV-2)
+    are flagged rather than masked, so they are left in.
+    """
+    intervals = []
+    with open_text(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            try:
+                pos, ref = int(fields[1]), fields[3]
+            except (IndexError, ValueError):
+                raise ValueError(f"line {line_number} is not a VCF record")
+            if len(fields) > 6 and fields[6] == "caution":
+                continue
+            intervals.append((pos, pos + max(len(ref), 1) - 1))
+    return intervals
+
+
+class IntervalSet:
+    """
+    Disjoint, sorted closed intervals of 1-based positions.
+
+    Membership is a binary search over the interval starts, so a range such as
+    1-5000000 costs one interval rather than five million positions.
+    """
+
+    def __init__(self, intervals):
+        self.intervals = merge_intervals(intervals)
+        self.starts = np.array([start for start, end in self.intervals], dtype=np.int64)
+        self.ends = np.array([end for start, end in self.intervals], dtype=np.int64)
+
+    def __contains__(self, position):
+        i = bisect_right(self.starts, position) - 1
+        return i >= 0 and position <= self.ends[i]
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def contains(self, positions):
+        """Vectorised membership test for an array of 1-based positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        i = np.searchsorted(self.starts, positions, side="right") - 1
+        return (i >= 0) & (positions <= self.ends[np.maximum(i, 0)]) if len(self.intervals) else np.zeros(positions.shape, dtype=bool)
+
+    def fill(self, mask, value):
+        """Set mask (indexed by 0-based alignment column) to value over every interval."""
+        for start, end in self.intervals:
+            mask[max(start, 1) - 1:end] = value
+        return mask
+
+
+class PositionFilter:
+    """
+    The positions kept by --include-positions, --exclude-positions and the mask files.
+
+    A position is kept if it falls in an included interval (or nothing was included)
+    and in no excluded or masked interval, so inclusion is considered before exclusion.
+    Included and excluded positions are alignment columns, while masked intervals, read
+    from BED and VCF files, are positions on the ungapped reference.
+    """
+
+    def __init__(self, included=None, excluded=None, masked=None):
+        self.included = IntervalSet(included) if included else None
+        self.excluded = IntervalSet(excluded or [])
+        self.masked = IntervalSet(masked or [])
+
+    def __bool__(self):
+        return self.included is not None or len(self.excluded) > 0 or len(self.masked) > 0
+
+    def keeps(self, position):
+        if self.included is not None and position not in self.included:
+            return False
+        return position not in self.excluded and position not in self.masked
+
+    def mask(self, positions):
+        """Boolean array marking which of an array of 1-based positions are kept."""
+        positions = np.asarray(positions, dtype=np.int64)
+        keep = ~self.excluded.contains(positions) & ~self.masked.contains(positions)
+        if self.included is not None:
+            keep &= self.included.contains(positions)
+        return keep
+
+    def masked_columns(self, reference_row=None):
+        """
+        The masked intervals as closed, 1-based alignment columns. Each end is mapped
+        through the bases of the encoded reference row, so a mask also covers any
+        insertions against the reference inside it. Without a reference row the
+        positions are taken to be columns already, as for VCF input.
+        """
+        if reference_row is None or not len(self.masked):
+            return self.masked.intervals
+        # 1-based column of each reference base
+        columns = np.flatnonzero(np.asarray(reference_row) != GAP) + 1
+        keep = (self.masked.ends >= 1) & (self.masked.starts <= len(columns))
+        starts = np.clip(self.masked.starts[keep], 1, len(columns))
+        ends = np.clip(self.masked.ends[keep], 1, len(columns))
+        return list(zip(columns[starts - 1].tolist(), columns[ends - 1].tolist()))
+
+    def column_ranges(self, length, reference_row=None):
+        """
+        The kept alignment columns as sorted, 0-based half-open (start, end) ranges,
+        so callers can slice out and compare only the columns that are kept.
+        Masks are mapped onto the alignment through reference_row, if given.
+        """
+        included = self.included.intervals if self.included is not None else [(1, length)]
+        excluded = merge_intervals(self.excluded.intervals + self.masked_columns(reference_row))
+        ranges = []
+        j = 0
+        for start, end in included:
+            start, end = max(start, 1), min(end, length)
+            # excluded intervals are sorted and disjoint, so those ending before this
+            # interval starts can be passed over for good
+            while j < len(excluded) and excluded[j][1] < start:
+                j += 1
+            k = j
+            while start <= end:
+                if k < len(excluded) and excluded[k][0] <= end:
+                    if excluded[k][0] > start:
+                        ranges.append((start - 1, excluded[k][0] - 1))
+                    start = max(start, excluded[k][1] + 1)
+                    k += 1
+                else:
+                    ranges.append((start - 1, end))
+                    break
+        return ranges
+
+    def key(self):
+        """Hashable summary, for caching variants called with this filter."""
+        return (tuple(self.included.intervals) if self.included is not None else None,
+                tuple(self.excluded.intervals),
+                tuple(self.masked.intervals))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # resource is unix only, peak RSS is reported as unavailable elsewhere
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in megabytes.
+    Returns None where the platform doesn't expose it.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on linux
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class StageProfiler:
+    """
+    Records wall time, CPU time and peak RSS for each named stage of a snipit run.
+
+    Stages can be nested, e.g. `make_graph` containing `make_graph.savefig`,
+    and are kept in the order they were started.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        depth = getattr(self._local, "depth", 0)
+        entry = {"name": name,
+                 "depth": depth,
+                 "start": time.perf_counter() - self._origin,
+                 "wall": 0.0,
+                 "cpu": 0.0,
+                 "peak_rss_mb": None,
+                 "tid": threading.get_ident()}
+        self.stages.append(entry)
+
+        self._local.depth = depth + 1
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry["wall"] = time.perf_counter() - wall_start
+            entry["cpu"] = time.process_time() - cpu_start
+            entry["peak_rss_mb"] = peak_rss_mb()
+            self._local.depth = depth
+
+    def summary(self):
+        """Format the recorded stages as a plain text table."""
+        header = f"{'stage':<32}{'wall (s)':>12}{'cpu (s)':>12}{'peak RSS (MB)':>16}"
+        lines = [header, "-" * len(header)]
+        for entry in self.stages:
+            name = "  " * entry["depth"] + entry["name"]
+            rss = "n/a" if entry["peak_rss_mb"] is None else f"{entry['peak_rss_mb']:.1f}"
+            lines.append(f"{name:<32}{entry['wall']:>12.3f}{entry['cpu']:>12.3f}{rss:>16}")
+        total = sum(entry["wall"] for entry in self.stages if entry["depth"] == 0)
+        lines.append("-" * len(header))
+        lines.append(f"{'total':<32}{total:>12.3f}")
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """
+        Write the stages as a Chrome trace (chrome://tracing, Perfetto) JSON file.
+        Times are in microseconds, as the trace event format expects.
+        """
+        pid = os.getpid()
+        events = []
+        for entry in self.stages:
+            events.append({"name": entry["name"],
+                           "cat": "snipit",
+                           "ph": "X",
+                           "ts": round(entry["start"] * 1e6),
+                           "dur": round(entry["wall"] * 1e6),
+                           "pid": pid,
+                           "tid": entry["tid"],
+                           "args": {"cpu_s": round(entry["cpu"], 6),
+                                    "peak_rss_mb": entry["peak_rss_mb"]}})
+        with open(path, "w") as fw:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fw, indent=1)
+
+
+def stage(profiler, name):
+    """Time `name` with the given profiler, or do nothing if profiling is off."""
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
@@ -8,29 +8,58 @@ import collections
 from itertools import cycle, chain
 import csv
 import math
-from itertools import groupby, count
+import gc
+from concurrent.futures import ProcessPoolExecutor
+import re
+import time
+import threading
 from collections import OrderedDict
 from enum import Enum
+from contextlib import contextmanager
 import warnings
 warnings.filterwarnings('ignore')
 
 # imports from other modules
+import numpy as np
 from Bio import SeqIO
 from Bio.Seq import Seq
 import matplotlib as mpl
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.patches as patches
 from matplotlib.patches import Polygon, FancyBboxPatch
-
-
-new_rc_params = {'text.usetex': False,
-"svg.fonttype": 'none'
-}
-mpl.rcParams.update(new_rc_params)
+from matplotlib.collections import PolyCollection, PatchCollection, PathCollection
+from matplotlib.transforms import AffineDeltaTransform
+from matplotlib.text import Text
+from matplotlib.font_manager import FontProperties
+
+# imports from this module
+from snipit.scripts import profiling
+from snipit.scripts import genbank_features
+from snipit.scripts import annotation
+from snipit.scripts import vcf
+from snipit.scripts import html_viewer
+from snipit.scripts import svg_writer
+from snipit.scripts.positions import PositionFilter, read_bed_intervals, read_vcf_intervals
+from snipit.scripts.variant_matrix import VariantMatrix, SharedVariantMatrix, attach_shared_matrix, AMBIGUITY, INSERTION, DELETION, display_alleles, variant_keys, SNP_KEY, INSERTION_KEY, DELETION_KEY
+
+
+# fonts are set on each text as it's drawn (see apply_plot_fonts) rather than through the
+# global rcParams, so drawing neither reads nor changes matplotlib's global settings and
+# several plots can be drawn at once from different threads. DejaVu Sans ships with
+# matplotlib, so naming only it and the generic family never sends findfont looking for
+# (and warning about) fonts that aren't installed
+FONT_FAMILY = ['DejaVu Sans', 'Helvetica', 'Arial', 'sans-serif']
+PLOT_FONT_FAMILY = ['DejaVu Sans', 'sans-serif']
+# svg text is written as text rather than paths, with the generic sans-serif family spelt
+# out as FONT_FAMILY. the svg backend only reads these from rcParams while saving, so
+# they're set just for that, one svg at a time
+SVG_RC_PARAMS = {"svg.fonttype": 'none',
+                 'font.sans-serif': FONT_FAMILY}
+_svg_rc_lock = threading.Lock()
 
 
 colour_list = ["lightgrey","white"]
-colour_cycle = cycle(colour_list)
 END_FORMATTING = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
@@ -44,6 +73,99 @@ NT_BASES = ["A","T","G","C"]
 NT_AMBIG = ["W","S","M","K","R","Y","B","D","H","V","N"]
 AA_BASES = ["A","R","N","D","C","Q","E","G","H","I","L","K","M","F","P","S","T","W","Y","V"]
 AA_AMBIG = ["X","B","Z","J"]
+GAP = ord("-")
+# --reference keyword for using the majority consensus of the alignment as the reference
+CONSENSUS = "consensus"
+# label_map key for the reference row. fasta ids stop at whitespace, so no record can share it
+REFERENCE_LABEL = "reference label"
+
+# above this many features the gene track is drawn as collections rather than per-gene patches
+GENE_TRACK_DETAIL_LIMIT = 250
+# genes narrower than this on screen are binned together when drawn as collections
+GENE_MIN_PIXELS = 2
+# rough rendered width of a size 8 gene label at 300 dpi (scaled for other resolutions), used to decide which names fit
+GENE_LABEL_CHAR_PIXELS = 20
+GENE_LABEL_PAD_PIXELS = 16
+# resolution of saved figures, unless --dpi is given
+DEFAULT_DPI = 300
+PREVIEW_DPI = 72
+# plots with more records than this are split into pages unless --page-rows says otherwise
+AUTO_PAGE_ROWS = 1000
+# the most pixels a page may take up at its dpi. pages are laid out on an Agg canvas even
+# for vector formats, and with the renderer's buffers that's ~1 GB of memory at most
+MAX_PAGE_PIXELS = 100_000_000
+# pages aren't made shorter than this to fit MAX_PAGE_PIXELS, the dpi is lowered instead
+MIN_PAGE_ROWS = 100
+# the point size of cell letters and record and position labels, and how much of that
+# a cell must span before its letter is drawn (see label_step)
+LABEL_SIZE = 11
+LETTER_FIT = 0.8
+
+# callables fired at the start and end of each pipeline stage, see register_stage_hook.
+# the list is replaced rather than mutated so readers never need a lock
+_stage_hooks = []
+
+
+def register_stage_hook(hook):
+    """
+    Register a callable to be notified at the start and end of each pipeline stage.
+
+    The hook is called as hook(event, stage, counts), where event is "start" or "end",
+    stage is the stage name (e.g. "find_snps", "make_graph") and counts is a dict of
+    stage-specific counts such as sequences, unique_haplotypes, snp_sites or artists.
+    End events also carry the stage duration in seconds as counts["elapsed"], and fire
+    even when the stage fails, with the exception in counts["error"].
+    When no hooks are registered the pipeline skips all of this work.
+    """
+    global _stage_hooks
+    if hook not in _stage_hooks:
+        _stage_hooks = _stage_hooks + [hook]
+    return hook
+
+def unregister_stage_hook(hook):
+    global _stage_hooks
+    # equality rather than identity, as each access to a bound method makes a new object
+    _stage_hooks = [h for h in _stage_hooks if h != hook]
+
+def clear_stage_hooks():
+    global _stage_hooks
+    _stage_hooks = []
+
+def _fire_stage_hooks(event, stage, counts):
+    for hook in _stage_hooks:
+        try:
+            hook(event, stage, counts)
+        except Exception as e:
+            # metrics collection should never take down a plot
+            sys.stderr.write(yellow(f"Warning: stage hook {hook!r} failed on {event} {stage}: {e}\n"))
+
+def stage_started(stage, **counts):
+    """Fire start hooks and return the start time to pass to stage_finished."""
+    _fire_stage_hooks("start", stage, counts)
+    return time.perf_counter()
+
+def stage_finished(stage, started, **counts):
+    counts["elapsed"] = time.perf_counter() - started
+    _fire_stage_hooks("end", stage, counts)
+
+@contextmanager
+def hooked_stage(stage, **counts):
+    """
+    Fire the start and end hooks around a stage, yielding a dict the stage adds its end
+    counts to. The end hooks fire even if the stage raises, with counts["error"] set to
+    the exception. Nothing is fired when no hooks are registered.
+    """
+    if not _stage_hooks:
+        yield counts
+        return
+    started = stage_started(stage, **counts)
+    try:
+        yield counts
+    except BaseException as e:
+        counts["error"] = e
+        raise
+    finally:
+        stage_finished(stage, started, **counts)
 
 
 def create_rounded_rectangle(xy, width, height, corner_radius=0.1, **kwargs):
@@ -71,28 +193,81 @@ def create_rounded_rectangle(xy, width, height, corner_radius=0.1, **kwargs):
         **kwargs
     )
 
+def create_plain_rectangle(xy, width, height, corner_radius=0.1, **kwargs):
+    """Square cornered, unantialiased stand in for create_rounded_rectangle, used by --preview."""
+    kwargs["antialiased"] = False
+    return patches.Rectangle(xy, width, height, **kwargs)
+
+
+def label_step(pitch_pixels, dpi, fit=1.0, size=LABEL_SIZE):
+    """
+    How often a label can be drawn along a run of cells pitch_pixels apart without
+    overlapping the next: 1 draws every label, 2 every other and so on.
+    A label needs fit times its font size, converted to pixels at this dpi.
+    """
+    label_pixels = fit*size*dpi/72
+    return max(1, math.ceil(label_pixels/pitch_pixels))
+
+
+def box_path(patch):
+    """
+    Outline of a box from create_rounded_rectangle or create_plain_rectangle, in data units.
+    Used as a template that a PathCollection repeats at many offsets.
+    """
+    return patch.get_patch_transform().transform_path(patch.get_path())
+
 
 def bp_range(s):
     """
-        Crude function to parse positions or position ranges (inclusive) passed as a string by argparse.
+        Parse positions or position ranges (inclusive) passed as a string by argparse.
         Input: string in the format "100-200" or "100"
-        Returns a list with integer positions.
-        Arguably better solved by a regex, but still would need to typecast
+        Returns a closed (start, end) interval rather than every position in it,
+        so long ranges cost nothing to represent (see positions.PositionFilter).
     """
     # try to parse as a range
     try:
         start,end = map(int, s.split('-'))
-        return list(range(start,end+1))
     except ValueError:
         # if range parsing fails, perhaps it's only one position. try to parse as a single int
         try: 
-            pos = int(s)
-            return [pos]
+            start = end = int(s)
         except ValueError:
             raise argparse.ArgumentTypeError("Coordinates must be in the format 'start-end' or 'pos'")
+    if start > end:
+        raise argparse.ArgumentTypeError("Coordinates must be in the format 'start-end' with start no greater than end")
+    return (start,end)
         
+def frequency(s):
+    """Parse a fraction between 0 and 1 passed as a string by argparse."""
+    try:
+        value = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Frequency must be a number between 0 and 1")
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError("Frequency must be a number between 0 and 1")
+    return value
 
 
+def load_masks(mask_bed,mask_vcf,cwd):
+    """
+    Read every --mask-bed and --mask-vcf file into one list of closed, 1-based intervals,
+    as positions on the ungapped reference.
+    """
+    intervals = []
+    for mask_files,reader,file_type in [(mask_bed, read_bed_intervals, "BED"),
+                                        (mask_vcf, read_vcf_intervals, "VCF")]:
+        for mask_file in mask_files or []:
+            mask_path = os.path.join(cwd, mask_file)
+            if not os.path.exists(mask_path):
+                sys.stderr.write(red(f"Error: can't find mask file at {mask_path}\n"))
+                sys.exit(-1)
+            try:
+                intervals.extend(reader(mask_path))
+            except (ValueError, OSError, UnicodeDecodeError) as e:
+                sys.stderr.write(red(f"Error: {mask_file} must be in {file_type} format ({e})\n"))
+                sys.exit(-1)
+    return intervals
+
 def check_ref(recombi_mode):
     if recombi_mode:
         sys.stderr.write(red(f"Error: Please explicitly state reference sequence when using `--recombi-mode`\n"))
@@ -143,7 +318,7 @@ def qc_alignment(alignment,reference,cds_mode,sequence_type,cwd):
             print(f"{i[0]}\t{i[1]}\n")
         sys.exit(-1)
     
-    if cds_mode and unique_lengths[0]%3!=0:
+    if cds_mode and lengths[0]%3!=0:
         sys.stderr.write(red("Error: CDS mode flag used but alignment length not a multiple of 3.\n"))
         sys.exit(-1)
 
@@ -159,18 +334,18 @@ def reference_qc(reference, record_ids,cwd):
             sys.stderr.write(red(f"Error: can't find genbank file at {ref_path}\n"))
             sys.exit(-1)
         else:
-            ref_input = ""
-            ref_file = ""
-            record_count = 0
-            for record in SeqIO.parse(reference, "genbank"):
-                ref_input = record.seq
-                ref_file = record
-                record_count += 1
-
-            if record_count >1:
+            # shares the parsed table with parse_genbank, so the file is only read once per run
+            ref_file = genbank_features.load_feature_table(ref_path, with_sequence=True)
+            ref_input = ref_file["sequence"]
+
+            if ref_file["records"] >1:
                 sys.stderr.write(red(f"Error: more than one record found in reference genbank file\n"))
                 sys.exit(-1)
 
+    elif reference == CONSENSUS:
+        # built from the alignment itself once it has been read, see consensus_sequence
+        ref_input = CONSENSUS
+
     elif reference not in record_ids:
         sys.stderr.write(red(f"Error: input reference {reference} not found in alignment\n"))
         sys.exit(-1)
@@ -180,6 +355,49 @@ def reference_qc(reference, record_ids,cwd):
 
     return ref_file, ref_input
 
+def read_vcf(vcf_file,region,reference,genbank,cds_mode,sequence_type,compare_references,show_indels,ambig_mode,positions,cwd):
+    """
+    Variants straight from the genotypes of a multi-sample VCF, without an alignment.
+    The VCF's REF alleles are the reference, so the reference row is labelled with its chromosome.
+    Returns the same dict that is stored in the variant cache.
+    """
+    vcf_path = os.path.join(cwd, vcf_file)
+    if not os.path.exists(vcf_path):
+        sys.stderr.write(red(f"Error: can't find VCF file at {vcf_path}\n"))
+        sys.exit(-1)
+    if sequence_type != "nt":
+        sys.stderr.write(red(f"Error: VCF input is only supported for nucleotide sequences\n"))
+        sys.exit(-1)
+    for option,given in [("--reference",reference),("--cds-mode",cds_mode),("--compare-references",compare_references)]:
+        if given:
+            sys.stderr.write(red(f"Error: `{option}` can't be used with VCF input, the reference is the VCF's REF alleles\n"))
+            sys.exit(-1)
+
+    try:
+        called = vcf.vcf_variants(vcf_path, region, show_indels, ambig_mode, positions)
+    except (ValueError, IndexError, OSError, UnicodeDecodeError) as e:
+        sys.stderr.write(red(f"Error: {vcf_file} must be a VCF with genotype columns ({e})\n"))
+        sys.exit(-1)
+    if called["chrom"] is None:
+        sys.stderr.write(red(f"Error: no VCF records found{' in ' + region if region else ''}\n"))
+        sys.exit(-1)
+
+    # codon changes are annotated against the genbank sequence, if there is one
+    reference_seq = ""
+    if genbank:
+        genbank_path = os.path.join(cwd, genbank)
+        if os.path.exists(genbank_path):
+            reference_seq = genbank_features.load_feature_table(genbank_path, with_sequence=True)["sequence"]
+
+    return {"num_seqs": len(called["samples"]) + 1,
+            "ref_input": called["chrom"],
+            "reference": reference_seq,
+            "record_ids": called["samples"],
+            "length": called["length"],
+            "variants": called["variants"],
+            "record_aa_snps": None,
+            "record_synonymous": None}
+
 def recombi_ref_missing():
     sys.stderr.write(red(f"Error: when using --recombi-mode, please supply 2 references separated by a comma with `--recombi-references`.\n"))
     sys.exit(-1)
@@ -236,39 +454,116 @@ def label_map(record_ids,labels,column_names,cwd):
 
     return label_map
 
-def next_colour():
-    return next(colour_cycle)
+def set_reference_label(label_map, reference_id):
+    if reference_id not in label_map:
+        label_map[REFERENCE_LABEL]=reference_id
+    else:
+        label_map[REFERENCE_LABEL]=label_map[reference_id]
 
-def get_ref_and_alignment(input_file,reference,label_map):
-    input_seqs = collections.defaultdict(list)
-    reference_seq = ""
+def get_ref_and_alignment(input_file,reference,label_map,sequence_type="nt"):
+    with hooked_stage("parse_alignment") as stage_counts:
+        input_seqs = collections.defaultdict(list)
+        reference_seq = ""
 
-    for record in SeqIO.parse(input_file, "fasta"):
-        if record.id == reference:
-            reference_seq = record.seq.upper()
-            if record.id not in label_map:
-                label_map["reference"]=record.id
+        for record in SeqIO.parse(input_file, "fasta"):
+            if record.id == reference:
+                reference_seq = record.seq.upper()
+                set_reference_label(label_map, record.id)
             else:
-                label_map["reference"]=label_map[record.id]
-        else:
-            input_seqs[str(record.seq).upper()].append(record.id)
+                input_seqs[str(record.seq).upper()].append(record.id)
 
+        if reference == CONSENSUS:
+            reference_seq = consensus_sequence(input_seqs, sequence_type)
+            set_reference_label(label_map, CONSENSUS)
+
+        stage_counts.update(sequences=sum(len(ids) for ids in input_seqs.values()),
+                            unique_haplotypes=len(input_seqs))
     return reference_seq, input_seqs
 
-def merge_indels(indel_list,prefix):
-    if indel_list:
-        groups = groupby(indel_list, key=lambda item, c=count():item-next(c))
-        tmp = [list(g) for k, g in groups]
-        merged_indels = []
-        for i in tmp:
-            indel = f"{i[0]}:{prefix}{len(i)}"
-            merged_indels.append(indel)
-        return merged_indels
+def get_references_and_alignment(input_file,references,sequence_type="nt"):
+    """
+    Read the alignment once for comparison against several references.
+    Unlike get_ref_and_alignment, every record (references included) stays in the dedup map.
+    Returns a dict of reference id -> sequence and the dedup map of sequence -> record ids.
+    """
+    with hooked_stage("parse_alignment") as stage_counts:
+        input_seqs = collections.defaultdict(list)
+        reference_seqs = {}
+        wanted = set(references)
+
+        for record in SeqIO.parse(input_file, "fasta"):
+            seq = str(record.seq).upper()
+            if record.id in wanted:
+                reference_seqs[record.id] = seq
+            input_seqs[seq].append(record.id)
+
+        if CONSENSUS in wanted:
+            reference_seqs[CONSENSUS] = consensus_sequence(input_seqs, sequence_type)
+
+        stage_counts.update(sequences=sum(len(ids) for ids in input_seqs.values()),
+                            unique_haplotypes=len(input_seqs))
+    return {reference: reference_seqs[reference] for reference in references}, input_seqs
+
+def alignment_without(input_seqs,record_id):
+    """Dedup map as seen from one reference: the same map minus that reference's own record."""
+    alignment = {}
+    for seq,records in input_seqs.items():
+        records = [record for record in records if record != record_id]
+        if records:
+            alignment[seq] = records
+    return alignment
+
+def compare_references_qc(compare_references,reference,record_ids):
+    if reference:
+        sys.stderr.write(red(f"Error: use either `--reference` or `--compare-references`, not both.\n"))
+        sys.exit(-1)
 
-    return indel_list
+    references = compare_references.split(",")
+    for ref in references:
+        if ref == "":
+            sys.stderr.write(red(f"Error: input comma separated sequence IDs for `--compare-references`.\n"))
+            sys.exit(-1)
+        if ref not in record_ids and ref != CONSENSUS:
+            sys.stderr.write(red(f"Error: input reference {ref} not found in alignment\n"))
+            sys.exit(-1)
+    if len(set(references)) != len(references):
+        sys.stderr.write(red(f"Error: references given to `--compare-references` must be distinct.\n"))
+        sys.exit(-1)
+    return references
 
-def find_snps(reference_seq,input_seqs,show_indels,sequence_type,ambig_mode):
+def file_stem(name):
+    """Make a sequence id safe to use as part of a file name."""
+    return re.sub(r"[^\w.-]+", "_", name)
 
+def file_stems(names):
+    """
+    File name stems for several sequence ids, as a dict of id -> stem. Ids that would
+    share a stem, like 'A/B' and 'A_B' (or ones differing only in case, which some
+    filesystems don't tell apart), get a numbered suffix so their outputs don't overwrite each other.
+    """
+    stems = {}
+    taken = set()
+    for name in names:
+        stem = file_stem(name)
+        unique_stem = stem
+        suffix = 1
+        while unique_stem.lower() in taken:
+            suffix += 1
+            unique_stem = f"{stem}_{suffix}"
+        if unique_stem != stem:
+            sys.stderr.write(yellow(f"Warning: {name} would share output file names with another reference, using {unique_stem} for its files.\n"))
+        taken.add(unique_stem.lower())
+        stems[name] = unique_stem
+    return stems
+
+def merge_indels(indel_positions):
+    """Start and length of each run of consecutive 1-based gap positions."""
+    breaks = np.flatnonzero(np.diff(indel_positions) != 1) + 1
+    starts = np.concatenate(([0], breaks)) if len(indel_positions) else breaks
+    lengths = np.diff(np.concatenate((starts, [len(indel_positions)])))
+    return indel_positions[starts], lengths
+
+def snp_gcode(sequence_type,ambig_mode):
     # set the appropriate genetic code to use for snp calling
     if sequence_type == 'nt':
         if ambig_mode == 'snps':
@@ -284,87 +579,218 @@ def find_snps(reference_seq,input_seqs,show_indels,sequence_type,ambig_mode):
             gcode = AA_BASES + AA_AMBIG
         else: #exclude
             gcode = AA_BASES
+    return gcode
 
-    snp_dict = {}
-
-    record_snps = {}
-    var_counter = collections.Counter()
-    for query_seq in input_seqs:
-        snps =[]
-        insertions = []
-        deletions = []
-        for i in range(len(query_seq)):
-            bases = [query_seq[i],reference_seq[i]]
-            if bases[0] != bases[1]:
-                if bases[0] in gcode and bases[1] in gcode:
-
-                    snp = f"{i+1}:{bases[1]}{bases[0]}" # position-reference-query
-
-                    snps.append(snp)
-                elif bases[0]=='-' and show_indels:
-                #if there's a gap in the query, means a deletion
-                    deletions.append(i+1)
-                elif bases[1]=='-' and show_indels:
-                    #if there's a gap in the ref, means an insertion
-                    insertions.append(i+1)
-        if show_indels:
-            insertions = merge_indels(insertions,"ins")
-            deletions = merge_indels(deletions,"del")
-
-        variants = []
-        for var_list in [snps,insertions,deletions]:
-            for var in var_list:
-                var_counter[var]+=1
-                variants.append(var)
-        variants = sorted(variants, key = lambda x : int(x.split(":")[0]))
-
-        snp_dict[query_seq] = variants
-
-        for record in input_seqs[query_seq]:
-            record_snps[record] = variants
-    return snp_dict,record_snps,len(var_counter)
-
-def find_ambiguities(alignment, snp_dict,sequence_type):
-
-    if sequence_type == "nt":
-        amb = NT_AMBIG
-    if sequence_type == "aa":
-        amb = AA_AMBIG
+def byte_mask(symbols):
+    """Boolean lookup table over byte values, True for each of the given single characters."""
+    mask = np.zeros(256, dtype=bool)
+    for symbol in symbols:
+        mask[ord(symbol)] = True
+    return mask
 
-    snp_sites = collections.defaultdict(list)
-    for seq in snp_dict:
-        snps = snp_dict[seq]
-        for snp in snps:
-            pos,var = snp.split(":")
-            index = int(pos)-1
+def encode_sequence(seq):
+    return np.frombuffer(str(seq).encode("ascii", "replace"), dtype=np.uint8)
 
-            ref_allele = var[0]
-            snp_sites[index]=ref_allele
+def encode_alignment(input_seqs):
+    """
+    Pack the unique sequences of a dedup map (sequence -> record ids) into a single
+    uint8 matrix of byte codes, one row per unique sequence in map order.
+    Returns the list of unique sequences and the matrix.
+    """
+    haplotypes = list(input_seqs)
+    if not haplotypes:
+        return haplotypes, np.zeros((0, 0), dtype=np.uint8)
+    matrix = encode_sequence("".join(haplotypes)).reshape(len(haplotypes), -1)
+    return haplotypes, matrix
 
-    amb_dict = {}
+def consensus_sequence(input_seqs,sequence_type="nt"):
+    """
+    Majority consensus of a dedup map (sequence -> record ids).
 
-    for query_seq in alignment:
-        snps =[]
+    Bases and gaps are counted column by column over the encoded alignment, with each unique
+    sequence weighted by the number of records that share it. Ambiguity codes aren't counted,
+    ties go to the first base in NT_BASES/AA_BASES order, and columns with nothing to count
+    become N (or X for protein alignments).
+    """
+    with hooked_stage("consensus", unique_haplotypes=len(input_seqs)) as stage_counts:
+        symbols = (NT_BASES if sequence_type == "nt" else AA_BASES) + ["-"]
+        uncounted = "N" if sequence_type == "nt" else "X"
+        codes = np.full(256, len(symbols), dtype=np.uint8)
+        for code,symbol in enumerate(symbols):
+            codes[ord(symbol)] = code
+
+        haplotypes,matrix = encode_alignment(input_seqs)
+        columns = np.arange(matrix.shape[1])
+        # one extra row collects everything that isn't counted
+        counts = np.zeros((len(symbols)+1, matrix.shape[1]), dtype=np.int64)
+        for row,haplotype in enumerate(haplotypes):
+            counts[codes[matrix[row]], columns] += len(input_seqs[haplotype])
+
+        counted = counts[:-1]
+        alphabet = np.frombuffer("".join(symbols).encode("ascii"), dtype=np.uint8)
+        consensus = alphabet[counted.argmax(axis=0)]
+        consensus[counted.max(axis=0) == 0] = ord(uncounted)
+
+        stage_counts.update(length=matrix.shape[1])
+    return consensus.tobytes().decode("ascii")
+
+def differing_columns(query_row,reference_row,kept_ranges):
+    """Sorted 0-based columns where two encoded rows differ, comparing only the kept column ranges."""
+    return np.concatenate([np.flatnonzero(query_row[start:end] != reference_row[start:end]) + start
+                           for start,end in kept_ranges] + [np.zeros(0, dtype=np.int64)])
+
+def call_variants(sites,query_row,reference_row,called,show_indels):
+    """
+    Classify the (0-based, sorted) columns where an encoded query differs from an
+    encoded reference. Returns the 1-based positions, variant keys and flags of its
+    snps and indels, in position order.
+    """
+    query_bases = query_row[sites]
+    ref_bases = reference_row[sites]
+    is_snp = called[query_bases] & called[ref_bases]
+
+    positions = [sites[is_snp]+1]
+    keys = [variant_keys(positions[0], SNP_KEY, (ref_bases[is_snp].astype(np.int64) << 8) | query_bases[is_snp])]
+    flags = [np.zeros(len(positions[0]), dtype=np.uint8)]
+    if show_indels:
+        #a gap in the query means a deletion, a gap in the ref means an insertion
+        query_gap = ~is_snp & (query_bases == GAP)
+        ref_gap = ~is_snp & ~query_gap & (ref_bases == GAP)
+        for gaps,kind,flag in ((ref_gap, INSERTION_KEY, INSERTION), (query_gap, DELETION_KEY, DELETION)):
+            starts,lengths = merge_indels(sites[gaps]+1)
+            positions.append(starts)
+            keys.append(variant_keys(starts, kind, lengths))
+            flags.append(np.full(len(starts), flag, dtype=np.uint8))
+
+    positions = np.concatenate(positions)
+    order = np.argsort(positions, kind="stable")
+    return positions[order], np.concatenate(keys)[order], np.concatenate(flags)[order]
+
+def find_snps(reference_seq,input_seqs,show_indels,sequence_type,ambig_mode,positions=None):
+    """
+    Call the snps, indels and ambiguities of every record against the reference.
+    Returns a VariantMatrix with a row per record.
+    """
+    return find_snps_multi({None: reference_seq}, input_seqs, show_indels, sequence_type, ambig_mode, positions)[None]
 
-        for i in snp_sites:
-            bases = [query_seq[i],snp_sites[i]] #if query not same as ref allele
-            if bases[0] != bases[1]:
-                if bases[0] in amb:
-                    snp = f"{i+1}:{bases[1]}{bases[0]}" # position-outgroup-query
-                    snps.append(snp)
+def find_snps_multi(references,input_seqs,show_indels,sequence_type,ambig_mode,positions=None):
+    """
+    Call variants against several references in a single pass over the encoded alignment,
+    writing them straight into a VariantMatrix per reference.
+
+    references maps each reference id to its sequence and input_seqs is the dedup map of
+    the records to call, which may include the references: each unique sequence is compared
+    with all of the references in one go, and a record is never compared with itself.
 
-        for record in alignment[query_seq]:
-            amb_dict[record] = snps
+    Each row holds the record's snps and indels in position order, then its ambiguities
+    at the sites where any record has a snp or indel (see find_ambiguities).
+
+    Returns a dict of reference id -> VariantMatrix.
+    """
+    with hooked_stage("find_snps", unique_haplotypes=len(input_seqs), references=len(references)) as stage_counts:
+        called = byte_mask(snp_gcode(sequence_type,ambig_mode))
+        haplotypes,matrix = encode_alignment(input_seqs)
+        reference_ids = list(references)
+        reference_matrix = np.stack([encode_sequence(references[reference_id]) for reference_id in reference_ids])
+        # columns outside --include-positions, or inside --exclude-positions or a mask, are
+        # never compared. masks are in reference positions, so each reference maps them itself
+        length = reference_matrix.shape[1]
+        kept_ranges = [positions.column_ranges(length, reference_row) if positions else [(0, length)]
+                       for reference_row in reference_matrix]
+
+        # reference id -> (haplotype row, records, positions, keys, flags) per called haplotype
+        calls = {reference_id: [] for reference_id in reference_ids}
+        for row,query_seq in enumerate(haplotypes):
+            query_row = matrix[row]
+            for j,reference_id in enumerate(reference_ids):
+                records = [record for record in input_seqs[query_seq] if record != reference_id]
+                if not records:
+                    continue
+                sites = differing_columns(query_row, reference_matrix[j], kept_ranges[j])
+                calls[reference_id].append((row, records) + call_variants(sites, query_row, reference_matrix[j], called, show_indels))
+
+        stage_counts.update(sequences=sum(len(ids) for ids in input_seqs.values()))
+
+    return {reference_id: find_ambiguities(matrix, reference_matrix[j], calls[reference_id], sequence_type)
+            for j,reference_id in enumerate(reference_ids)}
+
+def find_ambiguities(matrix, reference_row, calls, sequence_type):
+    """
+    Add the ambiguities to the snps and indels called against one reference, and pack
+    them into a VariantMatrix.
 
-    return amb_dict
+    Ambiguities are looked for at the sites where any record has a snp or indel, and are
+    kept where the query's ambiguity code differs from the reference base.
+    calls holds (haplotype row, records, positions, keys, flags) for each called haplotype.
+    """
+    with hooked_stage("find_ambiguities", unique_haplotypes=len(calls)) as stage_counts:
+        ambiguous = byte_mask(NT_AMBIG if sequence_type == "nt" else AA_AMBIG)
+        no_entries = np.zeros(0, dtype=np.int64)
+
+        snp_sites = np.unique(np.concatenate([call[2] for call in calls] + [no_entries]))
+        ref_bases = reference_row[snp_sites-1]
+
+        row_records = []
+        positions = []
+        keys = []
+        flags = []
+        indptr = [0]
+        for row,records,call_positions,call_keys,call_flags in calls:
+            query_bases = matrix[row][snp_sites-1]
+            is_amb = ambiguous[query_bases] & (query_bases != ref_bases)
+            amb_positions = snp_sites[is_amb]
+            positions += [call_positions, amb_positions]
+            keys += [call_keys, variant_keys(amb_positions, SNP_KEY, (ref_bases[is_amb].astype(np.int64) << 8) | query_bases[is_amb])]
+            flags += [call_flags, np.full(len(amb_positions), AMBIGUITY, dtype=np.uint8)]
+            indptr.append(indptr[-1] + len(call_positions) + len(amb_positions))
+            row_records.append(records)
+
+        variants = VariantMatrix.from_calls(row_records,
+                                            np.array(indptr, dtype=np.int64),
+                                            np.concatenate(positions + [no_entries]),
+                                            np.concatenate(keys + [no_entries]),
+                                            np.concatenate(flags + [no_entries]).astype(np.uint8))
+
+        stage_counts.update(sequences=len(variants),
+                            snp_sites=len(snp_sites))
+    return variants
+
+def site_frequencies(variants):
+    """
+    Count the records carrying each variant, and carrying any variant at each site,
+    from the variant matrix. Ambiguities aren't counted.
+    Returns (site_counts: position -> records, variant_counts: variant -> records).
+    """
+    site_counts = collections.Counter(dict(zip(variants.sites.tolist(), variants.site_counts().tolist())))
+    return +site_counts, variants.variant_counts()
+
+def write_site_frequencies(site_counts,variant_counts,num_records,output_dir,file_name="site_frequencies.csv"):
+    with open(os.path.join(output_dir,file_name),"w") as fw:
+        fw.write("site,variant,count,frequency,site_count,site_frequency\n")
+        for var in sorted(variant_counts, key = lambda x : (int(x.split(":")[0]), x)):
+            site = int(var.split(":")[0])
+            fw.write(f"{site},{var},{variant_counts[var]},{variant_counts[var]/num_records:.6g},"
+                     f"{site_counts[site]},{site_counts[site]/num_records:.6g}\n")
+
+def filter_sites(variants,min_count=0,min_frequency=0):
+    """
+    Drop sites carried by fewer than min_count records, or by less than min_frequency of them,
+    before anything is drawn. Every variant (and ambiguity) at a site that passes is kept.
+    Returns the filtered variant matrix.
+    """
+    counts = variants.site_counts()
+    keep = counts >= min_count
+    if len(variants):
+        keep &= counts/len(variants) >= min_frequency
+    return variants.select_sites(keep)
 
 
-def recombi_ref_snps(recombi_references, snp_records):
+def recombi_ref_snps(recombi_references, variants):
 
     recombi_refs = recombi_references.split(",")
     recombi_snps = []
     for ref in recombi_refs:
-        recombi_snps.append(snp_records[ref])
+        recombi_snps.append(variants.record_variants(ref))
 
     return recombi_snps,recombi_refs
 
@@ -388,12 +814,38 @@ def recombi_painter(snp_to_check,recombi_snps):
         return "Private"
 
 
-def write_out_snps(write_snps,record_snps,output_dir):
-    with open(os.path.join(output_dir,"snps.csv"),"w") as fw:
-        fw.write("record,snps,num_snps\n")
-        for record in record_snps:
-            snps = ";".join(record_snps[record])
-            fw.write(f"{record},{snps},{len(record_snps[record])}\n")
+def write_out_snps(write_snps,variants,output_dir,variant_annotations=None,record_aa_snps=None,file_name="snps.csv"):
+    # snps.csv is only written when asked for with -s/--write-snps
+    if not write_snps:
+        return
+    with hooked_stage("write_snps", sequences=len(variants)):
+        with open(os.path.join(output_dir,file_name),"w") as fw:
+            header = "record,snps,num_snps"
+            if variant_annotations is not None:
+                # one gene annotation per snp, in the same order, blank where intergenic
+                header += ",genes"
+            if record_aa_snps is not None:
+                header += ",aa_snps,num_aa_snps"
+            fw.write(header + "\n")
+            for record in variants.records:
+                record_snps = variants.record_variants(record)
+                snps = ";".join(record_snps)
+                row = f"{record},{snps},{len(record_snps)}"
+                if variant_annotations is not None:
+                    genes = ";".join(annotation.format_annotation(variant_annotations.get(snp)) for snp in record_snps)
+                    row += f",{genes}"
+                if record_aa_snps is not None:
+                    aa_snps = record_aa_snps.get(record, [])
+                    row += f",{';'.join(aa_snps)},{len(aa_snps)}"
+                fw.write(row + "\n")
+
+def write_out_vcf(variants,output_dir,file_name,chrom,reference_seq,length,sequence_type="nt"):
+    if sequence_type != "nt":
+        sys.stderr.write(red(f"Error: `--write-vcf` is only supported for nucleotide sequences\n"))
+        sys.exit(-1)
+    with hooked_stage("write_vcf", sequences=len(variants), sites=variants.num_sites):
+        # whitespace isn't allowed in a VCF CHROM
+        vcf.write_vcf(variants, os.path.join(output_dir,file_name), re.sub(r"\s+", "_", chrom), reference_seq, length)
 
 
 """
@@ -408,104 +860,82 @@ sfunks.make_graph(num_seqs,num_snps,record_ambs,record_snps,
                       args.recombi_references)
 """
 
-def draw_gene_track(ax, features, y_position, y_height, genome_length, colour_palette="classic", sequence_type="nt"):
+# Gene colour palettes to match the different artistic styles.
+# Each palette contains a list of colours that will be assigned to genes in order
+GENE_COLOUR_SCHEMES = {
+    # Classic palette - traditional scientific colors
+    "classic": [
+        "#2563EB", "#10B981", "#F59E0B", "#EF4444", "#8B5CF6", 
+        "#EC4899", "#14B8A6", "#F97316", "#6366F1", "#84CC16",
+        "#06B6D4", "#A855F7", "#EAB308", "#3B82F6", "#22C55E"
+    ],
+    # Nature-style palette - high saturation
+    "nature": [
+        "#1E40AF", "#059669", "#DC2626", "#7C3AED", "#EA580C", 
+        "#0891B2", "#BE123C", "#166534", "#9333EA", "#CA8A04",
+        "#0E7490", "#7E22CE", "#B91C1C", "#15803D", "#C2410C"
+    ],
+    # Morandi palette - muted tones
+    "morandi": [
+        "#8B7E74", "#7F9173", "#A78F9B", "#9CA3AF", "#B3907A",
+        "#94A3B8", "#BFA094", "#A3A78F", "#8F94A3", "#B89B94",
+        "#91A3A7", "#A7948F", "#9B8FA3", "#8FA3B8", "#A79B8F"
+    ],
+    # Van Gogh palette - vibrant contrasts
+    "vangogh": [
+        "#1E3A8A", "#CA8A04", "#166534", "#7C2D12", "#DC2626",
+        "#3730A3", "#0F766E", "#B45309", "#4C1D95", "#991B1B",
+        "#1E40AF", "#A16207", "#14532D", "#6B21A8", "#C2410C"
+    ],
+    # Monet palette - soft impressionist pastels
+    "monet": [
+        "#93C5FD", "#BBF7D0", "#FECACA", "#E9D5FF", "#FED7AA",
+        "#C7D2FE", "#FDE68A", "#BFDBFE", "#D9F99D", "#FBCFE8",
+        "#A5F3FC", "#DDD6FE", "#FDE047", "#DBEAFE", "#FCA5A5"
+    ],
+    # Matisse palette - bold pure colors
+    "matisse": [
+        "#1D4ED8", "#10B981", "#EF4444", "#F59E0B", "#7C3AED",
+        "#EC4899", "#0EA5E9", "#16A34A", "#DC2626", "#EAB308",
+        "#9333EA", "#DB2777", "#0284C7", "#22C55E", "#F97316"
+    ]
+}
+
+
+def get_gene_colours(features, colour_palette="classic"):
     """
-    Draw a gene track with arrows for genes.
-    
-    Args:
-        ax: matplotlib axis
-        features: list of gene features from GenBank
-        y_position: y coordinate for gene track
-        y_height: height of gene track
-        genome_length: total length of the genome
-        colour_palette: color palette name to match gene colors
-        sequence_type: 'nt' for nucleotide or 'aa' for amino acid
+    Assign each distinct gene name a colour from the gene palette matching colour_palette,
+    cycling through the colours if there are more genes than colours.
     """
-    # Define gene color palettes to match different artistic styles
-    # Each palette contains a list of colors that will be assigned to genes in order
-    gene_color_schemes = {
-        # Classic palette - traditional scientific colors
-        "classic": [
-            "#2563EB", "#10B981", "#F59E0B", "#EF4444", "#8B5CF6", 
-            "#EC4899", "#14B8A6", "#F97316", "#6366F1", "#84CC16",
-            "#06B6D4", "#A855F7", "#EAB308", "#3B82F6", "#22C55E"
-        ],
-        # Nature-style palette - high saturation
-        "nature": [
-            "#1E40AF", "#059669", "#DC2626", "#7C3AED", "#EA580C", 
-            "#0891B2", "#BE123C", "#166534", "#9333EA", "#CA8A04",
-            "#0E7490", "#7E22CE", "#B91C1C", "#15803D", "#C2410C"
-        ],
-        # Morandi palette - muted tones
-        "morandi": [
-            "#8B7E74", "#7F9173", "#A78F9B", "#9CA3AF", "#B3907A",
-            "#94A3B8", "#BFA094", "#A3A78F", "#8F94A3", "#B89B94",
-            "#91A3A7", "#A7948F", "#9B8FA3", "#8FA3B8", "#A79B8F"
-        ],
-        # Van Gogh palette - vibrant contrasts
-        "vangogh": [
-            "#1E3A8A", "#CA8A04", "#166534", "#7C2D12", "#DC2626",
-            "#3730A3", "#0F766E", "#B45309", "#4C1D95", "#991B1B",
-            "#1E40AF", "#A16207", "#14532D", "#6B21A8", "#C2410C"
-        ],
-        # Monet palette - soft impressionist pastels
-        "monet": [
-            "#93C5FD", "#BBF7D0", "#FECACA", "#E9D5FF", "#FED7AA",
-            "#C7D2FE", "#FDE68A", "#BFDBFE", "#D9F99D", "#FBCFE8",
-            "#A5F3FC", "#DDD6FE", "#FDE047", "#DBEAFE", "#FCA5A5"
-        ],
-        # Matisse palette - bold pure colors
-        "matisse": [
-            "#1D4ED8", "#10B981", "#EF4444", "#F59E0B", "#7C3AED",
-            "#EC4899", "#0EA5E9", "#16A34A", "#DC2626", "#EAB308",
-            "#9333EA", "#DB2777", "#0284C7", "#22C55E", "#F97316"
-        ]
-    }
-    
-    # Get the appropriate color palette
     base_palette = colour_palette.replace("_extended", "").replace("_aa", "")
-    if base_palette not in gene_color_schemes:
+    if base_palette not in GENE_COLOUR_SCHEMES:
         base_palette = "classic"
-    
-    color_list = gene_color_schemes[base_palette]
-    
-    # Draw background track with rounded corners
-    track_bg = create_rounded_rectangle((0, y_position), genome_length, y_height * 2,
-                                       corner_radius=0.04, alpha=0.1, fill=True, 
-                                       edgecolor='none', facecolor="#E5E7EB", antialiased=True)
-    ax.add_patch(track_bg)
-    
-    # Create a mapping of unique gene names to colors
-    unique_genes = []
-    gene_color_map = {}
-    
-    # First pass: collect unique gene names
-    for feature in features:
-        gene_name = feature["name"]
-        if gene_name not in unique_genes:
-            unique_genes.append(gene_name)
-    
-    # Assign colors to each unique gene
-    for i, gene_name in enumerate(unique_genes):
-        # Cycle through colors if we have more genes than colors
-        color_index = i % len(color_list)
-        gene_color_map[gene_name] = color_list[color_index]
-    
-    # Draw genes
+    color_list = GENE_COLOUR_SCHEMES[base_palette]
+
+    unique_genes = dict.fromkeys(feature["name"] for feature in features)
+    return {gene_name: color_list[i % len(color_list)] for i, gene_name in enumerate(unique_genes)}
+
+def gene_track_bases_per_pixel(ax, genome_length):
+    """
+    Approximate number of bases covered by one pixel of the gene track,
+    given the axes width and the x limits make_graph sets (-5% to 100% of the genome).
+    """
+    fig = ax.figure
+    axes_pixels = ax.get_position().width * fig.get_figwidth() * fig.dpi
+    return max(genome_length * 1.05 / max(axes_pixels, 1), 1e-9)
+
+def draw_gene_arrows(ax, features, gene_color_map, feat_y, feat_height, genome_length):
+    """Draw each gene as a rounded body plus an arrow head showing its strand."""
     for feature in features:
         start = feature["start"]
         end = feature["end"]
         strand = feature["strand"]
-        feat_type = feature["type"]
         name = feature["name"]
         
         # Get color for this specific gene
         color = gene_color_map.get(name, "#6B7280")
         
-        # Calculate feature dimensions
         feat_length = end - start
-        feat_y = y_position + y_height * 0.2
-        feat_height = y_height * 1.6
         
         if strand == 1:  # Forward strand
             # Draw arrow pointing right
@@ -550,159 +980,194 @@ def draw_gene_track(ax, features, y_position, y_height, genome_length, colour_pa
                                   edgecolor='white', linewidth=1,
                                   facecolor=color, antialiased=True)
             ax.add_patch(arrow)
+
+def draw_gene_collection(ax, features, gene_color_map, feat_y, feat_height, genome_length, bases_per_pixel):
+    """
+    Draw large annotation sets as two collections rather than one patch per gene.
+
+    Genes at least GENE_MIN_PIXELS wide are drawn as single arrow-shaped polygons.
+    Narrower genes would just overplot each other, so they are binned per pixel
+    column and each occupied bin is drawn once, in the colour of its first gene.
+    """
+    arrows = []
+    arrow_colours = []
+    bins = {}
+    bin_width = GENE_MIN_PIXELS * bases_per_pixel
+    for feature in features:
+        start = feature["start"]
+        end = feature["end"]
+        feat_length = end - start
+        color = gene_color_map.get(feature["name"], "#6B7280")
+
+        if feat_length < bin_width:
+            bins.setdefault(int(start // bin_width), color)
+            continue
+
+        arrow_size = min(feat_length * 0.1, genome_length * 0.01)
+        mid_y = feat_y + feat_height/2
+        if feature["strand"] == 1:
+            body_end = end - arrow_size
+            arrows.append([(start, feat_y), (body_end, feat_y), (end, mid_y),
+                           (body_end, feat_y + feat_height), (start, feat_y + feat_height)])
+        else:
+            body_start = start + arrow_size
+            arrows.append([(body_start, feat_y), (end, feat_y), (end, feat_y + feat_height),
+                           (body_start, feat_y + feat_height), (start, mid_y)])
+        arrow_colours.append(color)
+
+    if arrows:
+        ax.add_collection(PolyCollection(arrows, facecolors=arrow_colours, alpha=0.8,
+                                         edgecolors='white', linewidths=0.3, antialiased=True))
+    if bins:
+        binned = []
+        for bin_index in sorted(bins):
+            left = bin_index * bin_width
+            binned.append([(left, feat_y), (left + bin_width, feat_y),
+                           (left + bin_width, feat_y + feat_height), (left, feat_y + feat_height)])
+        ax.add_collection(PolyCollection(binned, facecolors=[bins[i] for i in sorted(bins)], alpha=0.8,
+                                         edgecolors='none', antialiased=False))
+
+def draw_gene_track(ax, features, y_position, y_height, genome_length, colour_palette="classic", sequence_type="nt", preview=False):
+    """
+    Draw a gene track with arrows for genes.
+    
+    Args:
+        ax: matplotlib axis
+        features: list of gene features from GenBank
+        y_position: y coordinate for gene track
+        y_height: height of gene track
+        genome_length: total length of the genome
+        colour_palette: color palette name to match gene colors
+        sequence_type: 'nt' for nucleotide or 'aa' for amino acid
+        preview: leave the gene names without background boxes, for --preview
+    """
+    # Draw background track with rounded corners
+    track_bg = create_rounded_rectangle((0, y_position), genome_length, y_height * 2,
+                                       corner_radius=0.04, alpha=0.1, fill=True, 
+                                       edgecolor='none', facecolor="#E5E7EB", antialiased=True)
+    ax.add_patch(track_bg)
+    
+    # Create a mapping of unique gene names to colors
+    gene_color_map = get_gene_colours(features, colour_palette)
+    bases_per_pixel = gene_track_bases_per_pixel(ax, genome_length)
+    
+    # Calculate feature dimensions
+    feat_y = y_position + y_height * 0.2
+    feat_height = y_height * 1.6
+
+    if len(features) > GENE_TRACK_DETAIL_LIMIT:
+        # too many genes to draw one by one, draw them as a couple of collections instead
+        draw_gene_collection(ax, features, gene_color_map, feat_y, feat_height, genome_length, bases_per_pixel)
+        features = [feature for feature in features if (feature["end"] - feature["start"]) >= GENE_MIN_PIXELS * bases_per_pixel]
+    else:
+        draw_gene_arrows(ax, features, gene_color_map, feat_y, feat_height, genome_length)
+
+    # Add gene names where there's room, skipping any that would overlap the previous name
+    label_right = None
+    for feature in features:
+        feat_length = feature["end"] - feature["start"]
+        label_width = (len(feature["name"]) * GENE_LABEL_CHAR_PIXELS + GENE_LABEL_PAD_PIXELS) * ax.figure.dpi / 300
+        if feat_length / bases_per_pixel < label_width:
+            continue
+        text_x = feature["start"] + feat_length/2
+        if label_right is not None and text_x - (label_width/2)*bases_per_pixel < label_right:
+            continue
+        label_right = text_x + (label_width/2)*bases_per_pixel
+
+        # Add white background for text
+        bbox_props = dict(boxstyle="round,pad=0.2", facecolor='white', 
+                        edgecolor='none', alpha=0.8)
         
-        # Add gene name if space permits
-        if feat_length > genome_length * 0.02:  # Only show name if gene is large enough
-            text_x = start + feat_length/2
-            text_y = feat_y + feat_height/2
-            
-            # Add white background for text
-            bbox_props = dict(boxstyle="round,pad=0.2", facecolor='white', 
-                            edgecolor='none', alpha=0.8)
-            
-            ax.text(text_x, text_y, name, size=8, ha="center", va="center",
-                   fontweight='medium', bbox=bbox_props)
+        ax.text(text_x, feat_y + feat_height/2, feature["name"], size=8, ha="center", va="center",
+               fontweight='medium', bbox=bbox_props if not preview else None)
     
     # Add gene track label
     label = "Gene" if sequence_type == "nt" else "Protein"
     ax.text(-0.01*genome_length, y_position + y_height, label, 
            size=10, ha="right", va="center", fontweight='medium', style='italic')
 
-def make_graph(num_seqs, num_snps, amb_dict, snp_records,
-                output, label_map, colour_dict, length,
-                width, height, size_option, solid_background,
-                remove_site_text,ambig_mode,flip_vertical=False,included_positions=None,excluded_positions=None,
-               sort_by_mutation_number=False, high_to_low=True, sort_by_id=False,
-               sort_by_mutations=False, recombi_mode=False, recombi_references=[],
-               gene_features=None, colour_palette="classic", sequence_type="nt"
-               ):
-    y_level = 0
-    ref_vars = {}
-    snp_dict = collections.defaultdict(list)
-    included_positions = set(chain.from_iterable(included_positions)) if included_positions is not None else set()
-    excluded_positions = set(chain.from_iterable(excluded_positions)) if excluded_positions is not None else set()
-
-    if sort_by_mutation_number:
-        snp_counts = {}
-        for record in snp_records:
-            snp_counts[record] = int(len(snp_records[record]))
-        ordered_dict = dict(sorted(snp_counts.items(), key=lambda item: item[1], reverse=high_to_low))
-        record_order = list(OrderedDict(ordered_dict).keys())
-
-    elif sort_by_id:
-        record_order = list(sorted(snp_records.keys()))
-
-    elif sort_by_mutations:
-        mutations = sort_by_mutations.split(",")
-        sortable_record = {}
-        for record in snp_records:
-            bases = []
-            for sort_mutation in mutations:
-                found = False
-                for record_mutation in snp_records[record]:
-                    if int(record_mutation.split(":")[0]) == int(sort_mutation):
-                        bases.append(record_mutation[-1])
-                        found = True
-                        break
-                if not found:
-                    bases.append("0")
-            sortable_record[record] = "".join(bases) + record
-        record_order = list(OrderedDict(sorted(sortable_record.items(), key=lambda item: item[1], reverse=high_to_low)).keys())
-
-    else:
-        record_order = list(snp_records.keys())
-    if recombi_mode:
-        # Get a list of SNPs present in each recombi_reference
-        recombi_snps,recombi_refs = recombi_ref_snps(recombi_references, snp_records)
-        # Set the colour palette to "recombi"
-        colour_dict = get_colours("recombi")
-        # Reorder list to put recombi_references at the start
-        record_order.remove(recombi_refs[0])
-        record_order.insert(0, recombi_refs[0])
-        record_order.remove(recombi_refs[1])
-        record_order.insert(1, recombi_refs[1])
-
-    for record in record_order:
-        # y level increments per record, add a gap after the two recombi_refs
-        if recombi_mode and y_level == 2:
-            y_level += 1.2
+def page_rows_of(num_records, page_rows=None, recombi_mode=False):
+    """
+    Split the rows of the plot into pages of at most page_rows records.
+    page_rows of None pages automatically once there are more than AUTO_PAGE_ROWS records,
+    and 0 keeps every record on one page. In recombi mode the two recombi references
+    head every page, so each page can be read on its own.
+    """
+    if page_rows is None:
+        page_rows = AUTO_PAGE_ROWS if num_records > AUTO_PAGE_ROWS else 0
+    if not page_rows or num_records <= page_rows:
+        return [list(range(num_records))]
+    first = 2 if recombi_mode and num_records > 2 else 0
+    header = list(range(first))
+    return [header + list(range(start, min(start + page_rows, num_records)))
+            for start in range(first, num_records, page_rows)]
+
+def limit_page_area(num_records, page_rows, dpi, size_option, width, height, num_snps, num_sites, spacing, length,
+                    recombi_mode=False):
+    """
+    Lower the rows per page, and if need be the dpi, so that no page's figure is more than
+    MAX_PAGE_PIXELS. Paging by rows alone leaves a wide plot at a high dpi free to need
+    gigabytes of raster, so the figure size of a page is worked out from its rows as
+    draw_page does, and the most rows that fit are found by bisection.
+    Returns the page_rows and dpi to draw with.
+    """
+    header = 2 if recombi_mode and num_records > 2 else 0
+    def pixels(rows):
+        y_level = rows + (0.2 if header else 0)
+        fig_width,fig_height,y_inc = figure_size(size_option, width, height, num_snps, num_sites, rows + 1, y_level, spacing, length)
+        return fig_width * fig_height * dpi * dpi
+
+    if page_rows is None:
+        page_rows = AUTO_PAGE_ROWS if num_records > AUTO_PAGE_ROWS else 0
+    rows = min(page_rows, num_records - header) if page_rows else num_records - header
+    if rows < 1 or pixels(header + rows) <= MAX_PAGE_PIXELS:
+        return page_rows, dpi
+
+    # figures only grow with their rows, so bisect for the most that fit
+    low, high = 0, rows
+    while low < high:
+        middle = (low + high + 1) // 2
+        if pixels(header + middle) <= MAX_PAGE_PIXELS:
+            low = middle
         else:
-            y_level +=1
-
-        # for each record get the list of snps
-        snps = snp_records[record]
-        x = []
-        y = []
-
-        for snp in snps:
-            # snp => 12345AT
-            pos,var = snp.split(":")
-            x_position = int(pos)
-            if var.startswith("del"):
-                length_indel = var[3:]
-                ref = f"{length_indel}"
-                base = "-"
-            elif var.startswith("ins"):
-                length_indel = var[3:]
-                ref = "-"
-                base = f"{length_indel}"
-            else:
-                ref = var[0]
-                base = var[1]
-
-            ref_vars[x_position]=ref
-            if recombi_mode:
-                recombi_out = recombi_painter(snp, recombi_snps)
-                # Add name of record, ref, SNP in record, y_level, if SNP is in either recombi_reference...
-                snp_dict[x_position].append((record, ref, base, y_level, recombi_out))
-            else:
-                # ...otherwise add False instead to help the colour logic
-                snp_dict[x_position].append((record, ref, base, y_level, False))
-
-        # if there are ambiguities in that record, add them to the snp dict too
-        if record in amb_dict:
-            for amb in sorted(amb_dict[record]):
-                # amb => 12345AN
-                pos,var = amb.split(":")
-                x_position = int(pos)
-
-                # if positions with any ambiguities should be ignored, note the position
-                if ambig_mode == 'exclude':
-                    excluded_positions.add(x_position)
-                else:
-                    ref = var[0]
-                    base = var[1]
-                    ref_vars[x_position]=ref
-                    # Add name of record, ref, SNP in record, y_level and False for "recombi_mode" colour logic
-                    snp_dict[x_position].append((record, ref, base, y_level, False))
-
-
-    # gather the positions that are not explicitly excluded,
-    # but are not among those to be included
-    positions_not_included=set()
-    if len(included_positions)>0:
-        # of the positions present,
-        # gather a set of positions which should NOT be included in the output
-        positions_not_included = set(snp_dict.keys()) - included_positions
-
-    # remove positions which should be ignored or are not included (pop items from union of the two sets)
-    for pos in excluded_positions | positions_not_included:
-        # remove records for the position, if present
-        snp_dict.pop(pos, None)
-
-    spacing = length/(len(snp_dict)+1)
+            high = middle - 1
+    if low < min(rows, MIN_PAGE_ROWS):
+        # too wide (or too tall, with a fixed --height) for pages of a useful number of
+        # rows, so those pages are drawn at a lower resolution instead
+        short_rows = min(rows, MIN_PAGE_ROWS)
+        if pixels(header + short_rows) >= pixels(header + rows):
+            # a fixed --height, so shorter pages wouldn't be any smaller
+            short_rows = page_rows if page_rows else rows
+        page_dpi = max(1, int(dpi * math.sqrt(MAX_PAGE_PIXELS / pixels(header + short_rows))))
+        sys.stderr.write(yellow(f"Warning: pages of {rows} sequences would be too large to draw at {dpi} dpi, using pages of {short_rows} at {page_dpi} dpi.\n"))
+        return short_rows, page_dpi
+    sys.stderr.write(yellow(f"Warning: pages of {rows} sequences would be too large to draw, using pages of {low}.\n"))
+    return low, dpi
+
+def page_outputs(output, num_pages):
+    """
+    The files each page is saved to: the output itself for a single page or a multi-page pdf,
+    otherwise numbered tiles such as snp_plot_page01.png.
+    """
+    root,ext = os.path.splitext(output)
+    if num_pages == 1 or ext.lower() == ".pdf":
+        return [output] * num_pages
+    digits = len(str(num_pages))
+    return [f"{root}_page{page:0{digits}d}{ext}" for page in range(1, num_pages + 1)]
+
+def figure_size(size_option, width, height, num_snps, num_sites, num_seqs, y_level, spacing, length):
+    """Figure width and height in inches and the row height, as set by --size-option."""
     y_inc = (spacing*0.8*y_level)/length
 
     if size_option == "expand":
         if not width:
             if num_snps ==0:
-                print(red(f"Note: no SNPs found between the reference and the alignment"))
                 width = 10
             else:
-                if len(snp_dict) <10:
+                if num_sites <10:
                     width = 10
                 else:
-                    width = 0.25* len(snp_dict)
+                    width = 0.25* num_sites
 
         if not height:
             if y_level < 5:
@@ -713,7 +1178,6 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
     elif size_option == "scale":
         if not width:
             if num_snps == 0:
-                print(red(f"Note: no SNPs found between the reference and the alignment"))
                 width = 12
             else:
                 width = math.sqrt(num_snps)*3
@@ -722,25 +1186,367 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
             height = math.sqrt(num_seqs)*2
             y_inc = 1
 
+    return width, height, y_inc
+
+def save_figure(fig, output, solid_background, pdf=None):
+    # Save with high quality settings, to a page of a multi-page pdf if there is one
+    target = pdf if pdf is not None else fig
+    if pdf is not None:
+        kwargs = {"figure": fig}
+    else:
+        kwargs = {"fname": output}
+    if not solid_background:
+        kwargs.update(transparent=True)
+    else:
+        kwargs.update(facecolor='white')
+    if pdf is None and output.lower().endswith(".svg"):
+        with _svg_rc_lock, mpl.rc_context(SVG_RC_PARAMS):
+            target.savefig(bbox_inches='tight', pad_inches=0.2, edgecolor='none', **kwargs)
+    else:
+        target.savefig(bbox_inches='tight', pad_inches=0.2, edgecolor='none', **kwargs)
+
+def apply_plot_fonts(fig):
+    """
+    Set snipit's font on every text of a drawn figure, so none of them depends on the
+    global rcParams. Tick labels made later, as the axes are drawn, copy their font from
+    the ones that already exist.
+    """
+    for ax in fig.axes:
+        ax.get_xticklabels()
+        ax.get_yticklabels()
+    for text in fig.findobj(Text):
+        text.set_fontfamily(PLOT_FONT_FAMILY)
+        text.set_usetex(False)
+
+def make_graph(num_seqs, num_snps, amb_dict, snp_records,
+                output, label_map, colour_dict, length,
+                width, height, size_option, solid_background,
+                remove_site_text,ambig_mode,flip_vertical=False,included_positions=None,excluded_positions=None,
+               sort_by_mutation_number=False, high_to_low=True, sort_by_id=False,
+               sort_by_mutations=False, recombi_mode=False, recombi_references=[],
+               gene_features=None, colour_palette="classic", sequence_type="nt",
+               profiler=None, colour_by_gene=False, synonymous_snps=None, page_rows=None, processes=1,
+               dpi=DEFAULT_DPI, preview=False, cull_labels=True, native_svg=False
+               ):
+    """
+    Draw the snipit plot, one page at a time.
+    Every page shares the site layout, reference row and genome and gene tracks, and is
+    drawn and saved before the next is started, so peak memory is set by the page size
+    rather than the number of records. With processes above 1, numbered pages are drawn
+    in parallel instead. Returns the files written.
+    """
+    # every stage reads the same sparse record-by-site matrix; plain dicts from older callers are converted
+    if isinstance(snp_records, VariantMatrix):
+        variants = snp_records
+    else:
+        variants = VariantMatrix.from_records(snp_records, amb_dict)
+    with hooked_stage("make_graph", sequences=len(variants), snp_sites=num_snps) as stage_counts:
+        with profiling.stage(profiler, "make_graph.layout"):
+            position_filter = PositionFilter(included_positions, excluded_positions)
+
+            if sort_by_mutation_number:
+                snp_counts = dict(zip(variants.records, variants.row_counts().tolist()))
+                ordered_dict = dict(sorted(snp_counts.items(), key=lambda item: item[1], reverse=high_to_low))
+                record_order = list(OrderedDict(ordered_dict).keys())
+
+            elif sort_by_id:
+                record_order = list(sorted(variants.records))
+
+            elif sort_by_mutations:
+                mutations = sort_by_mutations.split(",")
+                sortable_record = {}
+                for record in variants.records:
+                    record_mutations = variants.record_variants(record)
+                    bases = []
+                    for sort_mutation in mutations:
+                        found = False
+                        for record_mutation in record_mutations:
+                            if int(record_mutation.split(":")[0]) == int(sort_mutation):
+                                bases.append(record_mutation[-1])
+                                found = True
+                                break
+                        if not found:
+                            bases.append("0")
+                    sortable_record[record] = "".join(bases) + record
+                record_order = list(OrderedDict(sorted(sortable_record.items(), key=lambda item: item[1], reverse=high_to_low)).keys())
+
+            else:
+                record_order = list(variants.records)
+            recombi_snps = None
+            if recombi_mode:
+                # Get a list of SNPs present in each recombi_reference
+                recombi_snps,recombi_refs = recombi_ref_snps(recombi_references, variants)
+                # Set the colour palette to "recombi"
+                colour_dict = get_colours("recombi")
+                # Reorder list to put recombi_references at the start
+                record_order.remove(recombi_refs[0])
+                record_order.insert(0, recombi_refs[0])
+                record_order.remove(recombi_refs[1])
+                record_order.insert(1, recombi_refs[1])
+
+            # sorting is just a reordering of the matrix rows
+            variants = variants.reorder(record_order)
+
+            # keep the columns that are not excluded and, if positions to include were given, are among them.
+            # variants called by snipit itself are already filtered, but plain dicts may not be
+            keep = position_filter.mask(variants.sites)
+
+            # if positions with any ambiguities should be ignored, drop those columns too
+            if ambig_mode == 'exclude':
+                keep &= ~np.isin(variants.sites, variants.ambiguous_sites())
+                ref_vars = variants.called_sites().tolist()
+            else:
+                ref_vars = variants.sites.tolist()
+            variants = variants.select_sites(keep)
+
+            spacing = length/(variants.num_sites+1)
+
+            # the reference text of each site is the same on every page, whichever records the page holds
+            site_refs = [display_alleles(variants.variants[codes[-1]])[0] for snp,rows,codes,flags in variants.by_site()]
+
+            # optionally colour snp cells by the gene they fall in, to match the gene track
+            site_colours = {}
+            if colour_by_gene and gene_features:
+                gene_index = annotation.FeatureIndex(gene_features)
+                gene_colours = get_gene_colours(gene_features, colour_palette)
+                for snp in variants.sites.tolist():
+                    gene = gene_index.gene_at(snp-1)
+                    if gene is not None:
+                        site_colours[snp] = gene_colours[gene]
+
+            # large pages are split further, or drawn at a lower dpi, to keep their raster bounded
+            page_rows,dpi = limit_page_area(len(record_order), page_rows, dpi, size_option, width, height, num_snps,
+                                            variants.num_sites, spacing, length, recombi_mode)
+            pages = page_rows_of(len(record_order), page_rows, recombi_mode)
+            # one output file per format, each drawn from the same figure.
+            # html is a single interactive page of every record, written from the matrix rather than drawn
+            output_files = [output] if isinstance(output, str) else list(output)
+            html_files = [output_file for output_file in output_files if output_file.endswith(".html")]
+            output_files = [output_file for output_file in output_files if output_file not in html_files]
+            # with native_svg, svg pages are written directly by svg_writer rather than drawn
+            svg_files = [output_file for output_file in output_files if native_svg and output_file.endswith(".svg")]
+            output_files = [output_file for output_file in output_files if output_file not in svg_files]
+            if not output_files and not svg_files:
+                pages = []
+            format_outputs = [page_outputs(output_file, len(pages)) for output_file in output_files]
+            svg_outputs = [page_outputs(svg_file, len(pages)) for svg_file in svg_files]
+
+            if num_snps == 0 and size_option in ("expand", "scale") and not width:
+                print(red(f"Note: no SNPs found between the reference and the alignment"))
+
+        # everything a page needs besides its own records
+        page_context = dict(num_snps=num_snps, spacing=spacing, site_refs=site_refs, ref_vars=ref_vars,
+                            site_colours=site_colours, label_map=label_map, colour_dict=colour_dict,
+                            length=length, width=width, height=height, size_option=size_option,
+                            remove_site_text=remove_site_text, flip_vertical=flip_vertical,
+                            recombi_mode=recombi_mode, recombi_snps=recombi_snps, gene_features=gene_features,
+                            colour_palette=colour_palette, sequence_type=sequence_type,
+                            synonymous_snps=synonymous_snps, dpi=dpi, preview=preview, cull_labels=cull_labels)
+
+        pdfs = [None] * len(output_files)
+        for i,output_file in enumerate(output_files):
+            if len(pages) > 1 and format_outputs[i][0] == output_file:
+                # pages of a pdf go into the one file rather than numbered tiles
+                from matplotlib.backends.backend_pdf import PdfPages
+                pdfs[i] = PdfPages(output_file)
+
+        artists = 0
+        try:
+            if processes > 1 and len(pages) > 1 and format_outputs and not any(pdfs):
+                with profiling.stage(profiler, "make_graph.pages"):
+                    artists = render_pages_in_parallel(variants, pages, format_outputs, page_context, solid_background, processes)
+            elif format_outputs:
+                for page,rows in enumerate(pages):
+                    targets = [(page_files[page], pdf) for page_files,pdf in zip(format_outputs, pdfs)]
+                    if len(pages) == 1:
+                        artists += render_page(variants, targets, num_seqs, page_context, solid_background, profiler)
+                    else:
+                        page_variants = variants.reorder([record_order[row] for row in rows])
+                        artists += render_page(page_variants, targets, len(rows) + 1, page_context, solid_background, profiler)
+        finally:
+            for pdf in pdfs:
+                if pdf is not None:
+                    pdf.close()
+
+        if svg_files:
+            with profiling.stage(profiler, "make_graph.svg"):
+                gene_colours = get_gene_colours(gene_features, colour_palette) if gene_features else None
+                for page,rows in enumerate(pages):
+                    page_variants = variants if len(pages) == 1 else variants.reorder([record_order[row] for row in rows])
+                    palette,colours = entry_colours(page_variants, colour_dict, site_colours, recombi_snps)
+                    synonymous = entry_synonymity(page_variants, synonymous_snps) if synonymous_snps is not None else None
+                    for page_files in svg_outputs:
+                        svg_writer.write_svg(page_variants, page_files[page], [label_map[record] for record in page_variants.records],
+                                             label_map[REFERENCE_LABEL], palette, colours, site_refs, ref_vars, length,
+                                             gene_features, gene_colours, "Gene" if sequence_type == "nt" else "Protein",
+                                             synonymous, remove_site_text, flip_vertical, recombi_mode, solid_background)
+
+        if html_files:
+            with profiling.stage(profiler, "make_graph.html"):
+                palette,colours = entry_colours(variants, colour_dict, site_colours, recombi_snps)
+                genes = []
+                if gene_features:
+                    gene_colours = get_gene_colours(gene_features, colour_palette)
+                    genes = [(feature["name"], int(feature["start"]), int(feature["end"]), mpl.colors.to_hex(gene_colours[feature["name"]]))
+                             for feature in gene_features]
+                for html_file in html_files:
+                    html_viewer.write_html(variants, html_file, [label_map[record] for record in variants.records],
+                                           label_map[REFERENCE_LABEL], palette, colours, site_refs, ref_vars,
+                                           int(length), genes, os.path.splitext(os.path.basename(html_file))[0])
+
+        stage_counts.update(sequences=len(record_order),
+                            snp_sites=variants.num_sites,
+                            pages=len(pages),
+                            artists=artists)
+    return list(dict.fromkeys([page_file for page_files in format_outputs + svg_outputs for page_file in page_files] + html_files))
+
+def entry_synonymity(variants, synonymous_snps):
+    """
+    For --cds-mode, whether each stored entry of the matrix is a synonymous change
+    (svg_writer.SYNONYMOUS), one that changes the amino acid (svg_writer.NON_SYNONYMOUS), or
+    neither is known (0), as draw_page fades or outlines them.
+    """
+    states = np.zeros(len(variants.codes), dtype=np.uint8)
+    for row,record in enumerate(variants.records):
+        record_synonymous = synonymous_snps.get(record, ())
+        entries = variants.row_entries(row)
+        for entry,code,flag in zip(range(entries.start, entries.stop), variants.codes[entries].tolist(), variants.flags[entries].tolist()):
+            if not flag & (AMBIGUITY | INSERTION | DELETION):
+                states[entry] = svg_writer.SYNONYMOUS if variants.variants[code] in record_synonymous else svg_writer.NON_SYNONYMOUS
+    return states
+
+def entry_colours(variants, colour_dict, site_colours, recombi_snps=None):
+    """
+    The colour of every stored entry of the matrix, by the same rules draw_page colours
+    cells with. Returns the distinct colours (as hex) and an index into them per entry.
+    """
+    def code_colour(code, ambiguous):
+        if recombi_snps is not None and not ambiguous:
+            return colour_dict[recombi_painter(variants.variants[code], recombi_snps)]
+        var = display_alleles(variants.variants[code])[1]
+        return colour_dict[var.upper()] if var in colour_dict else "dimgrey"
+
+    palette = {}
+    def palette_index(colour):
+        return palette.setdefault(mpl.colors.to_hex(colour), len(palette))
+
+    # entries with the same variant and ambiguity share their colour...
+    ambiguous = (variants.flags & AMBIGUITY) != 0
+    keys,inverse = np.unique(variants.codes*2 + ambiguous, return_inverse=True)
+    key_indices = np.array([palette_index(code_colour(key//2, bool(key%2))) for key in keys.tolist()], dtype=np.uint16)
+    indices = key_indices[inverse.reshape(-1)]
+
+    # ...unless their site has a colour of its own, which recombi colouring still takes precedence over
+    if site_colours:
+        site_indices = np.array([palette_index(site_colours[site]) if site in site_colours else -1
+                                 for site in variants.sites.tolist()], dtype=np.int64)
+        entry_sites = site_indices[variants.columns]
+        override = entry_sites >= 0
+        if recombi_snps is not None:
+            override &= ambiguous
+        indices[override] = entry_sites[override]
+    return list(palette), indices
+
+def render_page(variants, targets, num_seqs, page_context, solid_background, profiler=None):
+    """
+    Draw one page and save it to each (file, pdf) target, one per format, freeing the figure
+    afterwards. The layout and artists are only made once however many formats are saved.
+    Returns the number of artists drawn.
+    """
+    with profiling.stage(profiler, "make_graph.draw"):
+        fig = draw_page(variants, variants.records, num_seqs, **page_context)
+
+    with profiling.stage(profiler, "make_graph.savefig"):
+        for output,pdf in targets:
+            save_figure(fig, output, solid_background, pdf)
+
+    ax = fig.axes[0]
+    artists = len(ax.patches) + len(ax.texts) + len(ax.lines) + len(ax.collections)
+    # free this page's artists and canvas before drawing the next
+    fig.clear()
+    del fig, ax
+    gc.collect()
+    return artists
+
+# set in each page rendering process by _init_page_worker
+_page_worker = {}
+
+def _init_page_worker(handle, page_context, solid_background):
+    variants,blocks = attach_shared_matrix(handle)
+    _page_worker.update(variants=variants, blocks=blocks, page_context=page_context, solid_background=solid_background)
+
+def _render_page_worker(rows, outputs):
+    variants = _page_worker["variants"]
+    page_variants = variants.reorder([variants.records[row] for row in rows])
+    return render_page(page_variants, [(output, None) for output in outputs], len(rows) + 1,
+                       _page_worker["page_context"], _page_worker["solid_background"])
+
+def render_pages_in_parallel(variants, pages, format_outputs, page_context, solid_background, processes):
+    """
+    Render numbered pages in a pool of processes. The variant matrix is put in shared memory
+    once and every worker attaches to it, so only each page's row numbers are sent per task.
+    Returns the number of artists drawn.
+    """
+    with SharedVariantMatrix(variants) as shared:
+        with ProcessPoolExecutor(max_workers=min(processes, len(pages)),
+                                 initializer=_init_page_worker,
+                                 initargs=(shared.handle, page_context, solid_background)) as pool:
+            futures = [pool.submit(_render_page_worker, rows, [page_files[page] for page_files in format_outputs])
+                       for page,rows in enumerate(pages)]
+            return sum(future.result() for future in futures)
+
+def draw_page(variants, record_order, num_seqs, num_snps, spacing, site_refs, ref_vars, site_colours,
+              label_map, colour_dict, length, width, height, size_option,
+              remove_site_text, flip_vertical, recombi_mode, recombi_snps,
+              gene_features, colour_palette, sequence_type, synonymous_snps, dpi=DEFAULT_DPI, preview=False,
+              cull_labels=True):
+    """
+    Draw one page of records, with the reference row and tracks, on a new figure.
+    In preview mode cells are plain rectangles and text has no shadows or background boxes.
+    With cull_labels, letters are left off cells too small to hold them and record and
+    position labels are thinned out where they would overlap.
+    """
+    # every box on the page is drawn by one of these
+    create_box = create_plain_rectangle if preview else create_rounded_rectangle
+    # previews add every box as one collection at the end, rather than patch by patch
+    preview_boxes = []
+    def add_box(patch):
+        if preview:
+            preview_boxes.append(patch)
+        else:
+            ax.add_patch(patch)
+    y_levels = []
+    y_level = 0
+    for record in record_order:
+        # y level increments per record, add a gap after the two recombi_refs
+        if recombi_mode and y_level == 2:
+            y_level += 1.2
+        else:
+            y_level +=1
+        y_levels.append(y_level)
+
+    width,height,y_inc = figure_size(size_option, width, height, num_snps, variants.num_sites, num_seqs, y_level, spacing, length)
+
+    # width and height of the figure with higher DPI for better quality.
+    # an explicit Figure on its own Agg canvas keeps this call independent of pyplot's global state
+    fig = Figure(figsize=(width,height), dpi=dpi, facecolor='white')
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1,1,1)
+
+    # tick styling is set on these axes only, rather than through the global rcParams
+    ax.tick_params(width=1.5, length=4)
+    for spine in ax.spines.values():
+        spine.set_linewidth(1.5)
+
     # if the plot is flipped vertically, place the x-axis (genome map) labels on top
     if flip_vertical:
-        plt.rcParams['xtick.bottom'] = plt.rcParams['xtick.labelbottom'] = False
-        plt.rcParams['xtick.top'] = plt.rcParams['xtick.labeltop'] = True
-
-    # Set matplotlib parameters for better quality
-    plt.rcParams['font.family'] = 'sans-serif'
-    plt.rcParams['font.sans-serif'] = ['DejaVu Sans', 'Helvetica', 'Arial', 'sans-serif']
-    plt.rcParams['font.size'] = 11
-    plt.rcParams['axes.linewidth'] = 1.5
-    plt.rcParams['xtick.major.width'] = 1.5
-    plt.rcParams['ytick.major.width'] = 1.5
-    plt.rcParams['xtick.major.size'] = 4
-    plt.rcParams['ytick.major.size'] = 4
-    
-    # width and height of the figure with higher DPI for better quality
-    fig, ax = plt.subplots(1,1, figsize=(width,height), dpi=300, facecolor='white')
+        ax.tick_params(axis='x', bottom=False, labelbottom=False, top=True, labeltop=True)
+
+    # row shading alternates grey/white, starting afresh for each plot
+    row_colours = cycle(colour_list)
 
     y_level = 0
+    row_levels = []
 
     for record in record_order:
 
@@ -752,29 +1558,69 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
 
 
         # either grey or white
-        col = next_colour()
+        col = next(row_colours)
 
         # for each record (sequence) draw a rounded rectangle the length of the whole genome (either grey or white)
-        rect = create_rounded_rectangle((0,y_level-(0.5*y_inc)), length, y_inc,
+        rect = create_box((0,y_level-(0.5*y_inc)), length, y_inc,
                                        corner_radius=0.05, alpha=0.25, fill=True, 
                                        edgecolor='none', facecolor=col, antialiased=True)
-        ax.add_patch(rect)
+        add_box(rect)
+        row_levels.append(y_level)
+
+    ref_genome_position = y_inc*-2.7
 
+    # Adjust y-axis limits to accommodate gene track if present
+    bottom_limit = ref_genome_position
+    if gene_features:
+        bottom_limit = ref_genome_position - y_inc * 3  # Extra space for gene track
+    if not flip_vertical:
+        top_limit = y_level+(y_inc*1.05)
+    else:
+        top_limit = y_level+(y_inc*2.05)
+
+    # labels that would be too small to read, or overlap their neighbours, are left out.
+    # cell sizes in pixels are estimated from the axes before tight_layout, which only makes them larger
+    if cull_labels:
+        axes_box = ax.get_position()
+        x_pixels = width*dpi*axes_box.width/(1.05*length)
+        y_pixels = height*dpi*axes_box.height/(top_limit-bottom_limit)
+        name_step = label_step(y_inc*y_pixels, dpi)
+        site_step = label_step(spacing*x_pixels, dpi)
+        show_letters = label_step(min(spacing*0.85*x_pixels, y_inc*0.9*y_pixels), dpi, fit=LETTER_FIT) == 1
+    else:
+        name_step = site_step = 1
+        show_letters = True
+    show_letters = show_letters and not remove_site_text
+
+    for row,record in enumerate(record_order):
+        if row % name_step:
+            continue
         # for each record add the name to the left hand side with background
         # Add subtle background box for label
         bbox_props = dict(boxstyle="round,pad=0.3", facecolor='#F3F4F6', edgecolor='none', alpha=0.7)
-        ax.text(-0.01*length, y_level, label_map[record], size=11, ha="right", va="center", fontweight='medium', bbox=bbox_props)
+        ax.text(-0.01*length, row_levels[row], label_map[record], size=LABEL_SIZE, ha="right", va="center", fontweight='medium', bbox=bbox_props if not preview else None)
+
+    # the text drawn for each distinct variant, and its recombi colouring, only need working out once
+    alleles = [display_alleles(variant) for variant in variants.variants]
+    recombi_outs = {}
+
+    # every snp cell is the same size, so its outline is built once and stamped at each cell's offset
+    cell_template = box_path(create_box((0,0), spacing*0.85, y_inc*0.9, corner_radius=0.15))
+    cell_offsets = []
+    cell_faces = []
+    cell_edges = []
+    cell_widths = []
 
     position = 0
-    for snp in sorted(snp_dict):
+    for column,(snp,rows,codes,flags) in enumerate(variants.by_site()):
         position += spacing
 
         # write text adjacent to the SNPs shown with the numeric position
         # the text alignment is toggled right/left (top/bottom considering 90-deg rotation) if the plot is flipped
-        if not remove_site_text:
+        if not remove_site_text and column % site_step == 0:
             # Add background for position number
             bbox_props = dict(boxstyle="round,pad=0.2", facecolor='white', edgecolor='#E5E7EB', linewidth=0.5, alpha=0.9)
-            ax.text(position, y_level+(0.55*y_inc), snp, size=11, ha="center", va="bottom" if not flip_vertical else "top", rotation=45, fontweight='medium', color='#374151')
+            ax.text(position, y_level+(0.55*y_inc), snp, size=LABEL_SIZE, ha="center", va="bottom" if not flip_vertical else "top", rotation=45, fontweight='medium', color='#374151')
 
         # snp position labels
         left_of_box = position-(0.4*spacing)
@@ -783,39 +1629,57 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
         top_polygon = y_inc * -0.7
         bottom_polygon = y_inc * -1.7
 
-        for sequence in snp_dict[snp]:
-
-            name,ref,var,y_pos,recombi_out = sequence
-            bottom_of_box = (y_pos*y_inc)-(0.5*y_inc)
-            # draw rounded box for snp
+        for row,code,flag in zip(rows.tolist(), codes.tolist(), flags.tolist()):
+
+            ref,var = alleles[code]
+            y_pos = y_levels[row]
+            recombi_out = False
+            synonymous = None
+            if not flag & AMBIGUITY:
+                if recombi_mode:
+                    if code not in recombi_outs:
+                        recombi_outs[code] = recombi_painter(variants.variants[code], recombi_snps)
+                    recombi_out = recombi_outs[code]
+                # in cds mode, note whether the snp changes the amino acid (None if not known)
+                if synonymous_snps is not None and not flag & (INSERTION | DELETION):
+                    synonymous = variants.variants[code] in synonymous_snps.get(record_order[row], ())
+            # place a copy of the cell template for this snp
             if recombi_out:
-                rect = create_rounded_rectangle((left_of_box,bottom_of_box),spacing*0.85,  y_inc*0.9,
-                                              corner_radius=0.15, alpha=0.8, fill=True, 
-                                              edgecolor='white',linewidth=0.5,facecolor=colour_dict[recombi_out], antialiased=True)
+                cell_colour = colour_dict[recombi_out]
+            elif snp in site_colours:
+                cell_colour = site_colours[snp]
             elif var in colour_dict:
-                rect = create_rounded_rectangle((left_of_box,bottom_of_box),spacing*0.85,  y_inc*0.9,
-                                              corner_radius=0.15, alpha=0.8, fill=True, 
-                                              edgecolor='white',linewidth=0.5,facecolor=colour_dict[var.upper()], antialiased=True)
+                cell_colour = colour_dict[var.upper()]
             else:
-                rect = create_rounded_rectangle((left_of_box,bottom_of_box), spacing*0.85,  y_inc*0.9,
-                                              corner_radius=0.15, alpha=0.8, fill=True, 
-                                              edgecolor='white',linewidth=0.5,facecolor="dimgrey", antialiased=True)
-
-            ax.add_patch(rect)
+                cell_colour = "dimgrey"
+            cell_offsets.append((left_of_box, (y_pos*y_inc)-(0.5*y_inc)))
+
+            # in cds mode, fade synonymous changes and outline non-synonymous ones
+            cell_alpha = 0.35 if synonymous else 0.8
+            cell_faces.append(mpl.colors.to_rgba(cell_colour, cell_alpha))
+            if synonymous is False:
+                cell_edges.append(mpl.colors.to_rgba('#111827', cell_alpha))
+                cell_widths.append(1)
+            else:
+                cell_edges.append(mpl.colors.to_rgba('white', cell_alpha))
+                cell_widths.append(0.5)
 
             # sequence variant text with shadow
-            if not remove_site_text:
+            if show_letters:
                 # Add shadow
-                ax.text(position+0.02*spacing, (y_pos*y_inc)-0.02*y_inc, var, size=11, ha="center", va="center", fontweight='bold', color='black', alpha=0.3)
+                if not preview:
+                    ax.text(position+0.02*spacing, (y_pos*y_inc)-0.02*y_inc, var, size=LABEL_SIZE, ha="center", va="center", fontweight='bold', color='black', alpha=0.3)
                 # Main text
-                ax.text(position, y_pos*y_inc, var, size=11, ha="center", va="center", fontweight='bold', color='white')
+                ax.text(position, y_pos*y_inc, var, size=LABEL_SIZE, ha="center", va="center", fontweight='bold', color='white')
 
         # reference variant text with shadow
-        if not remove_site_text:
+        if show_letters:
+            ref = site_refs[column]
             # Add shadow
-            ax.text(position+0.02*spacing, (y_inc * -0.2)-0.02*y_inc, ref, size=11, ha="center", va="center", fontweight='medium', color='black', alpha=0.2)
+            if not preview:
+                ax.text(position+0.02*spacing, (y_inc * -0.2)-0.02*y_inc, ref, size=LABEL_SIZE, ha="center", va="center", fontweight='medium', color='black', alpha=0.2)
             # Main text
-            ax.text(position, y_inc * -0.2, ref, size=11, ha="center", va="center", fontweight='medium')
+            ax.text(position, y_inc * -0.2, ref, size=LABEL_SIZE, ha="center", va="center", fontweight='medium')
 
         #polygon showing mapping from genome to spaced out snps
         x = [snp-0.5,snp+0.5,right_of_box,left_of_box,snp-0.5]
@@ -824,14 +1688,22 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
 
         # draw polygon with gradient effect
         poly = patches.Polygon(coords, alpha=0.08, fill=True, edgecolor='#CCCCCC',linewidth=0.5,facecolor="#4A5568", antialiased=True)
-        ax.add_patch(poly)
+        add_box(poly)
 
-        rect = create_rounded_rectangle((left_of_box,top_polygon), spacing*0.85, y_inc*0.95,
+        rect = create_box((left_of_box,top_polygon), spacing*0.85, y_inc*0.95,
                                        corner_radius=0.12, alpha=0.12, fill=True, 
                                        edgecolor='#E0E0E0',linewidth=0.5,facecolor="#718096", antialiased=True)
-        ax.add_patch(rect)
+        add_box(rect)
+
+    # the cells sit above the row shading, like the patches they replace
+    if cell_offsets:
+        ax.add_collection(PathCollection([cell_template], offsets=cell_offsets, offset_transform=ax.transData,
+                                         transform=AffineDeltaTransform(ax.transData), facecolors=cell_faces,
+                                         edgecolors=cell_edges, linewidths=cell_widths, joinstyle="miter", antialiased=not preview,
+                                         zorder=1.5),
+                          autolim=False)
 
-    if len(snp_dict) == 0:
+    if variants.num_sites == 0:
         # snp position labels
         left_of_box = position-(0.4*position)
         right_of_box = position+(0.4*position)
@@ -841,41 +1713,44 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
 
 
     # reference variant rounded rectangle with enhanced style
-    rect = create_rounded_rectangle((0,(top_polygon)), length, y_inc,
+    rect = create_box((0,(top_polygon)), length, y_inc,
                                    corner_radius=0.08, alpha=0.2, fill=True, 
                                    edgecolor='#CBD5E0',linewidth=1,facecolor="#64748B", antialiased=True)
-    ax.add_patch(rect)
+    add_box(rect)
 
     # Add reference label with enhanced style
     bbox_props = dict(boxstyle="round,pad=0.3", facecolor='#1F2937', edgecolor='none', alpha=0.9)
-    ax.text(-0.01*length,  y_inc * -0.2, label_map["reference"], size=12, ha="right", va="center", fontweight='bold', style='italic', color='white', bbox=bbox_props)
-
-    ref_genome_position = y_inc*-2.7
+    # without its dark background box the reference label is drawn in the box colour instead of white
+    ax.text(-0.01*length,  y_inc * -0.2, label_map[REFERENCE_LABEL], size=12, ha="right", va="center", fontweight='bold', style='italic',
+            color='white' if not preview else '#1F2937', bbox=bbox_props if not preview else None)
 
     # reference genome rounded rectangle with gradient-like effect
     # Bottom darker layer
-    rect_bottom = create_rounded_rectangle((0,ref_genome_position), length, y_inc*0.5,
+    rect_bottom = create_box((0,ref_genome_position), length, y_inc*0.5,
                                           corner_radius=0.06, alpha=0.25, fill=True, 
                                           edgecolor='none',facecolor="#374151", antialiased=True)
-    ax.add_patch(rect_bottom)
+    add_box(rect_bottom)
     # Top lighter layer
-    rect_top = create_rounded_rectangle((0,ref_genome_position+y_inc*0.5), length, y_inc*0.5,
+    rect_top = create_box((0,ref_genome_position+y_inc*0.5), length, y_inc*0.5,
                                        corner_radius=0.06, alpha=0.15, fill=True, 
                                        edgecolor='none',facecolor="#6B7280", antialiased=True)
-    ax.add_patch(rect_top)
+    add_box(rect_top)
     # Border
-    rect_border = create_rounded_rectangle((0,ref_genome_position), length, y_inc,
+    rect_border = create_box((0,ref_genome_position), length, y_inc,
                                           corner_radius=0.06, alpha=1, fill=False, 
                                           edgecolor='#9CA3AF',linewidth=1, antialiased=True)
-    ax.add_patch(rect_border)
+    add_box(rect_border)
 
     for var in ref_vars:
         ax.plot([var,var],[ref_genome_position+y_inc*0.02,ref_genome_position+(y_inc*0.98)], color="#DC2626", linewidth=2, alpha=0.7, antialiased=True, solid_capstyle='round')
 
+    if preview_boxes:
+        ax.add_collection(PatchCollection(preview_boxes, match_original=True))
+
     # Draw gene track if features are provided
     if gene_features:
         gene_track_position = ref_genome_position - y_inc * 2
-        draw_gene_track(ax, gene_features, gene_track_position, y_inc, length, colour_palette, sequence_type)
+        draw_gene_track(ax, gene_features, gene_track_position, y_inc, length, colour_palette, sequence_type, preview)
 
     # Remove all plot borders/spines
     ax.spines['top'].set_visible(False)
@@ -883,32 +1758,24 @@ def make_graph(num_seqs, num_snps, amb_dict, snp_records,
     ax.spines['left'].set_visible(False)
     ax.spines['bottom'].set_visible(False)
 
-    plt.yticks([])
+    ax.set_yticks([])
 
     # Add extra space on the left for labels
     ax.set_xlim(-0.05*length,length)
-    
-    # Adjust y-axis limits to accommodate gene track if present
-    bottom_limit = ref_genome_position
-    if gene_features:
-        bottom_limit = ref_genome_position - y_inc * 3  # Extra space for gene track
-    
-    if not flip_vertical:
-        ax.set_ylim(bottom_limit,y_level+(y_inc*1.05))
-    else:
-        ax.set_ylim(bottom_limit,y_level+(y_inc*2.05))
+
+    ax.set_ylim(bottom_limit,top_limit)
+    if flip_vertical:
         ax.invert_yaxis() # must be called after axis limits are set
 
     ax.tick_params(axis='x', labelsize=9)
-    plt.xlabel("Position (base)", fontsize=12, fontweight='medium')
-    # Adjust layout with more padding
-    plt.tight_layout(pad=1.5)
-    
-    # Save with high quality settings
-    if not solid_background:
-        plt.savefig(output, transparent=True, bbox_inches='tight', pad_inches=0.2, edgecolor='none')
-    else:
-        plt.savefig(output, bbox_inches='tight', pad_inches=0.2, facecolor='white', edgecolor='none')
+    ax.set_xlabel("Position (base)", fontsize=12, fontweight='medium')
+    apply_plot_fonts(fig)
+    # Adjust layout with more padding. previews skip this, saving with a tight bounding box is enough
+    if not preview:
+        # tight_layout measures padding in the global font size, so scale it to 1.5 of snipit's
+        fig.tight_layout(pad=1.5 * LABEL_SIZE / FontProperties().get_size_in_points())
+
+    return fig
 
 def get_colours(colour_palette):
 
@@ -990,11 +1857,15 @@ def check_size_option(s):
         sys.exit(-1)
 
 def check_format(f):
-    formats = ["png", "jpg", "pdf", "svg", "tiff"]
+    """One or more comma separated formats, e.g. 'png,svg,pdf'. Returns them as a list without repeats."""
+    formats = ["png", "jpg", "pdf", "svg", "tiff", "html"]
     f_string = "\n - ".join(formats)
-    if f not in formats:
-        sys.stderr.write(red(f"Error: format specified not one of:\n - {f_string}\n"))
-        sys.exit(-1)
+    requested = list(dict.fromkeys(fmt.strip() for fmt in f.split(",")))
+    for fmt in requested:
+        if fmt not in formats:
+            sys.stderr.write(red(f"Error: format specified not one of:\n - {f_string}\n"))
+            sys.exit(-1)
+    return requested
 
 def colour(text, text_colour):
     bold_text = 'bold' in text_colour
@@ -1077,83 +1948,45 @@ def parse_genbank(genbank_file, cwd, sequence_type="nt"):
     Returns:
         List of gene features with positions, names, and types, or None if incompatible
     """
-    import os
-    from Bio import SeqIO
-    
     gb_path = os.path.join(cwd, genbank_file)
+    with hooked_stage("parse_genbank") as stage_counts:
+        if not os.path.exists(gb_path):
+            sys.stderr.write(red(f"Error: GenBank file {genbank_file} not found\n"))
+            return None
     
-    if not os.path.exists(gb_path):
-        sys.stderr.write(red(f"Error: GenBank file {genbank_file} not found\n"))
-        return None
-    
-    features = []
-    protein_features = []
-    nucleotide_features = []
+        try:
+            # only the feature table is needed, so skip building full SeqRecords
+            table = genbank_features.load_feature_table(gb_path)
+        except Exception as e:
+            sys.stderr.write(red(f"Error parsing GenBank file: {str(e)}\n"))
+            return None
     
-    try:
-        # Parse GenBank file
-        for record in SeqIO.parse(gb_path, "genbank"):
-            for feature in record.features:
-                if feature.type in ["gene", "CDS", "rRNA", "tRNA", "ncRNA", "regulatory"]:
-                    # Extract feature information
-                    start = int(feature.location.start)
-                    end = int(feature.location.end)
-                    strand = feature.location.strand  # 1 for forward, -1 for reverse
-                    
-                    # Get feature name
-                    name = None
-                    if "gene" in feature.qualifiers:
-                        name = feature.qualifiers["gene"][0]
-                    elif "locus_tag" in feature.qualifiers:
-                        name = feature.qualifiers["locus_tag"][0]
-                    elif "product" in feature.qualifiers:
-                        name = feature.qualifiers["product"][0][:20]  # Truncate long product names
-                    else:
-                        name = feature.type
-                    
-                    feature_info = {
-                        "start": start,
-                        "end": end,
-                        "strand": strand,
-                        "type": feature.type,
-                        "name": name
-                    }
-                    
-                    # Categorize features by type
-                    if feature.type == "CDS":
-                        protein_features.append(feature_info)
-                    else:
-                        nucleotide_features.append(feature_info)
-                    
-                    features.append(feature_info)
-            
-            # Only process the first record (reference sequence)
-            break
-                
-    except Exception as e:
-        sys.stderr.write(red(f"Error parsing GenBank file: {str(e)}\n"))
-        return None
+        # copies, so the cached table is never altered by callers
+        features = [dict(feature) for feature in table["features"]]
+        protein_features = [feature for feature in features if feature["type"] == "CDS"]
     
-    # Check compatibility between sequence type and available annotations
-    if sequence_type == "aa":
-        if not protein_features:
-            sys.stderr.write(yellow(f"Warning: GenBank file contains no protein (CDS) annotations.\n"))
-            sys.stderr.write(yellow(f"For amino acid sequences, GenBank file should contain CDS features.\n"))
-            sys.stderr.write(yellow(f"Skipping GenBank annotations for this visualization.\n"))
-            return None
-        else:
-            # For protein sequences, only use CDS features
-            features = protein_features
-            sys.stderr.write(green(f"Using {len(protein_features)} protein features from GenBank file.\n"))
-    else:  # nucleotide sequence
-        if not features:
-            sys.stderr.write(yellow(f"Warning: GenBank file contains no suitable annotations.\n"))
-            return None
-        else:
-            sys.stderr.write(green(f"Using {len(features)} genomic features from GenBank file.\n"))
+        # Check compatibility between sequence type and available annotations
+        if sequence_type == "aa":
+            if not protein_features:
+                sys.stderr.write(yellow(f"Warning: GenBank file contains no protein (CDS) annotations.\n"))
+                sys.stderr.write(yellow(f"For amino acid sequences, GenBank file should contain CDS features.\n"))
+                sys.stderr.write(yellow(f"Skipping GenBank annotations for this visualization.\n"))
+                return None
+            else:
+                # For protein sequences, only use CDS features
+                features = protein_features
+                sys.stderr.write(green(f"Using {len(protein_features)} protein features from GenBank file.\n"))
+        else:  # nucleotide sequence
+            if not features:
+                sys.stderr.write(yellow(f"Warning: GenBank file contains no suitable annotations.\n"))
+                return None
+            else:
+                sys.stderr.write(green(f"Using {len(features)} genomic features from GenBank file.\n"))
     
-    # Sort features by start position
-    features.sort(key=lambda x: x["start"])
+        # Sort features by start position
+        features.sort(key=lambda x: x["start"])
+
+        stage_counts.update(features=len(features))
     
     return features
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import math
+from html import escape
+
+# imports from this module
+from snipit.scripts.variant_matrix import display_alleles
+
+# layout in svg pixels: the distance between sites and the height of a row
+SITE_PITCH = 20
+ROW_HEIGHT = 20
+# genome and gene tracks stay readable however few sites there are
+MIN_PLOT_WIDTH = 400
+# rough text widths, used to leave room for labels
+CHAR_WIDTH = 7
+LABEL_SIZE = 11
+# extra space between the two recombi references and the other rows, in rows
+RECOMBI_GAP = 0.2
+
+# entry states for synonymous, see write_svg
+SYNONYMOUS = 1
+NON_SYNONYMOUS = 2
+
+STYLE = """
+.row{fill:#D3D3D3;fill-opacity:.25}
+.cells rect{fill-opacity:.8;stroke:#fff;stroke-opacity:.8;stroke-width:.5}
+.cells .syn{fill-opacity:.35;stroke-opacity:.35}
+.cells .nonsyn{stroke:#111827;stroke-width:1}
+.site{fill:#4A5568;fill-opacity:.08;stroke:#CCC;stroke-width:.5}
+.sitebox{fill:#718096;fill-opacity:.12;stroke:#E0E0E0;stroke-width:.5}
+.refrow{fill:#64748B;fill-opacity:.2;stroke:#CBD5E0}
+.genome-low{fill:#374151;fill-opacity:.25}
+.genome-high{fill:#6B7280;fill-opacity:.15}
+.genome{fill:none;stroke:#9CA3AF}
+.refvars{stroke:#DC2626;stroke-width:2;stroke-opacity:.7;stroke-linecap:round}
+.genes{fill:#E5E7EB;fill-opacity:.1}
+.gene{fill-opacity:.8;stroke:#fff}
+text{font-size:11px}
+.name{text-anchor:end;font-weight:500}
+.pos{fill:#374151;font-weight:500}
+.letter{fill:#fff;font-weight:bold;text-anchor:middle}
+.ref{text-anchor:middle;font-weight:500}
+.reference{text-anchor:end;font-weight:bold;font-style:italic;font-size:12px}
+.genename{text-anchor:middle;font-size:8px;font-weight:500}
+.track{text-anchor:end;font-style:italic;font-size:10px}
+.axis{stroke:#000;stroke-width:1.5}
+.tick{text-anchor:middle;font-size:9px}
+.xlabel{text-anchor:middle;font-size:12px}
+"""
+
+
+def num(value):
+    """Coordinates to a tenth of a pixel, without trailing zeros."""
+    return f"{value:.1f}".rstrip("0").rstrip(".")
+
+
+def tick_step(span, ticks=6):
+    """A round step (1, 2 or 5 times a power of ten) giving about this many ticks over span."""
+    raw = max(span / ticks, 1)
+    power = 10 ** math.floor(math.log10(raw))
+    for multiple in (1, 2, 5, 10):
+        if raw <= multiple * power:
+            return multiple * power
+    return 10 * power
+
+
+def write_svg(variants, output_file, labels, reference_label, palette, entry_colours, site_refs,
+              ref_vars, length, gene_features=None, gene_colours=None, gene_label="Gene",
+              synonymous=None, remove_site_text=False, flip_vertical=False, recombi_mode=False,
+              solid_background=False):
+    """
+    Write one page of the snipit layout straight to svg, without going through matplotlib.
+
+    The layout matches draw_page: a row per record of the matrix (labels are their display
+    names), the reference row, the genome track with its links to the sites and, given
+    gene_features and gene_colours, the gene track. Cells are plain <rect rx> elements grouped
+    by colour, with the colours (entry_colours indexing palette) and the rest of the styling
+    in shared css classes, so each cell costs one short element. synonymous optionally marks
+    each entry SYNONYMOUS or NON_SYNONYMOUS (0 where not known), as in --cds-mode.
+
+    The figure is sized by the number of sites and records rather than by --width and --height.
+    """
+    num_rows = len(variants)
+    num_sites = variants.num_sites
+
+    # levels are in rows, counting up from the reference row like the axes draw_page uses
+    levels = [row + 1 + (RECOMBI_GAP if recombi_mode and row >= 2 else 0) for row in range(num_rows)]
+    top_level = (levels[-1] if levels else 0) + 0.5
+    bottom_level = -4.7 if gene_features else -2.7
+
+    name_space = CHAR_WIDTH * max([len(label) for label in labels] + [len(reference_label)]) + 24
+    site_label_space = int(CHAR_WIDTH * 0.75 * len(str(int(variants.sites[-1]) if num_sites else 0))) + 20
+    axis_space = 48
+    left = name_space
+    plot_width = max((num_sites + 1) * SITE_PITCH, MIN_PLOT_WIDTH)
+    spacing = plot_width / (num_sites + 1)
+    width = left + plot_width + site_label_space
+    top = axis_space if flip_vertical else site_label_space
+    plot_height = (top_level - bottom_level) * ROW_HEIGHT
+    height = top + plot_height + (site_label_space if flip_vertical else axis_space)
+
+    def gx(pos):
+        return left + pos / max(length, 1) * plot_width
+
+    def sx(column):
+        return left + (column + 1) * spacing
+
+    def y(level):
+        if flip_vertical:
+            return top + (level - bottom_level) * ROW_HEIGHT
+        return top + (top_level - level) * ROW_HEIGHT
+
+    def band(low, high):
+        """Top and height in pixels of the band between two levels."""
+        return min(y(low), y(high)), abs(high - low) * ROW_HEIGHT
+
+    def text_y(level, size=LABEL_SIZE):
+        # roughly centres text on a level without relying on dominant-baseline support
+        return num(y(level) + 0.35 * size)
+
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{num(width)}" height="{num(height)}" '
+           f'viewBox="0 0 {num(width)} {num(height)}" font-family="DejaVu Sans, Helvetica, Arial, sans-serif">',
+           "<style>" + STYLE + "".join(f".c{i}{{fill:{colour}}}\n" for i, colour in enumerate(palette)) + "</style>"]
+    if solid_background:
+        out.append(f'<rect width="{num(width)}" height="{num(height)}" fill="#fff"/>')
+
+    # row shading, every other record starting with the first
+    out.append('<g class="row">')
+    for row in range(0, num_rows, 2):
+        row_y, row_height = band(levels[row] - 0.5, levels[row] + 0.5)
+        out.append(f'<rect x="{num(left)}" y="{num(row_y)}" width="{num(plot_width)}" height="{num(row_height)}" rx="1"/>')
+    out.append("</g>")
+
+    # cells, one group per colour
+    cell_width = num(spacing * 0.85)
+    cell_height = num(ROW_HEIGHT * 0.9)
+    by_colour = {}
+    for row in range(num_rows):
+        entries = variants.row_entries(row)
+        cell_y = num(band(levels[row] - 0.5, levels[row] + 0.4)[0])
+        for entry, column, colour in zip(range(entries.start, entries.stop), variants.columns[entries].tolist(),
+                                         entry_colours[entries].tolist()):
+            state = synonymous[entry] if synonymous is not None else 0
+            extra = ' class="syn"' if state == SYNONYMOUS else ' class="nonsyn"' if state == NON_SYNONYMOUS else ""
+            by_colour.setdefault(colour, []).append(
+                f'<rect x="{num(sx(column) - 0.4 * spacing)}" y="{cell_y}" width="{cell_width}" height="{cell_height}" rx="3"{extra}/>')
+    out.append('<g class="cells">')
+    for colour, cells in sorted(by_colour.items()):
+        out.append(f'<g class="c{colour}">')
+        out.extend(cells)
+        out.append("</g>")
+    out.append("</g>")
+
+    # links from each site's column down to its place on the genome, and the reference row
+    link_top = y(-0.7)
+    link_bottom = y(-1.7)
+    box_y, box_height = band(-0.7, 0.25)
+    out.append('<g class="site">')
+    for column, site in enumerate(variants.sites.tolist()):
+        points = [(gx(site - 0.5), link_bottom), (gx(site + 0.5), link_bottom),
+                  (sx(column) + 0.4 * spacing, link_top), (sx(column) - 0.4 * spacing, link_top)]
+        out.append('<polygon points="' + " ".join(f"{num(px)},{num(py)}" for px, py in points) + '"/>')
+    out.append('</g><g class="sitebox">')
+    for column in range(num_sites):
+        out.append(f'<rect x="{num(sx(column) - 0.4 * spacing)}" y="{num(box_y)}" width="{cell_width}" height="{num(box_height)}" rx="2"/>')
+    out.append("</g>")
+    ref_y, ref_height = band(-0.7, 0.3)
+    out.append(f'<rect class="refrow" x="{num(left)}" y="{num(ref_y)}" width="{num(plot_width)}" height="{num(ref_height)}" rx="2"/>')
+
+    # genome track, with a line at every variant site
+    for css, low, high in (("genome-low", -2.7, -2.2), ("genome-high", -2.2, -1.7), ("genome", -2.7, -1.7)):
+        track_y, track_height = band(low, high)
+        out.append(f'<rect class="{css}" x="{num(left)}" y="{num(track_y)}" width="{num(plot_width)}" height="{num(track_height)}" rx="2"/>')
+    if ref_vars:
+        line_y, line_height = band(-2.68, -1.72)
+        out.append('<path class="refvars" d="' + "".join(f"M{num(gx(var))} {num(line_y)}v{num(line_height)}" for var in ref_vars) + '"/>')
+
+    texts = []
+    if gene_features:
+        track_y, track_height = band(-4.7, -2.7)
+        out.append(f'<rect class="genes" x="{num(left)}" y="{num(track_y)}" width="{num(plot_width)}" height="{num(track_height)}" rx="2"/>')
+        gene_y, gene_height = band(-4.5, -2.9)
+        out.append('<g class="gene">')
+        label_right = None
+        for feature in gene_features:
+            start, end = gx(feature["start"]), gx(feature["end"])
+            arrow = min((end - start) * 0.1, plot_width * 0.01)
+            middle = gene_y + gene_height / 2
+            if feature["strand"] == 1:
+                points = [(start, gene_y), (end - arrow, gene_y), (end, middle), (end - arrow, gene_y + gene_height), (start, gene_y + gene_height)]
+            else:
+                points = [(end, gene_y), (start + arrow, gene_y), (start, middle), (start + arrow, gene_y + gene_height), (end, gene_y + gene_height)]
+            out.append(f'<polygon fill="{gene_colours.get(feature["name"], "#6B7280")}" points="'
+                       + " ".join(f"{num(px)},{num(py)}" for px, py in points) + '"/>')
+            # names only where they fit, skipping any that would overlap the previous name
+            label_width = len(feature["name"]) * 5 + 8
+            if end - start >= label_width and (label_right is None or (start + end - label_width) / 2 >= label_right):
+                label_right = (start + end + label_width) / 2
+                texts.append(f'<text class="genename" x="{num((start + end) / 2)}" y="{text_y(-3.7, 8)}">{escape(feature["name"])}</text>')
+        out.append("</g>")
+        texts.append(f'<text class="track" x="{num(left - 6)}" y="{text_y(-3.7, 10)}">{gene_label}</text>')
+
+    # record names and the reference label
+    for row, label in enumerate(labels):
+        texts.append(f'<text class="name" x="{num(left - 8)}" y="{text_y(levels[row])}">{escape(label)}</text>')
+    texts.append(f'<text class="reference" x="{num(left - 8)}" y="{text_y(-0.2, 12)}">{escape(reference_label)}</text>')
+
+    if not remove_site_text:
+        # site positions above the records (below them when flipped), then the letters
+        label_level = top_level + 0.05
+        label_y = y(label_level) + (8 if flip_vertical else -4)
+        rotation = 45 if flip_vertical else -45
+        for column, site in enumerate(variants.sites.tolist()):
+            texts.append(f'<text class="pos" x="{num(sx(column))}" y="{num(label_y)}" '
+                         f'transform="rotate({rotation} {num(sx(column))} {num(label_y)})">{site}</text>')
+        for column, ref in enumerate(site_refs):
+            texts.append(f'<text class="ref" x="{num(sx(column))}" y="{text_y(-0.2)}">{escape(ref)}</text>')
+        alleles = [display_alleles(variant)[1] for variant in variants.variants]
+        texts.append('<g class="letter">')
+        for row in range(num_rows):
+            entries = variants.row_entries(row)
+            letter_y = text_y(levels[row])
+            for column, code in zip(variants.columns[entries].tolist(), variants.codes[entries].tolist()):
+                texts.append(f'<text x="{num(sx(column))}" y="{letter_y}">{escape(alleles[code])}</text>')
+        texts.append("</g>")
+
+    # genome position axis along the bottom (the top when flipped)
+    axis_y = y(bottom_level) + (-6 if flip_vertical else 6)
+    tick_y = axis_y + (-6 if flip_vertical else 15)
+    step = tick_step(length)
+    out.append(f'<path class="axis" d="M{num(left)} {num(axis_y)}H{num(left + plot_width)}'
+               + "".join(f"M{num(gx(tick))} {num(axis_y)}v{-4 if flip_vertical else 4}" for tick in range(0, int(length) + 1, step))
+               + '"/>')
+    for tick in range(0, int(length) + 1, step):
+        texts.append(f'<text class="tick" x="{num(gx(tick))}" y="{num(tick_y)}">{tick}</text>')
+    texts.append(f'<text class="xlabel" x="{num(left + plot_width / 2)}" y="{num(tick_y + (-16 if flip_vertical else 18))}">Position (base)</text>')
+
+    out.extend(texts)
+    out.append("</svg>\n")
+    with open(output_file, "w", encoding="utf-8") as fw:
+        fw.write("\n".join(out))
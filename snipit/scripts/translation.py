@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+from itertools import product
+
+# imports from other modules
+import numpy as np
+
+# imports from this module
+from snipit.scripts.annotation import translate_codon
+
+# nucleotides are coded 0-3, anything ambiguous is 4 and a gap is 5
+NT_CODE_COUNT = 6
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for base in bases:
+        NT_CODES[ord(base)] = code
+NT_CODES[ord("-")] = 5
+
+
+def _build_codon_table():
+    """Amino acid (as a byte) for every combination of three nucleotide codes."""
+    letters = "ACGTN-"
+    table = np.zeros(NT_CODE_COUNT ** 3, dtype=np.uint8)
+    for i, codon in enumerate(product(letters, repeat=3)):
+        codon = "".join(codon)
+        if codon == "---":
+            aa = "-"
+        elif "-" in codon or "N" in codon:
+            aa = "X"
+        else:
+            aa = translate_codon(codon)
+        table[i] = ord(aa)
+    return table
+
+CODON_TABLE = _build_codon_table()
+
+# residues that count as a called amino acid change, as opposed to ambiguity or gaps
+CALLABLE_RESIDUES = np.zeros(256, dtype=bool)
+for residue in "ARNDCQEGHILKMFPSTWYV*":
+    CALLABLE_RESIDUES[ord(residue)] = True
+
+
+def translate_alignment(sequences):
+    """
+    Translate equal-length, in-frame nucleotide sequences in one go.
+
+    Every sequence is coded into a single uint8 matrix and codons are looked up in a
+    precomputed table, so there's no per-codon Python or Biopython call.
+    Returns a (num_sequences, num_codons) uint8 matrix of amino acid bytes.
+    """
+    sequences = [str(seq) for seq in sequences]
+    num_codons = len(sequences[0]) // 3
+    matrix = np.frombuffer("".join(seq[:num_codons*3] for seq in sequences).encode("ascii"), dtype=np.uint8)
+    codes = NT_CODES[matrix].reshape(len(sequences), num_codons, 3)
+    # there are only 216 codon indices, so they're built in place in uint8 rather than
+    # widened to intp, which would take 8 bytes per base
+    codon_index = codes[:, :, 0].copy()
+    codon_index *= NT_CODE_COUNT
+    codon_index += codes[:, :, 1]
+    codon_index *= NT_CODE_COUNT
+    codon_index += codes[:, :, 2]
+    return CODON_TABLE[codon_index]
+
+
+def find_aa_changes(reference_seq, input_seqs, variants):
+    """
+    Call amino acid changes for each unique query sequence and split its nucleotide SNPs
+    into synonymous and non-synonymous.
+
+    Positions are codon numbers counted from the first alignment column, so the
+    alignment is assumed to be an in-frame coding sequence (--cds-mode). The nucleotide
+    SNPs are read from variants, the VariantMatrix called from the same alignment.
+
+    Returns:
+        record_aa_snps: record id -> list of changes, e.g. '614:DG' (codon-reference-query)
+        record_synonymous: record id -> set of nucleotide SNPs that don't change the amino acid
+    """
+    haplotypes = list(input_seqs)
+    record_aa_snps = {}
+    record_synonymous = {}
+    if not haplotypes:
+        return record_aa_snps, record_synonymous
+
+    ref_aa = translate_alignment([reference_seq])[0]
+    query_aa = translate_alignment(haplotypes)
+    # codons with ambiguous bases or gaps are neither synonymous nor non-synonymous
+    callable_codons = CALLABLE_RESIDUES[query_aa] & CALLABLE_RESIDUES[ref_aa]
+    changed = (query_aa != ref_aa) & callable_codons
+
+    for row, haplotype in enumerate(haplotypes):
+        codons = np.flatnonzero(changed[row])
+        aa_snps = [f"{codon+1}:{chr(ref_aa[codon])}{chr(query_aa[row, codon])}" for codon in codons]
+
+        # records with the same sequence share their calls, so the first one's row will do
+        entries = variants.row_entries(variants.row_of(input_seqs[haplotype][0]))
+        is_snp = variants.flags[entries] == 0
+        snp_codons = (variants.sites[variants.columns[entries][is_snp]] - 1) // 3
+        codes = variants.codes[entries][is_snp]
+        in_frame = snp_codons < changed.shape[1]
+        snp_codons, codes = snp_codons[in_frame], codes[in_frame]
+        kept = callable_codons[row, snp_codons] & ~changed[row, snp_codons]
+        synonymous = {variants.variants[code] for code in codes[kept].tolist()}
+
+        for record in input_seqs[haplotype]:
+            record_aa_snps[record] = aa_snps
+            record_synonymous[record] = synonymous
+
+    return record_aa_snps, record_synonymous
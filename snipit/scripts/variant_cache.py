@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+
+def file_identity(path, cwd):
+    """A file's absolute path, modification time and size, or None if it isn't a file."""
+    path = os.path.abspath(os.path.join(cwd, path))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def variant_cache_key(alignment, cwd, input_files=(), **options):
+    """
+    Key parsed variants by the identity on disk of the alignment and every other input file
+    they were called from, and the options used to call them. input_files that are not files,
+    such as a reference given by sequence id, only count through the options.
+    Returns None if the alignment can't be found, in which case nothing is cached.
+    """
+    alignment_identity = file_identity(alignment, cwd)
+    if alignment_identity is None:
+        return None
+    files = tuple(file_identity(path, cwd) for path in input_files if path)
+    return alignment_identity + files + tuple(sorted((k, str(v)) for k, v in options.items()))
+
+
+def estimate_size(obj, seen=None):
+    """
+    Rough deep size in bytes of nested dicts, lists, tuples, sets, strings, arrays and the
+    attributes of objects. Objects shared between containers count once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key, seen) + estimate_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += estimate_size(item, seen)
+    elif hasattr(obj, "__dict__"):
+        # e.g. a VariantMatrix, whose numpy arrays count their own buffers
+        size += estimate_size(vars(obj), seen)
+    return size
+
+
+class VariantCache:
+    """
+    In-process LRU cache of parsed alignments and called variants, bounded by total size in bytes.
+
+    Entries larger than the whole budget are not stored.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
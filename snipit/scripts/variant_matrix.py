@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import collections
+from multiprocessing import shared_memory
+
+# imports from other modules
+import numpy as np
+
+# flags stored alongside each entry
+AMBIGUITY = 1
+INSERTION = 2
+DELETION = 4
+
+# called variants are packed into int64 keys, so the distinct ones can be found with
+# np.unique: the position sits above the kind, which sits above either the reference
+# and query bytes of a snp or the length of an indel
+SNP_KEY = 0
+INSERTION_KEY = 1
+DELETION_KEY = 2
+KIND_SHIFT = 28
+POSITION_SHIFT = 32
+
+
+def variant_keys(positions, kind, values):
+    """Keys for arrays of 1-based positions and snp bytes (ref << 8 | query) or indel lengths."""
+    return (np.asarray(positions, dtype=np.int64) << POSITION_SHIFT) | (kind << KIND_SHIFT) | np.asarray(values, dtype=np.int64)
+
+
+def key_variant(key):
+    """The variant string of a key, e.g. '23403:AG' or '100:del3'."""
+    position = key >> POSITION_SHIFT
+    kind = (key >> KIND_SHIFT) & 0xF
+    value = key & ((1 << KIND_SHIFT) - 1)
+    if kind == DELETION_KEY:
+        return f"{position}:del{value}"
+    elif kind == INSERTION_KEY:
+        return f"{position}:ins{value}"
+    return f"{position}:{chr(value >> 8)}{chr(value & 0xFF)}"
+
+
+def variant_flag(variant):
+    var = variant.split(":")[1]
+    if var.startswith("del"):
+        return DELETION
+    elif var.startswith("ins"):
+        return INSERTION
+    return 0
+
+
+def display_alleles(variant):
+    """Reference and query text drawn for a variant string, e.g. ('A','G'), ('3','-') or ('-','2')."""
+    var = variant.split(":")[1]
+    if var.startswith("del"):
+        return var[3:], "-"
+    elif var.startswith("ins"):
+        return "-", var[3:]
+    return var[0], var[1]
+
+
+class VariantMatrix:
+    """
+    Sparse record-by-site matrix of called variants, stored CSR style.
+
+    Rows are records and columns are variant sites (sorted 1-based positions). Every stored
+    entry has a code into `variants`, the table of distinct variant strings ('23403:AG',
+    '100:del3'), and flags marking ambiguities and indels. The entries of each row hold
+    its snps in position order followed by its ambiguities.
+
+    Matrices are never modified in place: filtering sites and reordering records return
+    new matrices, so one built from cached variants can be shared between plots.
+    """
+
+    def __init__(self, records, sites, indptr, columns, codes, flags, variants):
+        self.records = list(records)
+        self.sites = sites
+        self.indptr = indptr
+        self.columns = columns
+        self.codes = codes
+        self.flags = flags
+        self.variants = variants
+        self._rows = None
+
+    @classmethod
+    def from_calls(cls, row_records, indptr, positions, keys, flags):
+        """
+        Build the matrix straight from called variants. Each call row is one unique
+        sequence, with its entries (1-based positions, variant keys and flags) between
+        indptr[i] and indptr[i+1], and is copied into a row for each of its row_records.
+        Codes are numbered in the order the keys are first met.
+        """
+        records = [record for records in row_records for record in records]
+        calls = np.repeat(np.arange(len(row_records)), [len(records) for records in row_records])
+        lengths = np.diff(indptr)[calls]
+        row_indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        entries = np.arange(row_indptr[-1]) + np.repeat(indptr[calls] - row_indptr[:-1], lengths)
+
+        distinct, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        variants = [key_variant(key) for key in distinct[order].tolist()]
+
+        sites = np.unique(positions[entries])
+        return cls(records,
+                   sites,
+                   row_indptr,
+                   np.searchsorted(sites, positions[entries]),
+                   rank[inverse.reshape(-1)][entries],
+                   flags[entries].astype(np.uint8),
+                   variants)
+
+    @classmethod
+    def from_records(cls, record_snps, record_ambs=None):
+        """
+        Build the matrix from record -> variant string list dicts, which make_graph still
+        accepts. Records that share a list only have it encoded once.
+        """
+        records = list(record_snps)
+        record_ambs = record_ambs or {}
+        variant_codes = {}
+        variants = []
+        encoded = {}
+
+        def encode(variant_list, ambiguous):
+            key = (id(variant_list), ambiguous)
+            if key not in encoded:
+                positions = []
+                codes = []
+                flags = []
+                for variant in variant_list:
+                    code = variant_codes.get(variant)
+                    if code is None:
+                        code = variant_codes[variant] = len(variants)
+                        variants.append(variant)
+                    positions.append(int(variant.split(":")[0]))
+                    codes.append(code)
+                    flags.append(AMBIGUITY if ambiguous else variant_flag(variant))
+                encoded[key] = (positions, codes, flags)
+            return encoded[key]
+
+        positions = []
+        codes = []
+        flags = []
+        indptr = np.zeros(len(records) + 1, dtype=np.int64)
+        for i, record in enumerate(records):
+            count = 0
+            for variant_list, ambiguous in ((record_snps[record], False), (record_ambs.get(record, ()), True)):
+                row_positions, row_codes, row_flags = encode(variant_list, ambiguous)
+                positions.extend(row_positions)
+                codes.extend(row_codes)
+                flags.extend(row_flags)
+                count += len(row_positions)
+            indptr[i + 1] = indptr[i] + count
+
+        positions = np.array(positions, dtype=np.int64)
+        sites = np.unique(positions)
+        return cls(records,
+                   sites,
+                   indptr,
+                   np.searchsorted(sites, positions),
+                   np.array(codes, dtype=np.int64),
+                   np.array(flags, dtype=np.uint8),
+                   variants)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def num_sites(self):
+        return len(self.sites)
+
+    def row_of(self, record):
+        if self._rows is None:
+            self._rows = {record: i for i, record in enumerate(self.records)}
+        return self._rows[record]
+
+    def row_entries(self, row):
+        return slice(self.indptr[row], self.indptr[row + 1])
+
+    def record_variants(self, record, ambiguities=False):
+        """The variant strings of one record: its snps and indels, or its ambiguities."""
+        entries = self.row_entries(self.row_of(record))
+        ambiguous = (self.flags[entries] & AMBIGUITY) != 0
+        keep = ambiguous if ambiguities else ~ambiguous
+        return [self.variants[code] for code in self.codes[entries][keep].tolist()]
+
+    def distinct_variants(self):
+        """Every distinct snp and indel string still in the matrix (ambiguities excluded)."""
+        codes = np.unique(self.codes[(self.flags & AMBIGUITY) == 0])
+        return [self.variants[code] for code in codes.tolist()]
+
+    @property
+    def num_snps(self):
+        return len(np.unique(self.codes[(self.flags & AMBIGUITY) == 0]))
+
+    def entry_rows(self):
+        """Row index of every stored entry."""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def row_counts(self):
+        """Number of snps and indels in each row."""
+        called = (self.flags & AMBIGUITY) == 0
+        return np.bincount(self.entry_rows()[called], minlength=len(self))
+
+    def site_counts(self):
+        """Number of records carrying a snp or indel at each site, ambiguities excluded."""
+        called = (self.flags & AMBIGUITY) == 0
+        rows = self.entry_rows()[called]
+        # a record is counted once per site, even with several variants there
+        pairs = np.unique(rows * max(self.num_sites, 1) + self.columns[called])
+        return np.bincount(pairs % max(self.num_sites, 1), minlength=self.num_sites)
+
+    def variant_counts(self):
+        """Number of records carrying each distinct snp or indel string."""
+        codes = self.codes[(self.flags & AMBIGUITY) == 0]
+        counts = np.bincount(codes, minlength=len(self.variants))
+        return collections.Counter({self.variants[code]: int(counts[code]) for code in np.flatnonzero(counts).tolist()})
+
+    def ambiguous_sites(self):
+        """Sites where any record has an ambiguity."""
+        return self.sites[np.unique(self.columns[(self.flags & AMBIGUITY) != 0])]
+
+    def called_sites(self):
+        """Sites where any record has a snp or indel."""
+        return self.sites[np.unique(self.columns[(self.flags & AMBIGUITY) == 0])]
+
+    def select_sites(self, keep):
+        """New matrix with only the columns where the boolean mask keep is set."""
+        keep = np.asarray(keep, dtype=bool)
+        entries = keep[self.columns]
+        new_columns = np.cumsum(keep) - 1
+        kept_per_row = np.bincount(self.entry_rows()[entries], minlength=len(self))
+        indptr = np.concatenate(([0], np.cumsum(kept_per_row)))
+        return VariantMatrix(self.records, self.sites[keep], indptr,
+                             new_columns[self.columns[entries]], self.codes[entries],
+                             self.flags[entries], self.variants)
+
+    def reorder(self, records):
+        """New matrix with its rows in the order of the given record ids."""
+        rows = np.array([self.row_of(record) for record in records], dtype=np.int64)
+        lengths = np.diff(self.indptr)[rows]
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        # each new row copies a contiguous run of the old entries
+        entries = np.arange(indptr[-1]) + np.repeat(self.indptr[rows] - indptr[:-1], lengths)
+        return VariantMatrix(records, self.sites, indptr,
+                             self.columns[entries], self.codes[entries],
+                             self.flags[entries], self.variants)
+
+    def by_site(self):
+        """
+        Yield (site, rows, codes, flags) for each column in position order, with the
+        column's entries in row order.
+        """
+        order = np.argsort(self.columns, kind="stable")
+        rows = self.entry_rows()[order]
+        colptr = np.concatenate(([0], np.cumsum(np.bincount(self.columns, minlength=self.num_sites))))
+        codes = self.codes[order]
+        flags = self.flags[order]
+        for column, site in enumerate(self.sites.tolist()):
+            entries = slice(colptr[column], colptr[column + 1])
+            yield site, rows[entries], codes[entries], flags[entries]
+
+
+class SharedVariantMatrix:
+    """
+    A VariantMatrix copied into shared memory, so that worker processes attach to it by
+    name instead of each being sent a pickled copy.
+
+    The arrays are copied as they are, and the record and variant strings as newline
+    separated utf-8 blocks. Use as a context manager, so the shared blocks are freed
+    once the workers are done.
+    """
+
+    ARRAYS = ("sites", "indptr", "columns", "codes", "flags")
+
+    def __init__(self, variants):
+        self.blocks = []
+        self.handle = {"num_records": len(variants.records), "num_variants": len(variants.variants)}
+        for name in self.ARRAYS:
+            self.handle[name] = self._share(np.ascontiguousarray(getattr(variants, name)))
+        for name in ("records", "variants"):
+            text = "\n".join(getattr(variants, name)).encode("utf-8")
+            self.handle[name] = self._share(np.frombuffer(text, dtype=np.uint8))
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach_block(name):
+    try:
+        # python 3.13+: the creating process alone is responsible for unlinking
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def attach_shared_matrix(handle):
+    """
+    The VariantMatrix described by a SharedVariantMatrix handle, for use in a worker process.
+    Its arrays are views of the shared blocks, which are returned too and must be kept open
+    for as long as the matrix is used.
+    """
+    blocks = []
+    arrays = {}
+    for name in SharedVariantMatrix.ARRAYS + ("records", "variants"):
+        block_name, shape, dtype = handle[name]
+        block = _attach_block(block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    records = arrays["records"].tobytes().decode("utf-8").split("\n") if handle["num_records"] else []
+    variants = arrays["variants"].tobytes().decode("utf-8").split("\n") if handle["num_variants"] else []
+    return VariantMatrix(records, arrays["sites"], arrays["indptr"], arrays["columns"],
+                         arrays["codes"], arrays["flags"], variants), blocks
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+# imports of built-ins
+import os
+import io
+import re
+import gzip
+import struct
+
+# imports from other modules
+import numpy as np
+
+# imports from this module
+from snipit.scripts.positions import open_text
+from snipit.scripts.variant_matrix import VariantMatrix, AMBIGUITY, INSERTION, DELETION, variant_keys, SNP_KEY, INSERTION_KEY, DELETION_KEY
+
+VCF_EXTENSIONS = (".vcf", ".vcf.gz", ".vcf.bgz")
+
+# tabix linear index windows are 16 kb
+TABIX_WINDOW_SHIFT = 14
+
+GT_SEPARATOR = re.compile(r"[/|]")
+CONTIG_LENGTH = re.compile(r"##contig=<.*?ID=([^,>]+).*?length=(\d+)")
+
+IUPAC_CODES = {frozenset("AG"): "R", frozenset("CT"): "Y", frozenset("CG"): "S",
+               frozenset("AT"): "W", frozenset("GT"): "K", frozenset("AC"): "M",
+               frozenset("CGT"): "B", frozenset("AGT"): "D", frozenset("ACT"): "H",
+               frozenset("ACG"): "V"}
+
+
+def is_vcf(path):
+    return path.lower().endswith(VCF_EXTENSIONS)
+
+
+def parse_region(region):
+    """'chrom', 'chrom:start' or 'chrom:start-end' (1-based, inclusive) -> (chrom, start, end)."""
+    chrom, _, span = region.partition(":")
+    if not chrom:
+        raise ValueError(f"no chromosome in region {region}")
+    if not span:
+        return chrom, 1, None
+    start, _, end = span.replace(",", "").partition("-")
+    start = int(start)
+    end = int(end) if end else None
+    if start < 1 or (end is not None and end < start):
+        raise ValueError(f"invalid region {region}")
+    return chrom, start, end
+
+
+def read_header(vcf_file):
+    """Sample names and contig lengths from a VCF header."""
+    samples = []
+    contig_lengths = {}
+    with open_text(vcf_file) as f:
+        for line in f:
+            if line.startswith("##"):
+                match = CONTIG_LENGTH.match(line)
+                if match:
+                    contig_lengths[match.group(1)] = int(match.group(2))
+            elif line.startswith("#CHROM"):
+                samples = line.rstrip("\n").split("\t")[9:]
+                break
+            else:
+                raise ValueError("no #CHROM header line")
+    return samples, contig_lengths
+
+
+def tabix_offset(index_file, chrom, start):
+    """
+    Virtual file offset to start reading from for records at or after a 1-based start,
+    using the linear index of a tabix (.tbi) file. Returns None if the chromosome isn't indexed.
+    """
+    with gzip.open(index_file, "rb") as f:
+        data = f.read()
+    if data[:4] != b"TBI\x01":
+        raise ValueError(f"{index_file} is not a tabix index")
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].split(b"\x00")[:n_ref]
+    offset = 36 + l_nm
+
+    for name in names:
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        for _ in range(n_bin):
+            n_chunk = struct.unpack_from("<Ii", data, offset)[1]
+            offset += 8 + 16 * n_chunk
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        if name.decode() == chrom:
+            if n_intv == 0:
+                return None
+            window = min((start - 1) >> TABIX_WINDOW_SHIFT, n_intv - 1)
+            return struct.unpack_from("<Q", data, offset + 8 * window)[0]
+        offset += 8 * n_intv
+    return None
+
+
+def _open_at(vcf_file, virtual_offset):
+    """Text stream over a bgzip file starting at a tabix virtual offset."""
+    raw = open(vcf_file, "rb")
+    raw.seek(virtual_offset >> 16)
+    stream = gzip.GzipFile(fileobj=raw)
+    stream.read(virtual_offset & 0xFFFF)
+    return io.TextIOWrapper(stream)
+
+
+def iter_records(vcf_file, region=None):
+    """
+    Stream the data lines of a VCF as lists of fields, optionally restricted to a region.
+    With a bgzip file and a tabix index next to it, reading starts at the region rather
+    than the top of the file.
+    """
+    chrom = start = end = None
+    f = None
+    if region is not None:
+        chrom, start, end = parse_region(region)
+        if os.path.exists(vcf_file + ".tbi"):
+            virtual_offset = tabix_offset(vcf_file + ".tbi", chrom, start)
+            if virtual_offset is None:
+                return
+            f = _open_at(vcf_file, virtual_offset)
+    if f is None:
+        f = open_text(vcf_file)
+
+    with f:
+        seen_chrom = False
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if chrom is not None:
+                if fields[0] != chrom:
+                    # records are sorted, so once past the chromosome there's nothing more to read
+                    if seen_chrom:
+                        break
+                    continue
+                seen_chrom = True
+                pos = int(fields[1])
+                if end is not None and pos > end:
+                    break
+                if pos + len(fields[3]) - 1 < start:
+                    continue
+            yield fields
+
+
+def allele_variants(pos, ref, alt, show_indels):
+    """
+    The (position, variant key, flags) of each variant of one ALT allele against REF.
+    MNPs become one snp per changed base; indels are anchored on the shared leading base.
+    Symbolic and complex alleles give no variants.
+    """
+    if alt.startswith("<") or alt in ("*", ".") or "[" in alt or "]" in alt:
+        return []
+    # trim the bases shared at the start, as VCF indels carry an anchor base
+    shared = 0
+    while shared < min(len(ref), len(alt)) and ref[shared] == alt[shared]:
+        shared += 1
+    if len(ref) == len(alt):
+        return [(pos+i, int(variant_keys(pos+i, SNP_KEY, (ord(ref[i]) << 8) | ord(alt[i]))), 0)
+                for i in range(len(ref)) if ref[i] != alt[i]]
+    if not show_indels or shared < min(len(ref), len(alt)):
+        return []
+    if len(ref) > len(alt):
+        return [(pos+shared, int(variant_keys(pos+shared, DELETION_KEY, len(ref)-len(alt))), DELETION)]
+    return [(pos+shared, int(variant_keys(pos+shared, INSERTION_KEY, len(alt)-len(ref))), INSERTION)]
+
+
+def vcf_variants(vcf_file, region=None, show_indels=False, ambig_mode="snps", positions=None):
+    """
+    Call snipit's variant matrix straight from the genotypes of a multi-sample VCF,
+    streaming one record at a time.
+
+    Haploid or homozygous calls of an ALT allele are variants. Heterozygous snp calls
+    become IUPAC ambiguity codes and missing calls become N, as ambiguities at that site.
+    As with find_ambiguities, ambiguities are only kept at sites where some sample has a
+    called variant, unless ambig_mode is 'all'.
+    Each sample's row holds its snps and indels in position order, then its ambiguities.
+
+    Returns a dict with keys: samples, chrom, length and variants.
+    """
+    samples, contig_lengths = read_header(vcf_file)
+    if not samples:
+        raise ValueError("the VCF has no sample columns")
+
+    # (position, variant key, flags) of each sample's calls
+    snps = [[] for _ in samples]
+    ambs = [[] for _ in samples]
+    # positions with a called variant in any sample
+    variant_sites = set()
+    chrom = None
+    last_base = 0
+
+    for fields in iter_records(vcf_file, region):
+        if chrom is None:
+            chrom = fields[0]
+        elif fields[0] != chrom:
+            raise ValueError(f"records for more than one chromosome ({chrom}, {fields[0]}), choose one with --region")
+
+        pos = int(fields[1])
+        ref = fields[3].upper()
+        last_base = max(last_base, pos + len(ref) - 1)
+        if positions and not positions.keeps(pos):
+            continue
+
+        alts = fields[4].upper().split(",")
+        allele_changes = [[]] + [allele_variants(pos, ref, alt, show_indels) for alt in alts]
+        allele_bases = [ref] + alts
+        format_keys = fields[8].split(":") if len(fields) > 8 else []
+        # records without genotypes have nothing to call
+        if "GT" not in format_keys:
+            continue
+        gt_index = format_keys.index("GT")
+
+        for i, sample in enumerate(fields[9:]):
+            sample_fields = sample.split(":")
+            # trailing sample fields may be dropped, which leaves the genotype missing
+            gt = sample_fields[gt_index] if gt_index < len(sample_fields) else "."
+            called = set(GT_SEPARATOR.split(gt))
+            if "." in called:
+                ambiguity = "N"
+            elif len(called) == 1:
+                changes = allele_changes[int(called.pop())]
+                snps[i].extend(changes)
+                variant_sites.update(change[0] for change in changes)
+                continue
+            else:
+                bases = {allele_bases[int(allele)][0] for allele in called if len(allele_bases[int(allele)]) == 1}
+                ambiguity = IUPAC_CODES.get(frozenset(bases), "N") if len(bases) == len(called) else "N"
+            key = int(variant_keys(pos, SNP_KEY, (ord(ref[0]) << 8) | ord(ambiguity)))
+            ambs[i].append((pos, key, AMBIGUITY))
+            if ambig_mode == "all":
+                # as with alignments, ambiguity codes also count as snps in 'all' mode
+                snps[i].append((pos, key, 0))
+
+    if ambig_mode != "all":
+        ambs = [[amb for amb in sample_ambs if amb[0] in variant_sites] for sample_ambs in ambs]
+
+    entries = []
+    indptr = [0]
+    for sample_snps, sample_ambs in zip(snps, ambs):
+        entries += sorted(sample_snps, key=lambda entry: entry[0]) + sorted(sample_ambs, key=lambda entry: entry[0])
+        indptr.append(len(entries))
+    positions, keys, flags = (np.array([entry[i] for entry in entries], dtype=np.int64) for i in range(3))
+    variants = VariantMatrix.from_calls([[sample] for sample in samples], np.array(indptr, dtype=np.int64),
+                                        positions, keys, flags.astype(np.uint8))
+
+    length = contig_lengths.get(chrom) if chrom is not None else None
+    if length is None and region is not None:
+        length = contig_lengths.get(parse_region(region)[0])
+
+    return {"samples": samples,
+            "chrom": chrom,
+            "length": length or last_base,
+            "variants": variants}
+
+
+def _anchor_base(reference_seq, pos):
+    """Reference base at a 1-based position, or N where there isn't a called one."""
+    base = reference_seq[pos-1].upper() if reference_seq and 0 < pos <= len(reference_seq) else "N"
+    return base if base in "ACGT" else "N"
+
+
+def reference_positions(reference_seq):
+    """
+    Map alignment columns onto the ungapped reference: entry c is the number of reference
+    bases in columns 1 to c, so a column with a reference base maps to that base's 1-based
+    position and a gap column to the base before it.
+    """
+    row = np.frombuffer(str(reference_seq).upper().encode("ascii"), dtype=np.uint8)
+    return np.concatenate(([0], np.cumsum(row != ord("-"))))
+
+
+def _indel_line(variant, reference_seq, positions=None):
+    """
+    (POS, REF, ALT, INFO) for an indel variant string, anchored on the preceding reference base.
+    reference_seq is the ungapped reference and positions maps columns onto it (see
+    reference_positions), or None where variant positions are already reference positions.
+    """
+    column, var = variant.split(":")
+    column = int(column)
+    size = int(var[3:])
+    # the reference base before the indel, 0 if it starts the reference
+    before = int(positions[column-1]) if positions is not None else column - 1
+    anchor = max(before, 1)
+    if var.startswith("del"):
+        deleted = str(reference_seq[before:before+size]).upper() if reference_seq else ""
+        if before > 0 and len(deleted) == size and all(base in "ACGT" for base in deleted) and _anchor_base(reference_seq, anchor) != "N":
+            base = _anchor_base(reference_seq, anchor)
+            return anchor, base + deleted, base, "."
+        return anchor, _anchor_base(reference_seq, anchor), "<DEL>", f"SVTYPE=DEL;SVLEN=-{size};END={before+size}"
+    # only the length of an insertion is known, not its bases
+    return anchor, _anchor_base(reference_seq, anchor), "<INS>", f"SVTYPE=INS;SVLEN={size}"
+
+
+def write_vcf(variants, output_file, chrom, reference_seq="", length=None):
+    """
+    Write a VariantMatrix as a multi-sample, haploid VCF with one genotype column per record.
+
+    Each site gets one line for its snps (multi-allelic if records differ) and one line per
+    distinct indel. Deletions are written with their reference bases where the reference
+    sequence has them, otherwise, like insertions, as symbolic alleles. Records ambiguous
+    at a site, or with an ambiguity code called as a snp, get a missing genotype.
+
+    Variant positions are alignment columns. Where reference_seq (the aligned reference,
+    gaps included) is given they are written as positions in the ungapped reference, with
+    REF bases and the contig length taken from it, so the VCF lines up with the reference
+    sequence rather than the alignment.
+
+    Lines are streamed from the matrix's columns and genotypes are written into one reused
+    byte buffer, so nothing per record is built in memory.
+    """
+    num_records = len(variants)
+    # '0' genotypes separated by tabs, refilled for every line
+    genotypes = np.full(max(2 * num_records - 1, 0), ord("\t"), dtype=np.uint8)
+    missing = ord(".")
+
+    positions = None
+    if reference_seq:
+        positions = reference_positions(reference_seq)
+        reference_seq = str(reference_seq).upper().replace("-", "")
+        length = len(reference_seq)
+
+    with open(output_file, "w") as fw:
+        fw.write("##fileformat=VCFv4.2\n")
+        fw.write("##source=snipit\n")
+        fw.write(f"##contig=<ID={chrom}{f',length={length}' if length else ''}>\n")
+        fw.write('##INFO=<ID=AC,Number=A,Type=Integer,Description="Number of records carrying each ALT allele">\n')
+        fw.write('##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of symbolic allele">\n')
+        fw.write('##INFO=<ID=SVLEN,Number=1,Type=Integer,Description="Length of the inserted or deleted sequence">\n')
+        fw.write('##INFO=<ID=END,Number=1,Type=Integer,Description="End position of a symbolic deletion">\n')
+        fw.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        fw.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + variants.records) + "\n")
+
+        for site, rows, codes, flags in variants.by_site():
+            ambiguous = rows[(flags & AMBIGUITY) != 0]
+            called = (flags & AMBIGUITY) == 0
+            snps = called & ((flags & (INSERTION | DELETION)) == 0)
+
+            lines = []
+            snp_codes = np.unique(codes[snps])
+            if len(snp_codes):
+                ref = variants.variants[snp_codes[0]].split(":")[1][0]
+                alts = []
+                allele_of_code = {}
+                for code in snp_codes.tolist():
+                    alt = variants.variants[code].split(":")[1][1]
+                    if alt in "ACGT":
+                        if alt not in alts:
+                            alts.append(alt)
+                        allele_of_code[code] = alts.index(alt) + 1
+                    else:
+                        allele_of_code[code] = None
+                pos = int(positions[site]) if positions is not None else site
+                lines.append((pos, ref, alts, ".", snps, allele_of_code))
+            for code in np.unique(codes[called & ~snps]).tolist():
+                pos, ref, alt, info = _indel_line(variants.variants[code], reference_seq, positions)
+                lines.append((pos, ref, [alt], info, called & (codes == code), {code: 1}))
+
+            for pos, ref, alts, info, entries, allele_of_code in lines:
+                if not alts:
+                    continue
+                genotypes[0::2] = ord("0")
+                allele_counts = [0] * len(alts)
+                for row, code in zip(rows[entries].tolist(), codes[entries].tolist()):
+                    allele = allele_of_code[code]
+                    if allele is None:
+                        genotypes[2 * row] = missing
+                    else:
+                        genotypes[2 * row] = ord("0") + allele
+                        allele_counts[allele - 1] += 1
+                genotypes[2 * ambiguous] = missing
+                ac = "AC=" + ",".join(str(count) for count in allele_counts)
+                info = ac if info == "." else f"{ac};{info}"
+                fw.write(f"{chrom}\t{pos}\t.\t{ref}\t{','.join(alts)}\t.\t.\t{info}\tGT\t")
+                fw.write(genotypes.tobytes().decode("ascii"))
+                fw.write("\n")
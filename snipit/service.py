@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+snipit-mc asynchronous rendering service
+
+This module wraps the Python API for use from asyncio applications such as web
+dashboards. Parsing, SNP calling and rendering run in a pool of worker processes
+so the event loop is never blocked, and identical requests that arrive while a
+plot is already being made share the one computation.
+
+Example usage:
+    import asyncio
+    from snipit.service import snipit_plot_async
+
+    result = asyncio.run(snipit_plot_async("alignment.fasta", colour_palette="nature"))
+
+A small local HTTP endpoint is also provided:
+    python -m snipit.service --port 8765
+
+    curl -X POST localhost:8765/plot \\
+         -d '{"alignment": "alignment.fasta", "config": {"colour_palette": "nature"}}'
+
+Plots requested over HTTP are always written inside the server's --output-dir.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Union, Dict, Any, Tuple
+
+from snipit.api import snipit_plot, SnipitConfig, get_color_palettes
+from snipit.scripts.variant_cache import file_identity
+
+# config fields that can name input files, whose contents matter as much as the alignment's
+INPUT_FILE_FIELDS = ("reference", "labels", "genbank", "mask_bed", "mask_vcf")
+# config fields naming where files are written, which HTTP clients only get to choose
+# within the server's output directory
+OUTPUT_DIR_FIELDS = ("output_dir", "profile_trace")
+
+
+def _render(alignment_file: str, config: SnipitConfig) -> Dict[str, Any]:
+    """Run one plot in a worker process."""
+    try:
+        return snipit_plot(alignment_file, config=config)
+    except SystemExit as e:
+        # input errors in snipit exit the process, which would otherwise kill the worker
+        return {
+            'success': False,
+            'output_files': [],
+            'config': config,
+            'error': f"snipit exited with status {e.code}",
+            'message': f"Failed to generate plot: snipit exited with status {e.code}"
+        }
+
+
+def _resolve_config(config: Optional[SnipitConfig], kwargs: Dict[str, Any]) -> SnipitConfig:
+    """Copy the config with any keyword overrides applied, leaving the caller's config untouched."""
+    config = dataclasses.replace(config) if config is not None else SnipitConfig()
+    for key, value in kwargs.items():
+        if hasattr(config, key):
+            setattr(config, key, value)
+        else:
+            raise ValueError(f"Unknown parameter: {key}")
+    return config
+
+
+def _request_key(alignment_path: Path, config: SnipitConfig) -> Tuple:
+    """
+    Identical input files on disk plus identical configuration means identical output.
+    Besides the alignment, every config field naming a file (reference, labels, genbank
+    and masks) counts by its identity on disk; a reference given as a sequence id isn't a
+    file, and only counts through the configuration.
+    """
+    stat = alignment_path.stat()
+    input_files = tuple(file_identity(getattr(config, field), os.getcwd()) if getattr(config, field) else None
+                        for field in INPUT_FILE_FIELDS)
+    return (str(alignment_path), stat.st_mtime_ns, stat.st_size, input_files,
+            json.dumps(dataclasses.asdict(config), sort_keys=True, default=str))
+
+
+class SnipitService:
+    """
+    Renders snipit plots in a process pool, coalescing identical concurrent requests.
+
+    Args:
+        max_workers (int, optional): Number of worker processes. Default: number of CPUs
+
+    Example:
+        >>> async with SnipitService(max_workers=4) as service:
+        ...     result = await service.plot("alignment.fasta", colour_palette="monet")
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+        self._executor = None
+        self._inflight = {}
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def plot(
+        self,
+        alignment_file: Union[str, Path],
+        config: Optional[SnipitConfig] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Generate a plot without blocking the event loop.
+
+        Takes the same arguments as `snipit_plot` and returns the same result dict.
+        """
+        alignment_path = Path(alignment_file).resolve()
+        if not alignment_path.exists():
+            raise FileNotFoundError(f"Alignment file not found: {alignment_file}")
+
+        config = _resolve_config(config, kwargs)
+        key = _request_key(alignment_path, config)
+
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, _render, str(alignment_path), config)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _f, key=key: self._inflight.pop(key, None))
+
+        # shield so that one caller being cancelled doesn't cancel the plot for everyone else
+        return await asyncio.shield(future)
+
+    def close(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+_default_service = None
+
+
+def _get_default_service() -> SnipitService:
+    global _default_service
+    if _default_service is None:
+        _default_service = SnipitService()
+    return _default_service
+
+
+async def snipit_plot_async(
+    alignment_file: Union[str, Path],
+    config: Optional[SnipitConfig] = None,
+    **kwargs
+) -> Dict[str, Any]:
+    """
+    Asynchronous version of `snipit_plot` backed by a shared process pool.
+
+    Example:
+        >>> result = await snipit_plot_async("alignment.fasta", colour_palette="nature")
+        >>> print(result['output_files'])
+    """
+    return await _get_default_service().plot(alignment_file, config=config, **kwargs)
+
+
+def _json_default(obj):
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    return str(obj)
+
+
+async def _write_response(writer, status: int, payload: Dict[str, Any]):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+    body = json.dumps(payload, default=_json_default).encode()
+    head = (f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n")
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+
+def _pin_outputs(config: Dict[str, Any], output_root: Path) -> Dict[str, Any]:
+    """
+    Copy an HTTP request's config with its output paths resolved inside output_root, so a
+    client can't have the service write anywhere else on the machine.
+    Raises ValueError for paths that would leave it.
+    """
+    config = dict(config)
+    for field in OUTPUT_DIR_FIELDS:
+        if field == "output_dir" or config.get(field):
+            path = (output_root / str(config.get(field) or "")).resolve()
+            if path != output_root and output_root not in path.parents:
+                raise ValueError(f"{field} must be inside the service's output directory")
+            config[field] = str(path)
+    output_file = str(config.get("output_file", SnipitConfig.output_file))
+    if os.path.basename(output_file) != output_file or output_file in ("", ".", ".."):
+        raise ValueError("output_file must be a file name, without a directory")
+    return config
+
+
+async def _handle_request(service: SnipitService, reader, writer, output_root: Path):
+    try:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return
+        method, path = request_line.split(" ")[:2]
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if path == "/health":
+            await _write_response(writer, 200, {'status': 'ok'})
+        elif path == "/palettes":
+            await _write_response(writer, 200, get_color_palettes())
+        elif path == "/plot":
+            if method != "POST":
+                await _write_response(writer, 405, {'error': "use POST for /plot"})
+                return
+            try:
+                request = json.loads(body or b"{}")
+                config = _pin_outputs(request.get("config", {}), output_root)
+                result = await service.plot(request["alignment"], **config)
+            except (KeyError, ValueError, TypeError, FileNotFoundError) as e:
+                await _write_response(writer, 400, {'success': False, 'error': str(e)})
+                return
+            await _write_response(writer, 200 if result['success'] else 500, result)
+        else:
+            await _write_response(writer, 404, {'error': f"unknown path {path}"})
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        await _write_response(writer, 400, {'error': f"malformed request: {e}"})
+    except Exception as e:
+        # e.g. a broken process pool, the client still gets an answer rather than a dropped connection
+        try:
+            await _write_response(writer, 500, {'success': False, 'error': f"internal error: {e}"})
+        except ConnectionError:
+            pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str = "127.0.0.1", port: int = 8765, max_workers: Optional[int] = None,
+                output_dir: Optional[Union[str, Path]] = None):
+    """
+    Serve plots over HTTP until cancelled. Plots are written inside output_dir (default:
+    the current directory); a request's output_dir is taken relative to it.
+
+    Endpoints:
+        POST /plot      JSON body {"alignment": path, "config": {SnipitConfig fields}}
+        GET  /palettes  available colour palettes
+        GET  /health    liveness check
+    """
+    output_root = Path(output_dir or os.getcwd()).resolve()
+    async with SnipitService(max_workers=max_workers) as service:
+        server = await asyncio.start_server(
+            lambda reader, writer: _handle_request(service, reader, writer, output_root), host, port)
+        async with server:
+            print(f"snipit service listening on http://{host}:{port}")
+            await server.serve_forever()
+
+
+def main(sysargs=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog="snipit-service", description="Serve snipit plots over HTTP")
+    parser.add_argument("--host", action="store", default="127.0.0.1", help="Address to bind. Default: 127.0.0.1")
+    parser.add_argument("--port", action="store", type=int, default=8765, help="Port to listen on. Default: 8765")
+    parser.add_argument("--workers", action="store", type=int, default=None, dest="workers",
+                        help="Number of rendering processes. Default: number of CPUs")
+    parser.add_argument("--output-dir", action="store", default=None, dest="output_dir",
+                        help="Directory every plot is written inside. Default: the current directory")
+    args = parser.parse_args(sysargs)
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, args.output_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
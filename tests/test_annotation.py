@@ -0,0 +1,81 @@
+import random
+
+from snipit.scripts.annotation import FeatureIndex, annotate_variant, codon_change, in_parts
+
+
+def feature(name, start, end, strand=1, parts=None, feature_type="CDS"):
+    return {"start": start, "end": end, "strand": strand, "type": feature_type, "name": name,
+            "parts": parts or [[start, end]]}
+
+
+def brute_force(features, position):
+    return sorted((f for f in features if f["start"] <= position < f["end"] and in_parts(f, position)),
+                  key=lambda f: (f["start"], f["end"]))
+
+
+def test_nested_long_feature_does_not_hide_later_genes():
+    # a source-length polyprotein containing every other gene
+    features = [feature("polyprotein", 0, 10000)] + \
+               [feature(f"g{i}", i * 100, i * 100 + 50) for i in range(100)]
+    index = FeatureIndex(features)
+
+    assert [f["name"] for f in index.overlapping(9925)] == ["polyprotein", "g99"]
+    assert [f["name"] for f in index.overlapping(9975)] == ["polyprotein"]
+    assert index.gene_at(5010) == "polyprotein"
+    assert index.overlapping(10000) == []
+    assert index.gene_at(10000) is None
+
+
+def test_features_nested_in_an_intron_are_found():
+    features = [feature("spliced", 0, 100, parts=[[0, 10], [90, 100]]),
+                feature("inner", 40, 60)]
+    index = FeatureIndex(features)
+
+    assert [f["name"] for f in index.overlapping(50)] == ["inner"]
+    assert [f["name"] for f in index.overlapping(5)] == ["spliced"]
+    assert index.overlapping(20) == []
+
+
+def test_overlapping_matches_a_linear_scan():
+    rng = random.Random(1)
+    features = []
+    for i in range(300):
+        start = rng.randrange(0, 5000)
+        end = start + rng.choice([1, 10, 300, 4000])
+        if rng.random() < 0.2:
+            middle = (start + end) // 2
+            parts = [[start, middle - (end - start) // 4], [middle, end]]
+        else:
+            parts = None
+        features.append(feature(f"f{i}", start, end, parts=parts))
+    index = FeatureIndex(features)
+
+    assert len(index) == len(features)
+    for position in range(0, 9100, 7):
+        assert index.overlapping(position) == brute_force(features, position)
+
+
+def test_codon_change_on_the_minus_strand():
+    # reverse complement of ATG GAT TAA
+    reference = "TTAATCCAT"
+    cds = feature("orf", 0, 9, strand=-1)
+    # the last genome base is the first base of codon 1
+    assert codon_change(cds, 8, "C", reference) == (1, 1, "M", "V")
+    # codon 2 is GAT (D), changing its last base to C gives GAC, still D
+    assert codon_change(cds, 3, "G", reference) == (2, 3, "D", "D")
+
+
+def test_annotate_variant_across_a_splice_junction():
+    # ATG|GA ... intron ... T|TAA, codon 2 is split across the two exons
+    reference = "ATGGA" + "CCCCC" + "TTAA"
+    cds = feature("orf", 0, 14, parts=[[0, 5], [10, 14]])
+    index = FeatureIndex([cds, feature("gene", 0, 14, feature_type="gene")])
+
+    annotation = annotate_variant("11:TG", index, reference)
+    assert annotation["gene"] == "orf"
+    assert annotation["consequence"] == "D2E"
+    assert annotation["synonymous"] is False
+
+    # the intron is only covered by the gene feature
+    assert annotate_variant("7:CA", index, reference)["consequence"] is None
+    assert annotate_variant("20:CA", index, reference) is None
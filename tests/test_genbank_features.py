@@ -0,0 +1,53 @@
+import pytest
+
+from snipit.scripts.genbank_features import parse_location, parse_feature_table
+
+
+@pytest.mark.parametrize("location, expected", [
+    ("266..805", ([(265, 805)], 1)),
+    ("<1..>60", ([(0, 60)], 1)),
+    ("467", ([(466, 467)], 1)),
+    ("123^124", ([(122, 123)], 1)),
+    ("complement(100..200)", ([(99, 200)], -1)),
+    ("join(266..13468,13468..21555)", ([(265, 13468), (13467, 21555)], 1)),
+    ("complement(join(10..20,30..40))", ([(29, 40), (9, 20)], -1)),
+    ("join(complement(30..40),complement(10..20))", ([(29, 40), (9, 20)], -1)),
+    ("join(J00194.1:100..202,1..50)", ([(0, 50)], 1)),
+])
+def test_parse_location(location, expected):
+    assert parse_location(location) == expected
+
+
+GENBANK = """\
+LOCUS       ref                      120 bp    DNA     linear   VRL 01-JAN-2020
+FEATURES             Location/Qualifiers
+     source          1..120
+     gene            10..40
+                     /gene="orf1"
+     CDS             join(10..20,
+                     30..40)
+                     /gene="orf1"
+                     /product="a very long product name indeed"
+     CDS             complement(60..90)
+                     /locus_tag="T_1"
+ORIGIN
+        1 acgtacgtac gtacgtacgt
+//
+LOCUS       other                     10 bp    DNA     linear   VRL 01-JAN-2020
+//
+"""
+
+
+def test_parse_feature_table(tmp_path):
+    genbank = tmp_path / "ref.gb"
+    genbank.write_text(GENBANK)
+
+    table = parse_feature_table(str(genbank), with_sequence=True)
+    assert table["records"] == 2
+    assert table["length"] == 120
+    assert table["sequence"] == "ACGTACGTACGTACGTACGT"
+    assert table["features"] == [
+        {"start": 9, "end": 40, "strand": 1, "type": "gene", "name": "orf1", "parts": [[9, 40]]},
+        {"start": 9, "end": 40, "strand": 1, "type": "CDS", "name": "orf1", "parts": [[9, 20], [29, 40]]},
+        {"start": 59, "end": 90, "strand": -1, "type": "CDS", "name": "T_1", "parts": [[59, 90]]},
+    ]
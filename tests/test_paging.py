@@ -0,0 +1,104 @@
+import os
+import random
+
+import pytest
+
+from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.snp_functions import page_rows_of, page_outputs, limit_page_area, figure_size, MAX_PAGE_PIXELS, MIN_PAGE_ROWS
+
+LENGTH = 30000
+
+
+def page_pixels(rows, dpi, size_option, width, height, num_sites):
+    spacing = LENGTH / (num_sites + 1)
+    fig_width, fig_height, y_inc = figure_size(size_option, width, height, num_sites, num_sites, rows + 1, rows, spacing, LENGTH)
+    return fig_width * fig_height * dpi * dpi
+
+
+def limit(num_records, page_rows, dpi, size_option="expand", width=None, height=None, num_sites=10):
+    return limit_page_area(num_records, page_rows, dpi, size_option, width, height, num_sites, num_sites,
+                           LENGTH / (num_sites + 1), LENGTH)
+
+
+def test_page_rows_of():
+    assert page_rows_of(5) == [[0, 1, 2, 3, 4]]
+    assert page_rows_of(5, 2) == [[0, 1], [2, 3], [4]]
+    assert page_rows_of(5, 0) == [[0, 1, 2, 3, 4]]
+    # the recombi references head every page
+    assert page_rows_of(6, 2, recombi_mode=True) == [[0, 1, 2, 3], [0, 1, 4, 5]]
+    pages = page_rows_of(sfunks.AUTO_PAGE_ROWS + 1)
+    assert [len(page) for page in pages] == [sfunks.AUTO_PAGE_ROWS, 1]
+
+
+def test_page_outputs():
+    assert page_outputs("snp_plot.png", 1) == ["snp_plot.png"]
+    assert page_outputs("snp_plot.png", 10) == [f"snp_plot_page{page:02d}.png" for page in range(1, 11)]
+    assert page_outputs("snp_plot.pdf", 3) == ["snp_plot.pdf"] * 3
+
+
+def test_small_plots_are_left_alone(capsys):
+    # automatic paging resolves to every record on one page
+    assert limit(50, None, 300) == (0, 300)
+    assert limit(50, 10, 300) == (10, 300)
+    assert capsys.readouterr().err == ""
+
+
+def test_tall_pages_get_fewer_rows(capsys):
+    page_rows, dpi = limit(5000, None, 300)
+    assert dpi == 300
+    assert MIN_PAGE_ROWS <= page_rows < sfunks.AUTO_PAGE_ROWS
+    assert page_pixels(page_rows, dpi, "expand", None, None, 10) <= MAX_PAGE_PIXELS
+    # the most rows that fit
+    assert page_pixels(page_rows + 1, dpi, "expand", None, None, 10) > MAX_PAGE_PIXELS
+    assert "too large to draw" in capsys.readouterr().err
+
+
+def test_wide_pages_are_drawn_at_a_lower_dpi():
+    # with this many sites even MIN_PAGE_ROWS rows don't fit at 300 dpi
+    page_rows, dpi = limit(200, None, 300, num_sites=950)
+    assert page_rows == MIN_PAGE_ROWS
+    assert 1 <= dpi < 300
+    assert page_pixels(page_rows, dpi, "expand", None, None, 950) <= MAX_PAGE_PIXELS
+
+
+@pytest.mark.parametrize("page_rows", [None, 500])
+def test_fixed_height_pages_keep_their_rows(page_rows):
+    # shorter pages wouldn't be any smaller with a fixed height
+    rows, dpi = limit(500, page_rows, 300, width=400, height=100, num_sites=950)
+    assert rows == 500
+    assert page_pixels(rows, dpi, "expand", 400, 100, 950) <= MAX_PAGE_PIXELS
+
+
+def test_snps_csv_is_only_written_when_asked_for(tmp_path):
+    variants = sfunks.find_snps("ACGT", {"ACGA": ["a"], "ACGT": ["b"]}, False, "nt", "snps")
+    sfunks.write_out_snps(False, variants, str(tmp_path))
+    assert not (tmp_path / "snps.csv").exists()
+
+    sfunks.write_out_snps(True, variants, str(tmp_path))
+    assert (tmp_path / "snps.csv").read_text() == "record,snps,num_snps\na,4:TA,1\nb,,0\n"
+
+
+def test_parallel_pages_match_serial_pages(tmp_path):
+    rng = random.Random(3)
+    reference = "".join(rng.choice("ACGT") for _ in range(300))
+    input_seqs = {}
+    for i in range(12):
+        seq = list(reference)
+        for _ in range(5):
+            seq[rng.randrange(len(seq))] = rng.choice("ACGT")
+        input_seqs.setdefault("".join(seq), []).append(f"seq{i}")
+    variants = sfunks.find_snps(reference, input_seqs, False, "nt", "snps")
+    label_map = {record: record for record in variants.records}
+    label_map[sfunks.REFERENCE_LABEL] = "reference"
+
+    def draw(output, processes):
+        return sfunks.make_graph(len(variants), variants.num_snps, None, variants, output, label_map,
+                                 sfunks.get_colours("classic"), len(reference), None, None, "expand",
+                                 False, False, "snps", page_rows=5, processes=processes)
+
+    serial = draw(str(tmp_path / "serial.png"), 1)
+    parallel = draw(str(tmp_path / "parallel.png"), 2)
+    assert [os.path.basename(path) for path in parallel] == ["parallel_page1.png", "parallel_page2.png", "parallel_page3.png"]
+    for serial_page, parallel_page in zip(serial, parallel):
+        with open(serial_page, "rb") as f, open(parallel_page, "rb") as g:
+            assert f.read() == g.read()
@@ -0,0 +1,130 @@
+import gzip
+import random
+
+import numpy as np
+import pytest
+
+from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.positions import (IntervalSet, PositionFilter, merge_intervals,
+                                      read_bed_intervals, read_vcf_intervals)
+
+
+def test_merge_intervals():
+    assert merge_intervals([(10, 20), (1, 3), (4, 5), (15, 30), (40, 40)]) == [(1, 5), (10, 30), (40, 40)]
+
+
+def test_interval_set_membership():
+    intervals = IntervalSet([(1, 5000000), (5000010, 5000010)])
+    assert len(intervals) == 2
+    assert 1 in intervals and 5000000 in intervals and 5000010 in intervals
+    assert 0 not in intervals and 5000001 not in intervals and 5000011 not in intervals
+    assert intervals.contains([0, 1, 5000001, 5000010]).tolist() == [False, True, False, True]
+    assert IntervalSet([]).contains([1, 2]).tolist() == [False, False]
+
+
+def test_interval_set_fill():
+    mask = IntervalSet([(2, 3), (6, 20)]).fill(np.zeros(8, dtype=bool), True)
+    assert mask.tolist() == [False, True, True, False, False, True, True, True]
+
+
+def test_inclusion_is_considered_before_exclusion():
+    positions = PositionFilter(included=[(10, 20)], excluded=[(15, 30)])
+    assert positions
+    assert positions.keeps(12)
+    assert not positions.keeps(15)
+    assert not positions.keeps(5)
+    assert positions.mask([5, 12, 15, 25]).tolist() == [False, True, False, False]
+    assert not PositionFilter()
+
+
+def expand(ranges, length):
+    kept = np.zeros(length, dtype=bool)
+    for start, end in ranges:
+        kept[start:end] = True
+    return kept
+
+
+def test_column_ranges_match_the_mask():
+    rng = random.Random(2)
+    length = 500
+    for _ in range(200):
+        def random_intervals(count):
+            intervals = []
+            for _ in range(count):
+                start = rng.randrange(-5, length + 5)
+                intervals.append((start, start + rng.randrange(0, 60)))
+            return intervals
+
+        included = random_intervals(rng.randrange(0, 4)) or None
+        positions = PositionFilter(included, random_intervals(rng.randrange(0, 6)), random_intervals(rng.randrange(0, 3)))
+        ranges = positions.column_ranges(length)
+
+        assert ranges == sorted(ranges)
+        assert all(start < end for start, end in ranges)
+        assert expand(ranges, length).tolist() == positions.mask(np.arange(1, length + 1)).tolist()
+
+
+def test_key_distinguishes_filters():
+    assert PositionFilter(excluded=[(1, 5)]).key() != PositionFilter(masked=[(1, 5)]).key()
+    assert PositionFilter(excluded=[(1, 5)]).key() == PositionFilter(excluded=[(1, 2), (3, 5)]).key()
+
+
+def test_find_snps_only_compares_kept_columns():
+    reference = "ACGTACGTAC"
+    input_seqs = {"TCGTACGTAG": ["a"], "ACGAACGTAC": ["b"]}
+    matrix = sfunks.find_snps(reference, input_seqs, False, "nt", "snps",
+                              PositionFilter(included=[(1, 9)], excluded=[(4, 4)]))
+    assert matrix.record_variants("a") == ["1:AT"]
+    assert matrix.record_variants("b") == []
+
+
+def test_read_bed_intervals(tmp_path):
+    bed = tmp_path / "mask.bed"
+    bed.write_text("track name=mask\n"
+                   "# comment\n"
+                   "ref\t0\t10\tfirst\n"
+                   "ref 54 55\n"
+                   "ref\t20\t20\n")
+    assert read_bed_intervals(str(bed)) == [(1, 10), (55, 55)]
+
+
+def test_read_bed_intervals_gzipped(tmp_path):
+    bed = tmp_path / "mask.bed.gz"
+    with gzip.open(bed, "wt") as f:
+        f.write("ref\t99\t120\n")
+    assert read_bed_intervals(str(bed)) == [(100, 120)]
+
+
+def test_read_bed_intervals_rejects_other_files(tmp_path):
+    bed = tmp_path / "mask.bed"
+    bed.write_text("ref\tstart\tend\n")
+    with pytest.raises(ValueError, match="line 1"):
+        read_bed_intervals(str(bed))
+
+
+def test_read_vcf_intervals_leaves_caution_sites_in(tmp_path):
+    vcf = tmp_path / "problematic_sites.vcf"
+    vcf.write_text("##fileformat=VCFv4.2\n"
+                   "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                   "ref\t55\t.\tC\tT\t.\tmask\t.\n"
+                   "ref\t100\t.\tACG\tA\t.\tmask\t.\n"
+                   "ref\t200\t.\tG\tT\t.\tcaution\t.\n")
+    assert read_vcf_intervals(str(vcf)) == [(55, 55), (100, 102)]
+
+
+def test_masks_are_mapped_through_the_gapped_reference():
+    # reference positions 3-4 sit either side of a two column insertion
+    reference_row = np.frombuffer(b"ACG--TACGT", dtype=np.uint8)
+    positions = PositionFilter(masked=[(3, 4), (8, 20)])
+    assert positions.masked_columns(reference_row) == [(3, 6), (10, 10)]
+    # without a reference the positions are taken as columns
+    assert positions.masked_columns() == [(3, 4), (8, 20)]
+    assert positions.column_ranges(10, reference_row) == [(0, 2), (6, 9)]
+
+
+def test_find_snps_masks_reference_positions():
+    reference = "ACG--TACGT"
+    input_seqs = {"TCGAATACGA": ["a"]}
+    # reference position 8 is alignment column 10
+    matrix = sfunks.find_snps(reference, input_seqs, True, "nt", "snps", PositionFilter(masked=[(8, 8)]))
+    assert matrix.record_variants("a") == ["1:AT", "4:ins2"]
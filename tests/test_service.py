@@ -0,0 +1,37 @@
+import pytest
+
+from snipit.api import SnipitConfig
+from snipit.service import _pin_outputs, _request_key
+
+
+def test_request_key_follows_every_input_file(tmp_path):
+    alignment = tmp_path / "aln.fasta"
+    alignment.write_text(">a\nACGT\n")
+    genbank = tmp_path / "ref.gb"
+    genbank.write_text("LOCUS\n")
+    config = SnipitConfig(genbank=str(genbank))
+
+    key = _request_key(alignment, config)
+    assert key == _request_key(alignment, config)
+    genbank.write_text("LOCUS changed\n")
+    assert key != _request_key(alignment, config)
+
+
+def test_outputs_are_pinned_inside_the_output_root(tmp_path):
+    root = tmp_path.resolve()
+    config = _pin_outputs({"output_dir": "plots", "output_file": "plot.svg"}, root)
+    assert config["output_dir"] == str(root / "plots")
+    assert config["output_file"] == "plot.svg"
+    assert _pin_outputs({}, root)["output_dir"] == str(root)
+
+
+@pytest.mark.parametrize("config", [
+    {"output_dir": "../elsewhere"},
+    {"output_dir": "/tmp"},
+    {"profile_trace": "../trace.json"},
+    {"output_file": "../plot.png"},
+    {"output_file": "plots/plot.png"},
+])
+def test_outputs_outside_the_output_root_are_rejected(tmp_path, config):
+    with pytest.raises(ValueError):
+        _pin_outputs(config, tmp_path.resolve())
@@ -0,0 +1,41 @@
+import numpy as np
+from Bio.Seq import Seq
+
+from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.translation import translate_alignment, find_aa_changes
+
+
+def aa_strings(matrix):
+    return [row.tobytes().decode("ascii") for row in matrix]
+
+
+def test_translate_alignment():
+    sequences = ["ATGGATTAA", "atgga-taa", "ATGNNN---"]
+    assert aa_strings(translate_alignment(sequences)) == ["MD*", "MX*", "MX-"]
+    # trailing bases that don't make a codon are dropped
+    assert aa_strings(translate_alignment(["ATGGATTAAGC"])) == ["MD*"]
+
+
+def test_translate_alignment_matches_the_codon_table():
+    rng = np.random.default_rng(0)
+    sequence = "".join(rng.choice(list("ACGT"), size=3 * 500))
+    assert aa_strings(translate_alignment([sequence])) == [str(Seq(sequence).translate())]
+
+
+def test_find_aa_changes_splits_synonymous_snps():
+    reference = "ATGGATCTTTAA"
+    input_seqs = {
+        # GAT->GAC keeps D, CTT->CTC keeps L
+        "ATGGACCTCTAA": ["syn"],
+        # GAT->GGT is D2G, shared by two records
+        "ATGGGTCTTTAA": ["nonsyn1", "nonsyn2"],
+        # an ambiguous codon is neither
+        "ATGGANCTTTAA": ["ambiguous"],
+    }
+    variants = sfunks.find_snps(reference, input_seqs, False, "nt", "snps")
+    record_aa_snps, record_synonymous = find_aa_changes(reference, input_seqs, variants)
+
+    assert record_aa_snps == {"syn": [], "nonsyn1": ["2:DG"], "nonsyn2": ["2:DG"], "ambiguous": []}
+    assert record_synonymous["syn"] == {"6:TC", "9:TC"}
+    assert record_synonymous["nonsyn1"] == set()
+    assert record_synonymous["ambiguous"] == set()
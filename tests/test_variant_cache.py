@@ -0,0 +1,69 @@
+from snipit.scripts.variant_cache import VariantCache, variant_cache_key, estimate_size
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    value = "x" * 1000
+    size = estimate_size(value)
+    cache = VariantCache(max_bytes=size * 2)
+    cache.put("a", value)
+    cache.put("b", "y" * 1000)
+    # reading a makes b the least recently used
+    assert cache.get("a") == value
+    cache.put("c", "z" * 1000)
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.current_bytes <= cache.max_bytes
+
+
+def test_entries_larger_than_the_budget_are_not_stored():
+    cache = VariantCache(max_bytes=100)
+    cache.put("big", "x" * 1000)
+    assert len(cache) == 0
+    assert cache.current_bytes == 0
+
+
+def test_resize_evicts_down_to_the_new_budget():
+    cache = VariantCache()
+    for key in "abcd":
+        cache.put(key, key * 1000)
+    cache.resize(estimate_size("a" * 1000))
+    assert list(key for key in "abcd" if key in cache) == ["d"]
+
+
+def test_replacing_an_entry_keeps_the_byte_count():
+    cache = VariantCache()
+    cache.put("a", "x" * 1000)
+    cache.put("a", "x" * 10)
+    assert cache.current_bytes == estimate_size("x" * 10)
+
+
+def test_hits_and_misses_are_counted():
+    cache = VariantCache()
+    assert cache.get("a") is None
+    cache.put("a", "value")
+    cache.get("a")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_shared_objects_count_once():
+    shared = ["x" * 1000]
+    assert estimate_size({"a": shared, "b": shared}) < estimate_size({"a": shared, "b": ["y" * 1000]})
+
+
+def test_key_changes_when_an_input_file_changes(tmp_path):
+    alignment = tmp_path / "aln.fasta"
+    alignment.write_text(">a\nACGT\n")
+    genbank = tmp_path / "ref.gb"
+    genbank.write_text("LOCUS\n")
+
+    key = variant_cache_key("aln.fasta", str(tmp_path), input_files=("ref.gb",), show_indels=False)
+    assert key == variant_cache_key("aln.fasta", str(tmp_path), input_files=("ref.gb",), show_indels=False)
+    assert key != variant_cache_key("aln.fasta", str(tmp_path), input_files=("ref.gb",), show_indels=True)
+
+    genbank.write_text("LOCUS changed\n")
+    assert key != variant_cache_key("aln.fasta", str(tmp_path), input_files=("ref.gb",), show_indels=False)
+
+
+def test_no_key_without_an_alignment(tmp_path):
+    assert variant_cache_key("missing.fasta", str(tmp_path)) is None
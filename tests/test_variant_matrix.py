@@ -0,0 +1,101 @@
+import numpy as np
+
+from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.variant_matrix import (VariantMatrix, AMBIGUITY, INSERTION, DELETION,
+                                           SNP_KEY, DELETION_KEY, variant_keys, key_variant)
+
+REFERENCE = "ACGTACGT-ACGTACGT"
+INPUT_SEQS = {
+    # a snp, a one base insertion and a two base deletion, shared by two records
+    "ACGAACGTTACG--CGT": ["a", "b"],
+    # an ambiguity at a site the others call, and a snp of its own
+    "ACGWACGT-ACGTACGA": ["c"],
+}
+
+
+def as_dict(matrix):
+    return {record: (matrix.record_variants(record), matrix.record_variants(record, ambiguities=True))
+            for record in matrix.records}
+
+
+def test_keys_round_trip():
+    keys = variant_keys([23403, 100], SNP_KEY, [ord("A") << 8 | ord("G"), 0])
+    assert key_variant(int(keys[0])) == "23403:AG"
+    assert key_variant(int(variant_keys([100], DELETION_KEY, [3])[0])) == "100:del3"
+
+
+def test_find_snps_builds_the_matrix():
+    matrix = sfunks.find_snps(REFERENCE, INPUT_SEQS, True, "nt", "snps")
+
+    assert matrix.records == ["a", "b", "c"]
+    assert matrix.sites.tolist() == [4, 9, 13, 17]
+    assert as_dict(matrix) == {"a": (["4:TA", "9:ins1", "13:del2"], []),
+                               "b": (["4:TA", "9:ins1", "13:del2"], []),
+                               "c": (["17:TA"], ["4:TW"])}
+    # codes are numbered in the order they're first called, ambiguities last
+    assert matrix.variants == ["4:TA", "9:ins1", "13:del2", "17:TA", "4:TW"]
+    assert matrix.flags.tolist() == [0, INSERTION, DELETION, 0, INSERTION, DELETION, 0, AMBIGUITY]
+
+    assert matrix.num_snps == 4
+    assert matrix.row_counts().tolist() == [3, 3, 1]
+    assert matrix.site_counts().tolist() == [2, 2, 2, 1]
+    assert matrix.variant_counts()["4:TA"] == 2
+    assert matrix.ambiguous_sites().tolist() == [4]
+
+
+def test_indels_are_left_out_unless_shown():
+    matrix = sfunks.find_snps(REFERENCE, INPUT_SEQS, False, "nt", "snps")
+    assert matrix.sites.tolist() == [4, 17]
+    assert matrix.record_variants("a") == ["4:TA"]
+
+
+def test_ambiguities_are_called_as_snps_in_all_mode():
+    matrix = sfunks.find_snps(REFERENCE, INPUT_SEQS, False, "nt", "all")
+    # it's still listed as an ambiguity too, as in every mode
+    assert as_dict(matrix)["c"] == (["4:TW", "17:TA"], ["4:TW"])
+
+
+def test_records_are_not_compared_with_themselves():
+    references = {"a": "ACGAACGTTACG--CGT", "c": "ACGWACGT-ACGTACGA"}
+    matrices = sfunks.find_snps_multi(references, INPUT_SEQS, False, "nt", "snps")
+    assert matrices["a"].records == ["b", "c"]
+    assert matrices["a"].record_variants("b") == []
+    assert matrices["c"].records == ["a", "b"]
+
+
+def test_from_calls_copies_shared_rows():
+    # two unique sequences: the first carried by records x and y, the second by z
+    keys = variant_keys([5, 9, 5], SNP_KEY, [ord("A") << 8 | ord("G"), ord("C") << 8 | ord("T"), ord("A") << 8 | ord("G")])
+    matrix = VariantMatrix.from_calls([["x", "y"], ["z"]], np.array([0, 2, 3]),
+                                      np.array([5, 9, 5]), keys, np.zeros(3, dtype=np.uint8))
+
+    assert matrix.indptr.tolist() == [0, 2, 4, 5]
+    assert matrix.variants == ["5:AG", "9:CT"]
+    assert matrix.codes.tolist() == [0, 1, 0, 1, 0]
+    assert as_dict(matrix) == as_dict(VariantMatrix.from_records({"x": ["5:AG", "9:CT"],
+                                                                  "y": ["5:AG", "9:CT"],
+                                                                  "z": ["5:AG"]}))
+
+
+def test_select_sites_and_reorder():
+    matrix = sfunks.find_snps(REFERENCE, INPUT_SEQS, True, "nt", "snps")
+
+    selected = matrix.select_sites(matrix.sites != 9)
+    assert selected.sites.tolist() == [4, 13, 17]
+    assert selected.record_variants("a") == ["4:TA", "13:del2"]
+    assert selected.record_variants("c", ambiguities=True) == ["4:TW"]
+
+    reordered = matrix.reorder(["c", "a", "b"])
+    assert as_dict(reordered) == as_dict(matrix)
+    assert reordered.records == ["c", "a", "b"]
+    # the original is left as it was
+    assert matrix.records == ["a", "b", "c"]
+
+
+def test_by_site_walks_columns_in_row_order():
+    matrix = sfunks.find_snps(REFERENCE, INPUT_SEQS, True, "nt", "snps")
+    site, rows, codes, flags = next(matrix.by_site())
+    assert site == 4
+    assert rows.tolist() == [0, 1, 2]
+    assert [matrix.variants[code] for code in codes.tolist()] == ["4:TA", "4:TA", "4:TW"]
+    assert flags.tolist() == [0, 0, AMBIGUITY]
@@ -0,0 +1,170 @@
+import gzip
+import struct
+
+import pytest
+from Bio import bgzf
+
+from snipit.scripts import snp_functions as sfunks
+from snipit.scripts.vcf import (vcf_variants, write_vcf, tabix_offset, iter_records, read_header, parse_region,
+                               TABIX_WINDOW_SHIFT)
+
+HEADER = ("##fileformat=VCFv4.2\n"
+          "##contig=<ID=ref,length=100>\n"
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\ts3\n")
+
+
+def write_vcf_lines(path, lines, header=HEADER):
+    path.write_text(header + "".join("\t".join(map(str, fields)) + "\n" for fields in lines))
+    return str(path)
+
+
+def as_dict(matrix):
+    return {record: (matrix.record_variants(record), matrix.record_variants(record, ambiguities=True))
+            for record in matrix.records}
+
+
+def test_read_header(tmp_path):
+    vcf = write_vcf_lines(tmp_path / "calls.vcf", [])
+    assert read_header(vcf) == (["s1", "s2", "s3"], {"ref": 100})
+
+
+@pytest.mark.parametrize("region, expected", [
+    ("ref", ("ref", 1, None)),
+    ("ref:1,000", ("ref", 1000, None)),
+    ("ref:10-20", ("ref", 10, 20)),
+])
+def test_parse_region(region, expected):
+    assert parse_region(region) == expected
+
+
+def test_parse_region_rejects_backwards_ranges():
+    with pytest.raises(ValueError):
+        parse_region("ref:20-10")
+
+
+def test_genotypes_become_variants_and_ambiguities(tmp_path):
+    vcf = write_vcf_lines(tmp_path / "calls.vcf", [
+        # haploid, heterozygous and missing calls
+        ("ref", 10, ".", "A", "G", ".", ".", ".", "GT", "1", "0/1", "."),
+        # a record without genotypes has nothing to call
+        ("ref", 20, ".", "C", "T", ".", ".", ".", "DP", "5", "5", "5"),
+        # a multi-allelic MNP, with a sample that drops its trailing GT
+        ("ref", 30, ".", "AC", "GT,AT", ".", ".", ".", "DP:GT", "3:2", "3:1|1", "3"),
+        # a deletion, anchored on its first base
+        ("ref", 40, ".", "ACG", "A", ".", ".", ".", "GT", "0", "1", "0"),
+        # an ambiguity where nobody has a called variant
+        ("ref", 50, ".", "A", "C", ".", ".", ".", "GT", "0/1", "0", "0"),
+    ])
+    called = vcf_variants(vcf, show_indels=True)
+    assert called["samples"] == ["s1", "s2", "s3"]
+    assert called["chrom"] == "ref"
+    assert called["length"] == 100
+    assert as_dict(called["variants"]) == {
+        "s1": (["10:AG", "31:CT"], []),
+        "s2": (["30:AG", "31:CT", "41:del2"], ["10:AR"]),
+        "s3": ([], ["10:AN", "30:AN"]),
+    }
+
+    # without indels the deletion isn't called, and in 'all' mode every ambiguity is kept
+    called = vcf_variants(vcf, ambig_mode="all")
+    assert as_dict(called["variants"])["s1"] == (["10:AG", "31:CT", "50:AM"], ["50:AM"])
+    assert as_dict(called["variants"])["s2"] == (["10:AR", "30:AG", "31:CT"], ["10:AR"])
+
+
+def test_records_on_more_than_one_chromosome_need_a_region(tmp_path):
+    vcf = write_vcf_lines(tmp_path / "calls.vcf", [
+        ("ref", 10, ".", "A", "G", ".", ".", ".", "GT", "1", "0", "0"),
+        ("other", 10, ".", "A", "G", ".", ".", ".", "GT", "0", "1", "0"),
+    ])
+    with pytest.raises(ValueError, match="more than one chromosome"):
+        vcf_variants(vcf)
+    called = vcf_variants(vcf, region="other")
+    assert called["chrom"] == "other"
+    assert as_dict(called["variants"])["s2"] == (["10:AG"], [])
+
+
+def write_indexed_vcf(path, chrom, lines):
+    """bgzip a VCF and write a tabix index with only the linear index filled in."""
+    windows = {}
+    with bgzf.BgzfWriter(str(path), "wb") as writer:
+        writer.write(HEADER.encode())
+        writer.flush()
+        for fields in lines:
+            window = (int(fields[1]) - 1) >> TABIX_WINDOW_SHIFT
+            windows.setdefault(window, writer.tell())
+            writer.write(("\t".join(map(str, fields)) + "\n").encode())
+    # windows without records start at the next one that has them
+    offsets = [0] * (max(windows) + 1)
+    following = windows[max(windows)]
+    for window in range(max(windows), -1, -1):
+        following = windows.get(window, following)
+        offsets[window] = following
+
+    name = chrom.encode() + b"\x00"
+    index = b"TBI\x01" + struct.pack("<8i", 1, 2, 1, 2, 0, ord("#"), 0, len(name)) + name
+    index += struct.pack("<i", 0) + struct.pack("<i", len(offsets)) + struct.pack(f"<{len(offsets)}Q", *offsets)
+    with gzip.open(f"{path}.tbi", "wb") as f:
+        f.write(index)
+    return str(path), offsets
+
+
+def test_region_reads_start_from_the_tabix_index(tmp_path):
+    lines = [("ref", pos, ".", "A", "G", ".", ".", ".", "GT", "1", "0", "0") for pos in (1, 100, 40000, 40100, 70000)]
+    # a broken record in the first window is never read when seeking past it
+    lines.insert(2, ("ref", 200, ".", "A", "G", ".", ".", ".", "GT", "x", "0", "0"))
+    vcf, offsets = write_indexed_vcf(tmp_path / "calls.vcf.gz", "ref", lines)
+
+    assert tabix_offset(vcf + ".tbi", "ref", 1) == offsets[0]
+    assert tabix_offset(vcf + ".tbi", "ref", 40000) == offsets[2]
+    # past the last window, reading starts from the last one
+    assert tabix_offset(vcf + ".tbi", "ref", 10 ** 6) == offsets[-1]
+    assert tabix_offset(vcf + ".tbi", "other", 1) is None
+
+    assert [fields[1] for fields in iter_records(vcf, "ref:40050-70000")] == ["40100", "70000"]
+    assert list(iter_records(vcf, "other")) == []
+    called = vcf_variants(vcf, region="ref:20000")
+    assert as_dict(called["variants"])["s1"] == (["40000:AG", "40100:AG", "70000:AG"], [])
+    with pytest.raises(ValueError):
+        vcf_variants(vcf)
+
+
+def data_lines(path):
+    return [line.rstrip("\n").split("\t") for line in open(path) if not line.startswith("#")]
+
+
+def test_write_vcf_maps_columns_onto_the_reference(tmp_path):
+    # the reference has a two column gap, so later columns are two reference positions back
+    reference = "ACGT--ACGTACGT"
+    input_seqs = {"ACGAGGACGTA--T": ["a"], "ACGT--ACGTACGA": ["b"]}
+    variants = sfunks.find_snps(reference, input_seqs, True, "nt", "snps")
+    output = tmp_path / "out.vcf"
+    write_vcf(variants, str(output), "ref", reference)
+
+    assert "##contig=<ID=ref,length=12>" in output.read_text()
+    assert [line[:5] + line[7:] for line in data_lines(output)] == [
+        ["ref", "4", ".", "T", "A", "AC=1", "GT", "1", "0"],
+        ["ref", "4", ".", "T", "<INS>", "AC=1;SVTYPE=INS;SVLEN=2", "GT", "1", "0"],
+        ["ref", "9", ".", "ACG", "A", "AC=1", "GT", "1", "0"],
+        ["ref", "12", ".", "T", "A", "AC=1", "GT", "0", "1"],
+    ]
+
+
+def test_write_then_read_round_trip(tmp_path):
+    reference = "ACGTACGTACGTACGT"
+    input_seqs = {
+        "ACGAACGTAC--ACGT": ["a"],
+        "ACGCACGTACGTACGA": ["b"],
+        "ACGYACGTACGTACGT": ["c"],
+        reference: ["d"],
+    }
+    variants = sfunks.find_snps(reference, input_seqs, True, "nt", "snps")
+    output = tmp_path / "out.vcf"
+    write_vcf(variants, str(output), "ref", reference)
+
+    read_back = vcf_variants(str(output), show_indels=True)
+    assert read_back["samples"] == ["a", "b", "c", "d"]
+    assert read_back["length"] == len(reference)
+    expected = as_dict(variants)
+    # ambiguous records are written with a missing genotype, which reads back as N
+    expected["c"] = ([], ["4:TN"])
+    assert as_dict(read_back["variants"]) == expected
@@ -41,20 +41,17 @@ def generate_updated_examples():
         )
         
         # Find SNPs
-        snp_dict, record_snps, num_snps = sfunks.find_snps(
+        variants = sfunks.find_snps(
             reference, alignment, False, sequence_type, "snps"
         )
         
-        # Find ambiguities
-        record_ambs = sfunks.find_ambiguities(alignment, snp_dict, sequence_type)
-        
         # Get nature palette colors
         colours = sfunks.get_colours("nature")
         
         # Generate main genome graph
         output_file = "docs/genome_graph.png"
         sfunks.make_graph(
-            num_seqs, num_snps, record_ambs, record_snps, output_file,
+            num_seqs, variants.num_snps, None, variants, output_file,
             label_map, colours, length, 16, 6, "scale", False, False,
             "snps", False, None, None, False, True, False, None,
             False, None, None, "nature", sequence_type
@@ -66,7 +63,7 @@ def generate_updated_examples():
             gene_features = sfunks.parse_genbank("docs/test_reference.gb", os.getcwd(), sequence_type)
             output_file = "docs/examples/sars_cov2_nature.png"
             sfunks.make_graph(
-                num_seqs, num_snps, record_ambs, record_snps, output_file,
+                num_seqs, variants.num_snps, None, variants, output_file,
                 label_map, colours, length, 16, 6, "scale", False, False,
                 "snps", False, None, None, False, True, False, None,
                 False, None, gene_features, "nature", sequence_type